@@ -0,0 +1,226 @@
+import os
+import pickle
+import hashlib
+import datetime
+import psycopg2
+from collections import OrderedDict
+from sql_queries import load_watermark_select, load_watermark_listen, \
+    top_artists_by_hour_location_select, artist_revenue_by_location_select, \
+    artist_daily_plays_select, top_songs_select, user_plays_select, \
+    plays_by_hour_select, artist_revenue_by_location_select_typed, \
+    top_songs_select_typed, user_plays_select_typed, plays_by_hour_select_typed
+from typed_schema import is_typed_schema
+
+
+# query name -> (sql, tables read)
+ANALYTICS_QUERIES = {
+    "top_artists_by_hour_location": (
+        top_artists_by_hour_location_select,
+        ("artist_hour_location_users", "artists")),
+    "artist_revenue_by_location": (
+        artist_revenue_by_location_select, ("songplays", "artists")),
+    "artist_daily_plays": (
+        artist_daily_plays_select, ("artist_level_day_plays", "artists")),
+    "top_songs": (top_songs_select, ("songplays", "songs", "artists")),
+    "user_plays": (user_plays_select, ("songplays", "songs", "artists")),
+    "plays_by_hour": (plays_by_hour_select, ("songplays",)),
+}
+
+# the queries that differ for the typed layout
+TYPED_QUERIES = {
+    "artist_revenue_by_location": artist_revenue_by_location_select_typed,
+    "top_songs": top_songs_select_typed,
+    "user_plays": user_plays_select_typed,
+    "plays_by_hour": plays_by_hour_select_typed,
+}
+
+
+class ResultCache:
+    """
+    Two-level LRU cache of query results: a dict of the most recently used
+    results in memory and, when cache_dir is set, one pickle file per
+    result on disk, evicted by least recent use (file mtime).
+    """
+
+    def __init__(self, cache_dir=None, memory_entries=256, disk_entries=4096):
+        self.cache_dir = cache_dir
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self._memory = OrderedDict()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".pkl")
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        This procedure returns the cached result for key, or None.
+
+        INPUTS:
+        * key a hashable key with a stable repr
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                stored_key, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if stored_key != key:
+            return None
+        os.utime(path)
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        This procedure stores a result in memory and on disk, evicting the
+        least recently used entries beyond the limits.
+
+        INPUTS:
+        * key a hashable key with a stable repr
+        * value the result to cache
+        """
+        self._remember(key, value)
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        self._evict()
+
+    def _evict(self):
+        entries = [entry for entry in os.scandir(self.cache_dir)
+                   if entry.name.endswith(".pkl")]
+        if len(entries) <= self.disk_entries:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.disk_entries]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+class Analytics:
+    """
+    Query API over sparkifydb for the common star-schema questions.
+    Results are cached under the load watermarks of the tables each query
+    reads. The watermarks are read once and reloaded only when the ETL
+    sends a load_watermark notification, so repeated queries between
+    loads are answered without a round trip to postgres.
+    """
+
+    def __init__(self, dsn="host=127.0.0.1 dbname=sparkifydb user=student "
+                           "password=student", cache_dir=None,
+                 memory_entries=256, disk_entries=4096):
+        self.conn = psycopg2.connect(dsn)
+        self.conn.autocommit = True
+        self.cache = ResultCache(cache_dir, memory_entries, disk_entries)
+        with self.conn.cursor() as cur:
+            cur.execute(load_watermark_listen)
+            self.typed = is_typed_schema(cur)
+        self._watermarks = self._load_watermarks()
+
+    def _load_watermarks(self):
+        with self.conn.cursor() as cur:
+            cur.execute(load_watermark_select)
+            return {table: loaded_at.isoformat()
+                    for table, loaded_at in cur.fetchall()}
+
+    def watermarks(self):
+        """
+        This procedure returns the load watermark of every table, reloading
+        them if a load committed since they were last read.
+        """
+        self.conn.poll()
+        if self.conn.notifies:
+            del self.conn.notifies[:]
+            self._watermarks = self._load_watermarks()
+        return self._watermarks
+
+    def query(self, name, **params):
+        """
+        This procedure runs one of ANALYTICS_QUERIES and returns its rows,
+        from the cache when none of the tables it reads was loaded since
+        the result was cached.
+
+        INPUTS:
+        * name the query name
+        * params the query parameters
+        """
+        sql, tables = ANALYTICS_QUERIES[name]
+        if self.typed:
+            sql = TYPED_QUERIES.get(name, sql)
+        watermarks = self.watermarks()
+        key = (name, tuple(sorted(params.items())),
+               tuple(watermarks.get(table) for table in tables))
+        rows = self.cache.get(key)
+        if rows is None:
+            with self.conn.cursor() as cur:
+                cur.execute(sql, params)
+                rows = cur.fetchall()
+            self.cache.put(key, rows)
+        return rows
+
+    def top_artists_by_hour_location(self, location, min_hour=0, max_hour=23,
+                                     limit=10):
+        """
+        Artists with the most distinct listeners in a location (LIKE
+        pattern, e.g. '%, CA%') between two hours of the day.
+        """
+        return self.query("top_artists_by_hour_location", location=location,
+                          min_hour=min_hour, max_hour=max_hour, limit=limit)
+
+    def artist_revenue_by_location(self, artist, location="%"):
+        """
+        Paid plays of an artist per listener location.
+        """
+        return self.query("artist_revenue_by_location", artist=artist,
+                          location=location)
+
+    def artist_daily_plays(self, artist, start, end):
+        """
+        Plays and distinct listeners of an artist per day and level, for
+        the dates start <= day < end.
+        """
+        return self.query("artist_daily_plays", artist=artist, start=start,
+                          end=end)
+
+    def top_songs(self, start, end, limit=10):
+        """
+        Most played songs between two timestamps.
+        """
+        return self.query("top_songs", start=start, end=end, limit=limit)
+
+    def user_plays(self, user_id, start=datetime.datetime.min,
+                   end=datetime.datetime.max):
+        """
+        Songs played by one user between two timestamps.
+        """
+        return self.query("user_plays", user_id=str(user_id), start=start,
+                          end=end)
+
+    def plays_by_hour(self, start, end):
+        """
+        Plays and distinct listeners per hour of the day between two
+        timestamps.
+        """
+        return self.query("plays_by_hour", start=start, end=end)
+
+    def close(self):
+        self.conn.close()
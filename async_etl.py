@@ -0,0 +1,157 @@
+import asyncio
+import functools
+import numpy as np
+from psycopg2.extensions import register_adapter, AsIs
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import metrics
+from etl import PARALLEL_STAGES, SONGPLAY_PROCESSORS, list_files, \
+    write_files, build_parser, run
+
+
+class _End:
+    """
+    Last item of a pipeline queue; carries the error that stopped the
+    stage upstream, if any.
+    """
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+def read_bytes(filepath):
+    with open(filepath, "rb") as f:
+        return f.read()
+
+
+async def _prefetch(all_files, queue, io_executor):
+    """
+    This procedure reads the files in order in a thread and queues their
+    content, waiting while the queue is full.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        for datafile, entry in all_files:
+            data = await loop.run_in_executor(io_executor, read_bytes, datafile)
+            await queue.put((datafile, entry, data))
+    except Exception as exc:
+        await queue.put(_End(exc))
+        return
+    await queue.put(_End())
+
+
+async def _parse(in_queue, out_queue, transform, executor):
+    """
+    This procedure submits every prefetched file to the parse executor and
+    queues the pending result in file order, so up to the size of
+    out_queue files are parsed at the same time.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await in_queue.get()
+        if isinstance(item, _End):
+            await out_queue.put(item)
+            return
+        datafile, entry, data = item
+        await out_queue.put(
+            (datafile, entry, loop.run_in_executor(executor, transform, data)))
+
+
+async def _await(future):
+    return await future
+
+
+async def _pipeline(cur, conn, all_files, func, workers, queue_size,
+                    commit_policy, kwargs):
+    loop = asyncio.get_running_loop()
+    transform = PARALLEL_STAGES[func][0]
+    fetched = asyncio.Queue(queue_size)
+    parsed = asyncio.Queue(queue_size)
+
+    def items():
+        # runs in the writer thread and pulls from the event loop
+        while True:
+            item = asyncio.run_coroutine_threadsafe(parsed.get(), loop).result()
+            if isinstance(item, _End):
+                if item.error is not None:
+                    raise item.error
+                return
+            datafile, entry, future = item
+            with metrics.timer(metrics.WAIT):
+                batch = asyncio.run_coroutine_threadsafe(
+                    _await(future), loop).result()
+            yield datafile, entry, batch
+
+    with ThreadPoolExecutor(1) as io_executor, \
+            ProcessPoolExecutor(workers) as parse_executor, \
+            ThreadPoolExecutor(1) as db_executor:
+        tasks = [
+            asyncio.ensure_future(_prefetch(all_files, fetched, io_executor)),
+            asyncio.ensure_future(
+                _parse(fetched, parsed, transform, parse_executor)),
+        ]
+        try:
+            return await loop.run_in_executor(db_executor, functools.partial(
+                write_files, cur, conn, items(), len(all_files), func,
+                commit_policy, **kwargs))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def process_data_async(cur, conn, filepath, func, workers=1,
+                       incremental=False, commit_policy=None, queue_size=8,
+                       **kwargs):
+    """
+    This procedure is a drop-in replacement of etl.process_data that runs
+    the load as an asyncio pipeline of three stages joined by bounded
+    queues: a prefetch stage reading the files, a parse/transform stage in
+    a pool of worker processes and a writer stage committing to postgres
+    in file order. Disk, CPU and database work overlap, and a full queue
+    holds back the stages before it.
+
+    INPUTS:
+    * cur the cursor variable
+    * conn the connection variable
+    * filepath the directory holding the files
+    * func process_song_file or process_log_file
+    * workers number of worker processes parsing files
+    * incremental only process files that are new or changed since the
+      last run, according to the manifest
+    * commit_policy a CommitPolicy, as for etl.process_data
+    * queue_size number of files each queue holds
+    * kwargs extra keyword arguments passed on to func
+
+    Returns the number of rows committed per table, as etl.process_data.
+    """
+    all_files = list_files(cur, filepath, incremental,
+                           reload_changed=func not in SONGPLAY_PROCESSORS)
+    conn.commit()
+    print("{} files found in {}".format(len(all_files), filepath))
+    if not all_files:
+        return {}
+    return asyncio.run(_pipeline(cur, conn, all_files, func, max(workers, 1),
+                          queue_size, commit_policy, kwargs))
+
+
+def main(argv=None):
+    parser = build_parser()
+    parser.add_argument("--queue-size", type=int, default=8,
+                        help="files held between two pipeline stages")
+    args = parser.parse_args(argv)
+    if args.columnar_cache:
+        # the pipeline parses the json itself, use etl.py to read the cache
+        parser.error("--columnar-cache is not supported by the asyncio "
+                     "pipeline; use etl.py")
+    if args.stream_mb:
+        # whole files travel through the pipeline queues
+        parser.error("--stream-mb is not supported by the asyncio pipeline; "
+                     "use etl.py")
+    run(args, process=functools.partial(process_data_async,
+                                         queue_size=args.queue_size))
+
+
+if __name__ == "__main__":
+    register_adapter(np.int64, AsIs)
+    register_adapter(np.float64, AsIs)
+    main()
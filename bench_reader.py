@@ -0,0 +1,65 @@
+import time
+import argparse
+import pandas as pd
+from etl import get_files
+from json_reader import read_log_frame, read_song_records
+
+
+def pandas_log_reader(filepath):
+    df = pd.read_json(filepath, lines=True)
+    return df[df["page"] == "NextSong"]
+
+
+def pandas_song_reader(filepath):
+    return pd.read_json(filepath, lines=True)
+
+
+def bench(reader, files, repeat):
+    """
+    This procedure runs reader over all files repeat times and returns the
+    best wall time in seconds and the number of rows read per pass.
+
+    INPUTS:
+    * reader function taking a file path
+    * files the files to read
+    * repeat number of passes
+    """
+    best, rows = None, 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = 0
+        for f in files:
+            result = reader(f)
+            rows += len(result) if isinstance(result, pd.DataFrame) \
+                else len(next(iter(result.values())))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare the json_reader readers with the pandas path.")
+    parser.add_argument("--log-data", default="data/log_data")
+    parser.add_argument("--song-data", default="data/song_data")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    cases = [
+        ("log", "pandas read_json + filter", pandas_log_reader, args.log_data),
+        ("log", "json_reader.read_log_frame", read_log_frame, args.log_data),
+        ("song", "pandas read_json", pandas_song_reader, args.song_data),
+        ("song", "json_reader.read_song_records", read_song_records,
+         args.song_data),
+    ]
+    print("{:<5} {:<32} {:>6} {:>8} {:>10} {:>12}".format(
+        "data", "reader", "files", "rows", "seconds", "rows/sec"))
+    for kind, name, reader, filepath in cases:
+        files = get_files(filepath)
+        seconds, rows = bench(reader, files, args.repeat)
+        print("{:<5} {:<32} {:>6} {:>8} {:>10.4f} {:>12.0f}".format(
+            kind, name, len(files), rows, seconds, rows / seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import platform
+import contextlib
+import subprocess
+import psycopg2
+import numpy as np
+import pandas as pd
+from psycopg2.extensions import register_adapter, AsIs
+import etl
+import sqlite_backend
+from create_tables import drop_tables, create_tables
+from song_index import load_song_index
+from time_dimension import TimeDimension
+from commit_policy import CommitPolicy
+from sinks import SQLiteSink
+
+
+class CountingCursor:
+    """
+    Cursor wrapper that counts the statements sent to the server, so each
+    stage can report its database round trips.
+    """
+
+    def __init__(self, cur):
+        self._cur = cur
+        self.round_trips = 0
+
+    def execute(self, *args, **kwargs):
+        self.round_trips += 1
+        return self._cur.execute(*args, **kwargs)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        self.round_trips += len(vars_list)
+        return self._cur.executemany(query, vars_list)
+
+    def copy_expert(self, *args, **kwargs):
+        self.round_trips += 1
+        return self._cur.copy_expert(*args, **kwargs)
+
+    def copy_from(self, *args, **kwargs):
+        self.round_trips += 1
+        return self._cur.copy_from(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+class CountingConnection:
+    """
+    Connection wrapper that counts commits as round trips of the cursor.
+    """
+
+    def __init__(self, conn, cur):
+        self._conn = conn
+        self._cur = cur
+
+    def commit(self):
+        self._cur.round_trips += 1
+        return self._conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def peak_rss_mb():
+    """
+    This procedure returns the peak resident set size so far of this
+    process and of its finished worker processes, in MB. Each stage runs
+    in a process of its own (run_stage_process), so this is the peak of
+    that stage.
+    """
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def count_rows(cur, tables):
+    total = 0
+    for table in tables:
+        cur.execute("SELECT count(*) FROM {};".format(table))
+        total += cur.fetchone()[0]
+    return total
+
+
+def run_stage(name, conn, cur, tables, fn):
+    """
+    This procedure runs one benchmark stage and returns its result record
+    with the rows written to tables, rows/sec, database round trips and
+    peak RSS.
+
+    INPUTS:
+    * name the stage name
+    * conn, cur the connection and cursor variables
+    * tables the tables the stage writes, counted before and after
+    * fn the stage, called with a counting connection and cursor
+    """
+    before = count_rows(cur, tables)
+    counting_cur = CountingCursor(cur)
+    counting_conn = CountingConnection(conn, counting_cur)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        fn(counting_conn, counting_cur)
+    seconds = time.perf_counter() - start
+    conn.commit()
+    rows = count_rows(cur, tables) - before
+    return {
+        "stage": name,
+        "seconds": round(seconds, 4),
+        "rows": rows,
+        "rows_per_sec": round(rows / seconds, 1) if seconds else None,
+        "round_trips": counting_cur.round_trips,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def run_stage_process(argv, name):
+    """
+    This procedure runs one benchmark stage in a fresh python process,
+    with the command line of the benchmark, and returns its result record.
+
+    INPUTS:
+    * argv the command line arguments of the benchmark
+    * name the stage name
+    """
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__)] + argv + ["--stage", name],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ETL stages against a local postgres.")
+    parser.add_argument("data", help="directory with song_data and log_data, "
+                                     "e.g. written by generate_data.py")
+    parser.add_argument("--dsn", default="host=127.0.0.1 dbname=sparkifybench "
+                                         "user=student password=student",
+                        help="the database to benchmark against; its tables "
+                             "are dropped and recreated, so it must not be "
+                             "sparkifydb")
+    parser.add_argument("--bulk-songs", action="store_true")
+    parser.add_argument("--stage-songplays", action="store_true")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--copy-rows", type=int, default=1000000,
+                        help="rows of the cd() COPY stage")
+    parser.add_argument("--sqlite", metavar="PATH",
+                        help="benchmark the SQLite database file PATH "
+                             "instead of postgres; each stage is one "
+                             "transaction")
+    parser.add_argument("--output", help="append the results as json lines")
+    # set for the process running one stage
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = parser.parse_args(argv)
+    if args.sqlite and (args.bulk_songs or args.stage_songplays):
+        parser.error("--bulk-songs and --stage-songplays need postgres")
+    if args.sqlite == ":memory:":
+        parser.error("--sqlite needs a file, the stages run in processes "
+                     "of their own")
+    if not args.sqlite and \
+            "sparkifydb" in psycopg2.extensions.parse_dsn(args.dsn).values():
+        parser.error("the benchmark drops the tables of --dsn, use another "
+                     "database than sparkifydb")
+
+    register_adapter(np.int64, AsIs)
+    register_adapter(np.float64, AsIs)
+    if args.sqlite:
+        conn = sqlite_backend.connect(args.sqlite)
+        cur = conn.cursor()
+    else:
+        conn = psycopg2.connect(args.dsn)
+        cur = conn.cursor()
+    if args.stage is None:
+        if args.sqlite:
+            sqlite_backend.drop_tables(cur, conn)
+            sqlite_backend.create_tables(cur, conn)
+        else:
+            drop_tables(cur, conn)
+            create_tables(cur, conn)
+
+    song_data = os.path.join(args.data, "song_data")
+    log_data = os.path.join(args.data, "log_data")
+
+    def load_songs(conn, cur):
+        if args.bulk_songs:
+            etl.process_song_files_bulk(cur, conn, song_data)
+        elif args.sqlite:
+            etl.process_data(cur, conn, song_data, etl.process_song_file,
+                             workers=args.workers,
+                             commit_policy=CommitPolicy(files=None),
+                             sink=SQLiteSink(cur))
+        else:
+            etl.process_data(cur, conn, song_data, etl.process_song_file,
+                             workers=args.workers)
+
+    def load_logs(conn, cur):
+        if args.stage_songplays:
+            etl.process_log_files_staged(cur, conn, log_data)
+        elif args.sqlite:
+            etl.process_data(cur, conn, log_data, etl.process_log_file,
+                             workers=args.workers,
+                             commit_policy=CommitPolicy(files=None),
+                             song_index=sqlite_backend.load_song_index(cur),
+                             time_dimension=sqlite_backend.load_time_dimension(cur),
+                             sink=SQLiteSink(cur))
+        else:
+            etl.process_data(cur, conn, log_data, etl.process_log_file,
+                             workers=args.workers,
+                             song_index=load_song_index(cur),
+                             time_dimension=TimeDimension.from_database(cur))
+
+    def copy_frame(conn, cur):
+        n = args.copy_rows
+        df = pd.DataFrame({
+            "songplay_id": np.arange(n),
+            "start_time": 1541106106 + np.arange(n),
+            "user_id": (np.arange(n) % 100).astype(str),
+            "level": np.where(np.arange(n) % 3, "free", "paid"),
+            "song_id": None,
+            "artist_id": None,
+            "session_id": np.arange(n) % 1000,
+            "location": "Phoenix-Mesa-Scottsdale, AZ",
+            "user_agent": "Mozilla/5.0 (Windows NT 6.1; WOW64)",
+        })
+        etl.cd(cur, df, "cd_bench")
+
+    stages = [
+        ("songs", ["songs", "artists"], load_songs),
+        ("logs", ["songplays", "users", "time"], load_logs),
+    ]
+    if not args.sqlite:
+        # cd() COPYs, which SQLite has no counterpart of
+        stages.append(("cd", ["cd_bench"], copy_frame))
+    run = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "data": os.path.abspath(args.data),
+        "bulk_songs": args.bulk_songs,
+        "stage_songplays": args.stage_songplays,
+        "workers": args.workers,
+        "sqlite": bool(args.sqlite),
+    }
+    if args.stage is not None:
+        name, tables, fn = next(stage for stage in stages
+                                if stage[0] == args.stage)
+        if name == "cd":
+            cur.execute("CREATE TEMP TABLE cd_bench (LIKE songplays);")
+        print(json.dumps(run_stage(name, conn, cur, tables, fn)))
+        conn.close()
+        return
+
+    conn.close()
+    results = []
+    for name, tables, fn in stages:
+        result = dict(run, **run_stage_process(argv, name))
+        results.append(result)
+        print("{stage:<6} {rows:>10} rows {seconds:>9.2f}s {rows_per_sec:>12} "
+              "rows/s {round_trips:>9} round trips {peak_rss_mb:>8} MB".format(
+                  **result))
+
+    if args.output:
+        with open(args.output, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
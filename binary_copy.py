@@ -0,0 +1,207 @@
+import io
+import struct
+import numpy as np
+import pandas as pd
+from itertools import chain, repeat
+from sql_queries import column_types_select
+import metrics
+
+
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+NULL_CELL = struct.pack(">i", -1)
+
+# microseconds between the unix epoch and the postgres epoch (2000-01-01)
+POSTGRES_EPOCH_US = 946684800000000
+
+FIXED_WIDTH_TYPES = {
+    "smallint": ">i2",
+    "integer": ">i4",
+    "bigint": ">i8",
+    "real": ">f4",
+    "double precision": ">f8",
+    "boolean": "?",
+}
+TEXT_TYPES = ("text", "character varying", "character", "name")
+TIMESTAMP_TYPES = ("timestamp without time zone", "timestamp with time zone")
+
+
+def get_column_types(cur, table_name):
+    """
+    This procedure returns a dict of column name -> postgres type name
+    (as printed by format_type) for a table, temporary tables included.
+
+    INPUTS:
+    * cur the cursor variable
+    * table_name the table to describe
+    """
+    cur.execute(column_types_select, (table_name,))
+    return dict(cur.fetchall())
+
+
+def _null_mask(values):
+    return np.asarray(pd.isna(values), dtype=bool)
+
+
+def _split_cells(rec, mask):
+    """
+    This procedure cuts an array of fixed-width (length, value) records
+    into one bytes object per cell and puts NULL cells where mask is set.
+    """
+    raw = rec.tobytes()
+    step = rec.dtype.itemsize
+    cells = [raw[i:i + step] for i in range(0, len(raw), step)]
+    for i in np.flatnonzero(mask):
+        cells[i] = NULL_CELL
+    return cells
+
+
+def _encode_fixed(values, dtype):
+    mask = _null_mask(values)
+    if mask.any():
+        values = np.where(mask, 0, values)
+    rec = np.empty(len(values), dtype=[("length", ">i4"), ("value", dtype)])
+    rec["length"] = np.dtype(dtype).itemsize
+    rec["value"] = values
+    return _split_cells(rec, mask)
+
+
+def _encode_timestamp(values):
+    stamps = pd.to_datetime(pd.Series(values))
+    if stamps.dt.tz is not None:
+        stamps = stamps.dt.tz_convert("UTC").dt.tz_localize(None)
+    mask = stamps.isna().values
+    micros = stamps.values.astype("datetime64[us]").astype(np.int64)
+    rec = np.empty(len(micros), dtype=[("length", ">i4"), ("value", ">i8")])
+    rec["length"] = 8
+    rec["value"] = micros - POSTGRES_EPOCH_US
+    return _split_cells(rec, mask)
+
+
+def _encode_text(values):
+    cells = []
+    for value in values:
+        if value is None or value is pd.NA or (
+                isinstance(value, float) and value != value):
+            cells.append(NULL_CELL)
+            continue
+        data = (value if isinstance(value, str) else str(value)).encode("utf-8")
+        cells.append(struct.pack(">i", len(data)) + data)
+    return cells
+
+
+def encode_column(values, pg_type):
+    """
+    This procedure encodes one column as a list of binary COPY cells
+    (length-prefixed values, or -1 for NULL).
+    None, NaN and NaT are sent as NULL; empty strings stay empty strings.
+
+    INPUTS:
+    * values array-like with the column values
+    * pg_type postgres type name of the target column, without type 
+      modifier as returned by get_column_types
+    """
+    if pg_type in FIXED_WIDTH_TYPES:
+        return _encode_fixed(values, FIXED_WIDTH_TYPES[pg_type])
+    if pg_type in TIMESTAMP_TYPES:
+        return _encode_timestamp(values)
+    if pg_type in TEXT_TYPES:
+        return _encode_text(values)
+    raise ValueError("binary COPY of {} columns is not supported".format(pg_type))
+
+
+def encode_rows(arrays, pg_types, start, stop):
+    """
+    This procedure encodes rows start:stop of the given columns as a block
+    of binary COPY tuples.
+
+    INPUTS:
+    * arrays the column arrays, in target column order
+    * pg_types the postgres type of each column
+    * start, stop the row range to encode
+    """
+    cells = [encode_column(values[start:stop], pg_type)
+             for values, pg_type in zip(arrays, pg_types)]
+    field_count = struct.pack(">h", len(arrays))
+    return b"".join(chain.from_iterable(
+        zip(repeat(field_count, stop - start), *cells)))
+
+
+class BinaryCopyStream(io.RawIOBase):
+    """
+    File-like object that reads from an iterator of byte blocks, so
+    copy_expert can pull the COPY data in fixed-size chunks while it is
+    being encoded.
+    """
+
+    def __init__(self, blocks):
+        self._blocks = iter(blocks)
+        self._buffer = bytearray()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            self._buffer += block
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def copy_columns(cur, table_name, columns, rows_per_chunk=10000,
+                 chunk_size=1 << 20):
+    """
+    This procedure copies columnar data to a postgres table with
+    COPY ... FROM STDIN WITH (FORMAT binary).
+    Rows are encoded rows_per_chunk at a time straight from the column
+    arrays and streamed to the server in chunk_size byte reads, so neither
+    a text rendering nor a full copy of the table is ever held in memory.
+
+    INPUTS:
+    * cur the cursor variable
+    * table_name table into which the data needs to be copied
+    * columns a dict of column name -> array-like, all of the same length
+    * rows_per_chunk number of rows encoded at a time
+    * chunk_size number of bytes handed to the server per read
+    """
+    names = list(columns)
+    arrays = [columns[name] for name in names]
+    arrays = [values.values if isinstance(values, pd.Series) else
+              np.asarray(values, dtype=object) if isinstance(values, list) else
+              values for values in arrays]
+    column_types = get_column_types(cur, table_name)
+    pg_types = [column_types[name] for name in names]
+    num_rows = len(arrays[0]) if arrays else 0
+
+    def blocks():
+        yield COPY_HEADER
+        for start in range(0, num_rows, rows_per_chunk):
+            stop = min(start + rows_per_chunk, num_rows)
+            yield encode_rows(arrays, pg_types, start, stop)
+        yield COPY_TRAILER
+
+    with metrics.timer(metrics.COPY, table_name, num_rows):
+        cur.copy_expert(
+            "COPY {} ({}) FROM STDIN WITH (FORMAT binary)".format(
+                table_name, ", ".join(names)),
+            BinaryCopyStream(blocks()), size=chunk_size)
+
+
+def copy_dataframe_binary(cur, df, table_name, **kwargs):
+    """
+    This procedure copies a dataframe to the postgres table of the same
+    column names with copy_columns.
+
+    INPUTS:
+    * cur the cursor variable
+    * df is the dataframe that needs to be copied
+    * table_name - table into which the dataframe needs to be copied
+    """
+    copy_columns(cur, table_name, {column: df[column] for column in df.columns},
+                 **kwargs)
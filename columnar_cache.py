@@ -0,0 +1,255 @@
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import json_reader
+import file_catalog
+from json_reader import LOG_FIELDS, SONG_FIELDS, SUFFIXES
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+# source kinds and the fields cached for them
+SONGS = "songs"
+LOGS = "logs"
+CACHE_FIELDS = {SONGS: SONG_FIELDS, LOGS: LOG_FIELDS}
+
+# bumped when the cached layout changes, so old partitions are rebuilt
+CACHE_VERSION = 1
+
+# a partition holds the files under one directory this many levels below
+# the source root, e.g. song_data/A/B or log_data/2018/11
+PARTITION_DEPTH = 2
+
+# line numbers of the log events, the index of read_log_frame
+LINE_COLUMN = "_line"
+
+
+def _arrow_type(dtype):
+    return pa.string() if dtype is object else pa.from_numpy_dtype(dtype)
+
+
+def partition_of(root, filepath):
+    """
+    This procedure returns the partition of a source file: the path,
+    relative to the source root, of its directory cut to PARTITION_DEPTH
+    levels.
+
+    INPUTS:
+    * root the source root directory
+    * filepath the source file
+    """
+    parts = os.path.relpath(os.path.dirname(filepath), root).split(os.sep)
+    parts = [part for part in parts if part not in ("", ".")]
+    return os.path.join(*parts[:PARTITION_DEPTH]) if parts else "."
+
+
+def fingerprint(kind, root, files):
+    """
+    This procedure returns the fingerprint of a partition: a digest of the
+    cache version, the source kind and the relative path, size and mtime
+    of every source file, so any added, removed or changed file gives a
+    new fingerprint.
+
+    INPUTS:
+    * kind SONGS or LOGS
+    * root the source root directory
+    * files the source files of the partition
+    """
+    digest = hashlib.sha256("{}:{}".format(CACHE_VERSION, kind).encode())
+    for path in sorted(files):
+        stat = os.stat(path)
+        digest.update("\n{}\t{}\t{}".format(
+            os.path.relpath(path, root), stat.st_size,
+            stat.st_mtime_ns).encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+def _partition_files(root, partition):
+    """
+    This procedure returns the source files of a partition, found as
+    etl.get_files finds them (file_catalog.scan), in sorted order.
+
+    INPUTS:
+    * root the absolute source root directory
+    * partition the partition directory, relative to root
+    """
+    directory = os.path.normpath(os.path.join(root, partition))
+    files = file_catalog.scan(directory, SUFFIXES)
+    if partition == "." or len(partition.split(os.sep)) < PARTITION_DEPTH:
+        # files above the partition depth, without the deeper partitions
+        return [path for path in files if os.path.dirname(path) == directory]
+    return files
+
+
+def build_partition(kind, root, files, path):
+    """
+    This procedure parses the source files of a partition and writes their
+    records to one Arrow IPC file, typed as the json readers type them, in
+    file order. The file name, first row and row count of every source
+    file are kept in the schema metadata.
+    It does not touch the database, so it can run in a worker process.
+
+    INPUTS:
+    * kind SONGS or LOGS
+    * root the source root directory
+    * files the source files of the partition, in order
+    * path the partition file to write
+    """
+    fields = CACHE_FIELDS[kind]
+    columns = {name: [] for name in fields}
+    lines = []
+    offsets = []
+    rows = 0
+    for filepath in files:
+        if kind == LOGS:
+            file_lines, records = json_reader.read_log_events(filepath)
+            lines.append(file_lines)
+        else:
+            records = json_reader.read_song_records(filepath)
+        count = len(next(iter(records.values())))
+        for name in fields:
+            columns[name].append(records[name])
+        offsets.append((os.path.relpath(filepath, root), rows, count))
+        rows += count
+
+    arrays = [pa.array(np.concatenate(columns[name]) if files
+                       else np.array([], dtype=dtype), type=_arrow_type(dtype))
+              for name, dtype in fields.items()]
+    names = list(fields)
+    if kind == LOGS:
+        arrays.append(pa.array(np.concatenate(lines) if files
+                               else np.array([], dtype=np.int64)))
+        names.append(LINE_COLUMN)
+    table = pa.Table.from_arrays(arrays, names=names).replace_schema_metadata(
+        {"files": json.dumps(offsets)})
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with pa.OSFile(tmp, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, path)
+    return path
+
+
+def _build_partition(job):
+    return build_partition(*job)
+
+
+class ColumnarCache:
+    """
+    Columnar copy of the raw json trees: one Arrow IPC file per partition
+    of a source tree, named by the fingerprint of its source files, so a
+    partition is only parsed again when one of its files changes.
+    Partitions are read memory-mapped, one at a time, and the records of a
+    source file are a zero-copy slice of its partition.
+    """
+
+    def __init__(self, cache_dir):
+        if pa is None:
+            raise ImportError("the columnar cache needs pyarrow")
+        self.cache_dir = cache_dir
+        # source file -> (partition file, first row, row count)
+        self._files = {}
+        self._path = None
+        self._table = None
+
+    def _partition_path(self, kind, root, partition, digest):
+        root_digest = hashlib.sha256(
+            os.path.abspath(root).encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.cache_dir, "{}-{}".format(kind, root_digest),
+                            partition, "part-{}.arrow".format(digest))
+
+    def update(self, root, files, kind, workers=1):
+        """
+        This procedure makes sure the partitions holding files are cached
+        and current, parsing the partitions that are missing or whose
+        fingerprint changed (in up to workers processes), and removes the
+        files of their previous fingerprints.
+        Returns the number of partitions built.
+
+        INPUTS:
+        * root the source root directory
+        * files the source files to be read from the cache
+        * kind SONGS or LOGS
+        * workers number of worker processes building partitions
+        """
+        root = os.path.abspath(root)
+        partitions = dict.fromkeys(partition_of(root, os.path.abspath(path))
+                                   for path in files)
+        jobs = []
+        for partition in partitions:
+            sources = _partition_files(root, partition)
+            path = self._partition_path(kind, root, partition,
+                                        fingerprint(kind, root, sources))
+            if not os.path.exists(path):
+                jobs.append((kind, root, sources, path))
+            else:
+                self._register(root, path)
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                built = list(executor.map(_build_partition, jobs))
+        else:
+            built = [_build_partition(job) for job in jobs]
+        for path in built:
+            for stale in glob.glob(os.path.join(os.path.dirname(path),
+                                                "part-*.arrow")):
+                if stale != path:
+                    os.remove(stale)
+            self._register(root, path)
+        return len(built)
+
+    def _register(self, root, path):
+        with pa.memory_map(path, "r") as source:
+            schema = pa.ipc.open_file(source).schema
+        for name, start, count in json.loads(schema.metadata[b"files"]):
+            self._files[os.path.join(root, name)] = (path, start, count)
+
+    def __contains__(self, filepath):
+        return os.path.abspath(filepath) in self._files
+
+    def _slice(self, filepath):
+        path, start, count = self._files[os.path.abspath(filepath)]
+        if path != self._path:
+            self._table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+            self._path = path
+        return self._table.slice(start, count)
+
+    def _columns(self, table, fields):
+        return {name: np.asarray(
+                    table.column(name).to_numpy(zero_copy_only=False),
+                    dtype=dtype)
+                for name, dtype in fields.items()}
+
+    def read_song_records(self, filepath):
+        """
+        This procedure returns the records of a cached song file as typed
+        column arrays, like json_reader.read_song_records.
+
+        INPUTS:
+        * filepath the file path to the song file
+        """
+        if filepath not in self:
+            return json_reader.read_song_records(filepath)
+        return self._columns(self._slice(filepath), SONG_FIELDS)
+
+    def read_log_frame(self, filepath):
+        """
+        This procedure returns the NextSong events of a cached log file as
+        a dataframe indexed by line number, like json_reader.read_log_frame.
+
+        INPUTS:
+        * filepath the file path to the log file
+        """
+        if filepath not in self:
+            return json_reader.read_log_frame(filepath)
+        table = self._slice(filepath)
+        return pd.DataFrame(self._columns(table, LOG_FIELDS),
+                            index=table.column(LINE_COLUMN).to_numpy())
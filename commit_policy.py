@@ -0,0 +1,41 @@
+import time
+
+
+class CommitPolicy:
+    """
+    When process_data commits: after every `files` files, once `rows` rows
+    are pending or once the open transaction is `seconds` old, whichever
+    comes first. A limit of None is not checked; the default commits after
+    every file. A group that fails is rolled back and written again up to
+    `retries` times.
+    """
+
+    def __init__(self, files=1, rows=None, seconds=None, retries=0):
+        self.files = files
+        self.rows = rows
+        self.seconds = seconds
+        self.retries = retries
+        self.reset()
+
+    def reset(self):
+        """
+        This procedure starts a new commit group.
+        """
+        self.pending_files = 0
+        self.pending_rows = 0
+        self.started = time.monotonic()
+
+    def add(self, rows):
+        """
+        This procedure counts one more written file of rows rows and
+        returns whether the group is due for a commit.
+
+        INPUTS:
+        * rows number of rows the file loaded
+        """
+        self.pending_files += 1
+        self.pending_rows += rows or 0
+        return ((self.files is not None and self.pending_files >= self.files)
+                or (self.rows is not None and self.pending_rows >= self.rows)
+                or (self.seconds is not None
+                    and time.monotonic() - self.started >= self.seconds))
@@ -1,5 +1,10 @@
+import argparse
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from concurrent.futures import ThreadPoolExecutor
+from sql_queries import create_table_queries, drop_table_queries, \
+    create_index_queries, create_index_queries_typed, drop_index_queries, \
+    analyze_queries, songplay_table_create, songplay_table_create_partitioned, \
+    songplay_table_create_typed_partitioned, typed_tables
 
 
 def create_database():
@@ -28,17 +33,75 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, partitioned=False, typed=False):
+    replacements = {}
+    if typed:
+        replacements = {create: create_typed
+                        for table, create, create_typed, migrate in typed_tables}
+    if partitioned:
+        replacements[songplay_table_create] = \
+            songplay_table_create_typed_partitioned if typed \
+            else songplay_table_create_partitioned
     for query in create_table_queries:
+        query = replacements.get(query, query)
         cur.execute(query)
         conn.commit()
 
 
-def main():
+def create_indexes(cur, conn, typed=False):
+    for query in (create_index_queries_typed if typed else create_index_queries):
+        cur.execute(query)
+        conn.commit()
+
+
+def drop_indexes(cur, conn):
+    """
+    Drops the secondary indexes of the index catalog, so a bulk load does
+    not maintain them row by row. Rebuild them with build_indexes.
+    """
+    for query in drop_index_queries:
+        cur.execute(query)
+        conn.commit()
+
+
+def _execute_autocommit(dsn, query):
+    conn = psycopg2.connect(dsn)
+    conn.set_session(autocommit=True)
+    try:
+        conn.cursor().execute(query)
+    finally:
+        conn.close()
+
+
+def build_indexes(dsn, workers=1, typed=False):
+    """
+    (Re)builds the secondary indexes of the index catalog after a bulk 
+    load, with up to workers indexes built at the same time over separate
+    connections, then ANALYZEs the indexed tables so the planner sees the
+    new data. typed selects the index catalog of the typed layout.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(lambda query: _execute_autocommit(dsn, query),
+                          create_index_queries_typed if typed
+                          else create_index_queries))
+        list(executor.map(lambda query: _execute_autocommit(dsn, query),
+                          analyze_queries))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create the sparkify schema.")
+    parser.add_argument("--partition-songplays", action="store_true",
+                        help="partition songplays by month of start_time")
+    parser.add_argument("--typed-schema", action="store_true",
+                        help="create the star tables with the typed layout")
+    args = parser.parse_args(argv)
+
     cur, conn = create_database() #creating database
     
     drop_tables(cur, conn)        #drop tables
-    create_tables(cur, conn)      #create tables
+    create_tables(cur, conn, partitioned=args.partition_songplays,
+                  typed=args.typed_schema) #create tables
+    create_indexes(cur, conn, typed=args.typed_schema) #create secondary indexes
 
     conn.close()
 
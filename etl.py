@@ -1,38 +1,144 @@
-import os
-import glob
+import time
+import argparse
+import functools
 import psycopg2
 import numpy as np
-import pandas as pd
 from sql_queries import *
 from psycopg2.extensions import register_adapter, AsIs
-from io import StringIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from song_index import load_song_index, build_song_index, resolve_songs, \
+    update_song_match, match_keys, DURATION_TOLERANCE
+from binary_copy import copy_columns, copy_dataframe_binary
+from manifest import select_changed_files, record_file, advance_watermarks
+from json_reader import read_log_frame, iter_log_frames, read_song_records, \
+    SUFFIXES
+from time_dimension import TimeDimension
+import metrics
+import file_catalog
+from create_tables import drop_indexes, build_indexes
+from partitions import SongplayPartitions
+from rollups import update_rollups
+from typed_schema import is_typed_schema, songplay_start_time
+from commit_policy import CommitPolicy
+from columnar_cache import ColumnarCache, SONGS, LOGS
+from sinks import PostgresSink, SQLiteSink, NullConnection, make_sink, \
+    table_columns, SINKS, DATABASE_SINKS, POSTGRES
+import sqlite_backend
+
+
+SONG_STAGING_COLUMNS = ["seq", "song_id", "title", "artist_id", "year",
+                        "duration", "artist_name", "artist_location",
+                        "artist_latitude", "artist_longitude"]
 
 
 def cd(cur, df, table_name, sep=',', null=False):
     """
     This procedure accepts a dataframe that needs to be copied to a 
     postgres table.
-    It first saves the dataframe as a csv to the buffer and then the 
-    table is copied to the 
-    postgres table. 
+    The dataframe columns are encoded straight into postgres' binary COPY 
+    format and streamed to the table in fixed-size chunks. None/NaN values
+    are loaded as NULL and strings are loaded as they are.
     
     INPUTS: 
     * cur the cursor variable
-    * df is the dataframe that needs to be converted to a csv 
-    * table_name - table into which the csv needs to be copied 
-    * sep = comma separated
-    """
-    sio = StringIO()
-    sio.write(df.to_csv(sep=sep, index=None, header=None))
-    # Write the Pandas DataFrame as a csv to the buffer
-    sio.seek(0)
-    if null:
-        cur.copy_from(sio, table_name, columns=df.columns, sep=sep, null="")
-    else:
-        cur.copy_from(sio, table_name, columns=df.columns, sep=sep)
+    * df is the dataframe that needs to be copied
+    * table_name - table into which the dataframe needs to be copied 
+    * sep, null - kept for compatibility with the former CSV path, unused
+    """
+    copy_dataframe_binary(cur, df, table_name)
+
+
+def list_files(cur, filepath, incremental=False, reload_changed=True):
+    """
+    This procedure returns the json files under filepath that need to be 
+    processed, as (path, manifest entry) pairs.
+    With incremental set only new or changed files are returned, each with
+    the entry to record in the manifest once it is loaded; otherwise every
+    file is returned with no entry.
+
+    INPUTS: 
+    * cur the cursor variable
+    * filepath the directory to search
+    * incremental skip files already recorded in the manifest
+    * reload_changed with incremental, load changed files again; otherwise
+      a changed file raises a ValueError (see select_changed_files). 
+      Songplays are appended, so log files must not be reloaded
+    """
+    all_files = get_files(filepath)
+    if not incremental:
+        return [(f, None) for f in all_files]
+    return [(entry[0], entry) for entry in
+            select_changed_files(cur, all_files, reload_changed)]
 
 
-def process_song_file(cur, filepath):
+def get_files(filepath):
+    """
+    This procedure returns the absolute paths of all json files under 
+    filepath, plain or compressed (json_reader.SUFFIXES), in sorted order,
+    see file_catalog.scan.
+
+    INPUTS: 
+    * filepath the directory to search
+    """
+    return file_catalog.scan(filepath, SUFFIXES)
+
+
+def transform_song_file(filepath, cache=None):
+    """
+    This procedure reads a song file and returns its song and artist 
+    records, ready to be written by write_song_batch.
+    It does not touch the database, so it can run in a worker process.
+
+    INPUTS: 
+    * filepath the file path to the song file
+    * cache a ColumnarCache to read the file from instead of its json
+    """
+    # open song file
+    with metrics.timer(metrics.PARSE):
+        if cache is not None:
+            records = cache.read_song_records(filepath)
+        else:
+            records = read_song_records(filepath)
+
+    with metrics.timer(metrics.TRANSFORM):
+        # song records
+        song_data = [list(row) for row in zip(
+            *[records[column] for column in
+              ["song_id", "title", "artist_id", "year", "duration"]])]
+
+        # artist records
+        artist_data = [
+            [None if isinstance(el, float) and np.isnan(el) else el
+             for el in row]
+            for row in zip(*[records[column] for column in
+                             ["artist_id", "artist_name", "artist_location",
+                              "artist_latitude", "artist_longitude"]])
+        ]
+    return {"songs": song_data, "artists": artist_data}
+
+
+def write_song_batch(cur, batch, sink=None):
+    """
+    This procedure inserts the records returned by transform_song_file 
+    into the songs and artists tables.
+
+    INPUTS: 
+    * cur the cursor variable
+    * batch the dict returned by transform_song_file
+    * sink a sinks.Sink to write the records to; by default one INSERT 
+      per row through cur
+
+    Returns the number of rows written.
+    """
+    if sink is None:
+        sink = PostgresSink(cur)
+    sink.write("songs", table_columns("songs", batch["songs"]))
+    sink.write("artists", table_columns("artists", batch["artists"]))
+    return len(batch["songs"]) + len(batch["artists"])
+
+
+def process_song_file(cur, filepath, sink=None):
     """
     This procedure processes a song file whose filepath has been provided 
     as an arugment.
@@ -44,38 +150,127 @@ def process_song_file(cur, filepath):
     INPUTS: 
     * cur the cursor variable
     * filepath the file path to the song file
+    * sink a sinks.Sink to write the records to
     """
-    # open song file
-    df = pd.read_json(filepath, lines=True)
-    # insert song record
-    song_data = list(
-        df.loc[0, ["song_id", "title", "artist_id", "year", 
-                   
-                   "duration"]].values
-    )
-    cur.execute(song_table_insert, song_data)
-
-    # insert artist record
-    artist_data = list(
-        df.loc[
-            0,
-            [
-                "artist_id",
-                "artist_name",
-                "artist_location",
-                "artist_latitude",
-                "artist_longitude",
-            ],
-        ].values
-    )
-    artist_data = [
-        None if isinstance(el, np.float64) and np.isnan(el) else el
-        for el in artist_data
-    ]
-    cur.execute(artist_table_insert, artist_data)
-
-
-def process_log_file(cur, filepath):
+    return write_song_batch(cur, transform_song_file(filepath), sink)
+
+
+def transform_user_records(df):
+    """
+    This procedure builds the user dataframe of a dataframe of NextSong 
+    events.
+
+    INPUTS: 
+    * df the filtered log dataframe
+    """
+    user_df = df[["userId", "firstName", "lastName", "gender", "level"]]
+    user_df_columns = {"userId": "user_id", "firstName": "first_name",
+                       "lastName": "last_name"}
+    return user_df.rename(columns=user_df_columns)
+
+
+def insert_user_records(cur, user_df, sink=None):
+    """
+    This procedure inserts the user records built by 
+    transform_user_records.
+
+    INPUTS: 
+    * cur the cursor variable
+    * user_df the user records
+    * sink a sinks.Sink to write the records to; by default one INSERT 
+      per row through cur
+    """
+    if sink is None:
+        sink = PostgresSink(cur)
+    sink.write("users", {column: user_df[column] for column in user_df.columns})
+
+#     cd(cur, user_df, "users")
+
+
+def transform_log_file(filepath, cache=None):
+    """
+    This procedure reads a log file and returns its NextSong events with 
+    the user records derived from them, ready to be written by 
+    write_log_batch.
+    It does not touch the database, so it can run in a worker process.
+
+    INPUTS: 
+    * filepath the file path to the log file
+    * cache a ColumnarCache to read the file from instead of its json
+    """
+    # read the NextSong events of the log file
+    with metrics.timer(metrics.PARSE):
+        if cache is not None:
+            df = cache.read_log_frame(filepath)
+        else:
+            df = read_log_frame(filepath)
+
+    with metrics.timer(metrics.TRANSFORM):
+        user_df = transform_user_records(df)
+    return {"users": user_df, "events": df}
+
+
+def write_log_batch(cur, batch, song_index=None, time_dimension=None,
+                    partitions=None, typed=False, sink=None):
+    """
+    This procedure writes the records returned by transform_log_file into
+    the time, users and songplays tables.
+
+    INPUTS: 
+    * cur the cursor variable
+    * batch the dict returned by transform_log_file
+    * song_index the song lookup index from song_index.load_song_index;
+      loaded from the database when not provided
+    * time_dimension the run-wide TimeDimension; loaded from the database
+      when not provided
+    * partitions the SongplayPartitions of a partitioned songplays table;
+      the songplays are then COPYed straight into their monthly partitions
+    * typed whether the tables use the typed layout (typed_schema.py)
+    * sink a sinks.Sink to write the records to; by default the time rows
+      are COPYed and the other rows inserted one by one through cur
+
+    Returns the number of rows written.
+    """
+    if sink is None:
+        sink = PostgresSink(cur)
+    # load the time rows of timestamps not seen before in this run
+    if time_dimension is None:
+        time_dimension = TimeDimension.from_database(cur)
+    num_time_rows = time_dimension.add(cur, batch["events"]["ts"].values, sink)
+
+    insert_user_records(cur, batch["users"], sink)
+
+    # get song_id and artist_id for all events in one in-memory lookup
+    df = batch["events"]
+    if song_index is None:
+        song_index = load_song_index(cur, typed)
+    with metrics.timer(metrics.LOOKUP, "songplays", len(df)):
+        df = resolve_songs(df, song_index)
+        df = df[df["song_id"].notna() & df["artist_id"].notna()]
+    start_times = songplay_start_time(df["ts"].values, typed)
+    # the typed songplays reference songs and artists by surrogate key
+    song, artist = ("song_key", "artist_key") if typed else ("song_id", "artist_id")
+
+    songplays = {
+        "start_time": start_times,
+        "user_id": df["userId"].values,
+        "level": df["level"].values,
+        song: df[song].values,
+        artist: df[artist].values,
+        "session_id": df["sessionId"].values,
+        "location": df["location"].values,
+        "user_agent": df["userAgent"].values,
+    }
+    if partitions is not None:
+        partitions.copy(cur, songplays)
+        sink.record("songplays", len(df))
+    else:
+        sink.write("songplays", songplays)
+    return num_time_rows + len(batch["users"]) + len(df)
+
+
+def process_log_file(cur, filepath, song_index=None, time_dimension=None,
+                     partitions=None, typed=False, sink=None):
     """
     This procedure processes a log file whose filepath has been provided as an arugment.
     It extracts and transforms the log information in order to store it into the time, user 
@@ -85,103 +280,743 @@ def process_log_file(cur, filepath):
     INPUTS: 
     * cur the cursor variable
     * filepath the file path to the song file
+    * song_index the song lookup index from song_index.load_song_index;
+      loaded from the database when not provided
+    * time_dimension the run-wide TimeDimension; loaded from the database
+      when not provided
+    * partitions the SongplayPartitions of a partitioned songplays table
+    * typed whether the tables use the typed layout (typed_schema.py)
+    * sink a sinks.Sink to write the records to
     """
-    # open log file
-    df = pd.read_json(filepath, lines=True)
+    return write_log_batch(cur, transform_log_file(filepath),
+                           song_index=song_index,
+                           time_dimension=time_dimension,
+                           partitions=partitions, typed=typed, sink=sink)
 
-    # filter by NextSong action
-    df = df[df["page"] == "NextSong"]
 
-    # convert timestamp column to datetime
-    ts = df["ts"]
-    tsdt = pd.to_datetime(df["ts"],unit='ms')
+def process_log_file_streamed(cur, filepath, chunk_bytes=64 << 20,
+                              song_index=None, time_dimension=None,
+                              partitions=None, typed=False, sink=None):
+    """
+    This procedure processes a log file like process_log_file, but one 
+    chunk of events at a time from parse through transform to the 
+    database, so memory stays bounded by chunk_bytes however large the 
+    file is. The time dimension and the song index are shared by all 
+    chunks and rows are written in file order, so the tables end up the 
+    same as with whole-file processing.
 
-    # insert time data records
-    time_data = (tsdt.values, tsdt.dt.hour, tsdt.dt.day, tsdt.dt.week,
-                 tsdt.dt.month, tsdt.dt.year, tsdt.dt.weekday)
-    column_labels = ("start_time", "hour", "day",
-                     "week", "month", "year", "weekday")
-    combined_dict = dict(zip(column_labels, time_data))
-    time_df = pd.DataFrame(combined_dict)
-    
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+    INPUTS: 
+    * cur the cursor variable
+    * filepath the file path to the log file
+    * chunk_bytes size of the NextSong event lines processed per chunk
+    * song_index the song lookup index from song_index.load_song_index;
+      loaded from the database when not provided
+    * time_dimension the run-wide TimeDimension; loaded from the database
+      when not provided
+    * partitions the SongplayPartitions of a partitioned songplays table
+    * typed whether the tables use the typed layout (typed_schema.py)
+    * sink a sinks.Sink to write the records to
+    """
+    if song_index is None:
+        song_index = load_song_index(cur, typed)
+    if time_dimension is None:
+        time_dimension = TimeDimension.from_database(cur)
+    rows_loaded = 0
+    chunks = iter_log_frames(filepath, chunk_bytes)
+    while True:
+        with metrics.timer(metrics.PARSE):
+            df = next(chunks, None)
+        if df is None:
+            return rows_loaded
+        with metrics.timer(metrics.TRANSFORM):
+            user_df = transform_user_records(df)
+        rows_loaded += write_log_batch(cur, {"users": user_df, "events": df},
+                                       song_index=song_index,
+                                       time_dimension=time_dimension,
+                                       partitions=partitions, typed=typed,
+                                       sink=sink)
 
-    
 
-    
+def process_log_files_staged(cur, conn, filepath, keep_unmatched=False,
+                             incremental=False, partitions=None,
+                             typed=False, tolerance=DURATION_TOLERANCE,
+                             cache=None):
+    """
+    This procedure loads all log files under filepath and resolves the 
+    songplays inside postgres.
+    User records are inserted per file as in process_log_file, while the 
+    NextSong events are COPYed into the unlogged songplay_staging table. 
+    One INSERT ... SELECT matching the staged events against the 
+    song_match table then fills the songplays table, and the time rows of
+    the union of all event timestamps are COPYed once.
+    Returns the number of staged events, how many matched a song and the
+    number of rows written per table.
 
-    # load user table
-    user_df = df[["userId", "firstName", "lastName", "gender", "level"]]
-    user_df_columns = {"userId": "user_id", "firstName": "first_name",
-                       "lastName": "last_name"}
-    
-    user_df = user_df.rename(columns=user_df_columns)
-  
-    
-    uder_df = user_df.drop_duplicates(subset='user_id')
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+    INPUTS: 
+    * cur the cursor variable
+    * conn the connection variable
+    * filepath the directory holding the log files
+    * keep_unmatched keep events without a matching song with NULL 
+      song_id/artist_id (as etl_copy.py does) instead of skipping them
+    * incremental only load files that are new or changed since the last 
+      run, according to the manifest
+    * partitions the SongplayPartitions of a partitioned songplays table;
+      the partitions of the staged months are created before the INSERT
+    * typed whether the tables use the typed layout (typed_schema.py); the
+      events are then staged with their epoch milliseconds
+    * tolerance seconds an event length may differ from songs.duration
+    * cache a ColumnarCache to read the log files from
+    """
+    all_files = list_files(cur, filepath, incremental, reload_changed=False)
+    num_files = len(all_files)
+    print("{} files found in {}".format(num_files, filepath))
+    if cache is not None:
+        update_cache(cache, filepath, all_files, LOGS)
 
-#     cd(cur, user_df, "users")
+    cur.execute(songplay_staging_truncate)
+    seq = 0
+    num_user_rows = 0
+    num_time_rows = 0
+    timestamps = []
+    for i, (datafile, entry) in enumerate(all_files, 1):
+        with metrics.process_file(datafile):
+            batch = transform_log_file(datafile, cache)
+            insert_user_records(cur, batch["users"])
+            num_user_rows += len(batch["users"])
+            df = batch["events"]
+            timestamps.append(np.unique(df["ts"].values))
+
+            copy_columns(cur, "songplay_staging", {
+                "seq": np.arange(seq, seq + len(df)),
+                "start_time": df["ts"].values if typed else
+                              songplay_start_time(df["ts"].values),
+                "user_id": df["userId"],
+                "level": df["level"],
+                "session_id": df["sessionId"],
+                "location": df["location"],
+                "user_agent": df["userAgent"],
+                "song": df["song"],
+                "artist": df["artist"],
+                "length": df["length"],
+                "title_key": match_keys(df["song"].values),
+                "name_key": match_keys(df["artist"].values),
+            })
+            seq += len(df)
+            if entry is not None:
+                record_file(cur, entry, len(df))
+        if not metrics.is_enabled():
+            print("{}/{} files staged.".format(i, num_files))
 
+    if timestamps:
+        timestamps = np.concatenate(timestamps)
+        num_time_rows = TimeDimension.from_database(cur).add(cur, timestamps)
+        if partitions is not None:
+            partitions.ensure(cur, songplay_start_time(timestamps, typed))
+    update_song_match(cur, typed)
+    with metrics.timer(metrics.INSERT, "songplays"):
+        if keep_unmatched:
+            cur.execute(songplay_staging_insert_all_typed if typed else
+                        songplay_staging_insert_all, {"tolerance": tolerance})
+        else:
+            cur.execute(songplay_staging_insert_matched_typed if typed else
+                        songplay_staging_insert_matched, {"tolerance": tolerance})
+        inserted, matched = cur.fetchone()
+    cur.execute(songplay_staging_truncate)
+    rows = {"users": num_user_rows, "time": num_time_rows,
+            "songplays": inserted}
+    advance_watermarks(cur, loaded_tables(rows))
+    with metrics.timer(metrics.COMMIT):
+        conn.commit()
+    return seq, matched, rows
+
+
+def report_match_rate(events, matched):
+    """
+    This procedure prints how many of the songplay events of the run 
+    matched a song and adds both counts to the metrics.
 
+    INPUTS: 
+    * events number of events looked up
+    * matched number of events that matched a song
+    """
+    metrics.count(metrics.MATCH, "events", events)
+    metrics.count(metrics.MATCH, "songs", matched)
+    if events:
+        print("{}/{} events matched a song ({:.1%}).".format(
+            matched, events, matched / events))
 
-    # insert songplay records
-    for index, row in df.iterrows():
-        # get song_id and artist_id from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, round(row.length)))
-        result = cur.fetchone()
-        (song_id, artist_id) = (result if result else (None, None))
 
-        if song_id is None or artist_id is None:
-            continue
+# transform (worker side) and write (writer side) halves of the file 
+# processors, used by process_data when running with workers > 1
+PARALLEL_STAGES = {
+    process_song_file: (transform_song_file, write_song_batch),
+    process_log_file: (transform_log_file, write_log_batch),
+}
 
-        # insert songplay record
-        songplay_data = (round(row.ts / 1000.0), row.userId, row.level, song_id, \
-                         artist_id, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
+# processors appending songplays, whose files cannot be loaded twice
+SONGPLAY_PROCESSORS = (process_log_file, process_log_file_streamed)
+
+# source kind of the files of each processor that can read them from the
+# columnar cache
+CACHE_KINDS = {
+    process_song_file: SONGS,
+    process_log_file: LOGS,
+}
+
+
+def update_cache(cache, filepath, all_files, kind, workers=1):
+    """
+    This procedure brings the columnar cache partitions of the files to be
+    loaded up to date, see ColumnarCache.update.
+
+    INPUTS: 
+    * cache the ColumnarCache
+    * filepath the directory holding the files
+    * all_files the (path, manifest entry) pairs returned by list_files
+    * kind SONGS or LOGS
+    * workers number of worker processes parsing partitions
+    """
+    with metrics.timer(metrics.PARSE, "columnar_cache"):
+        built = cache.update(filepath, [datafile for datafile, entry in all_files],
+                             kind, workers)
+    if built:
+        print("{} columnar cache partitions built for {}".format(built, filepath))
+
+
+def _ordered_parallel_map(fn, items, workers, window):
+    """
+    This procedure runs fn over items in a pool of worker processes and 
+    yields the results in the order of items, so the output does not 
+    depend on the number of workers.
+    At most window results are in flight, which bounds the memory held by
+    batches the writer has not consumed yet.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
-def process_data(cur, conn, filepath, func):
+def _rollback(conn, states):
+    """
+    This procedure rolls back the open transaction and forgets what the
+    run-wide states (e.g. the TimeDimension) learned in it.
+    """
+    conn.rollback()
+    for state in states:
+        state.rollback()
+
+
+def _commit(cur, conn, sink):
+    """
+    This procedure commits the open transaction of write_files, advancing
+    the load watermarks of the tables the sink wrote rows to in it first,
+    so the rows and the invalidation of the cached analytics results are
+    committed together.
+    """
+    if sink.advances_watermarks:
+        advance_watermarks(cur, sink.pending_tables())
+    with metrics.timer(metrics.COMMIT):
+        conn.commit()
+
+
+def _retry_group(cur, conn, group, load, states, retries, sink):
+    """
+    This procedure writes a rolled back commit group again and commits it,
+    up to retries times, so every file of the group is committed exactly
+    once or the last error is raised.
+    """
+    for attempt in range(1, retries + 1):
+        print("retrying {} files ({}/{})".format(len(group), attempt, retries))
+        try:
+            for item in group:
+                load(*item)
+            _commit(cur, conn, sink)
+        except psycopg2.Error:
+            _rollback(conn, states)
+            if attempt == retries:
+                raise
+        else:
+            return
+
+
+def process_data(cur, conn, filepath, func, workers=1, incremental=False,
+                 commit_policy=None, cache=None, **kwargs):
     """
     This procedure extracts json files from their respective directory and passes
     them to process_song_file and process_log_file functions for further 
     processing.
+    With workers > 1 the files are parsed and transformed by a pool of 
+    worker processes while this process writes the batches to postgres in
+    file order.
+    Files are committed in groups according to the commit policy, see
+    write_files.
     
 
     INPUTS: 
     * cur the cursor variable
     * filepath the file path to the song file
+    * workers number of worker processes parsing files
+    * incremental only process files that are new or changed since the 
+      last run, according to the manifest, and record each loaded file 
+      in the manifest in the same transaction as its data
+    * commit_policy a CommitPolicy; by default every file is committed on
+      its own
+    * cache a ColumnarCache; the files are then read memory-mapped from 
+      their cached partitions, which are built first where missing or 
+      stale, instead of being parsed
+    * kwargs extra keyword arguments passed on to func
+
+    Returns the number of rows committed per table, see write_files.
     """
     # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root, "*.json"))
-        for f in files:
-            all_files.append(os.path.abspath(f))
+    all_files = list_files(cur, filepath, incremental,
+                           reload_changed=func not in SONGPLAY_PROCESSORS)
+    conn.commit()
 
     # get total number of files found
     num_files = len(all_files)
     print("{} files found in {}".format(num_files, filepath))
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    if cache is not None and func in CACHE_KINDS:
+        # reading the cache is cheap, the workers only build partitions
+        update_cache(cache, filepath, all_files, CACHE_KINDS[func], workers)
+        transform = PARALLEL_STAGES[func][0]
+        workers = 1
+    else:
+        cache = None
+    if workers > 1:
+        transform, write = PARALLEL_STAGES[func]
+        batches = _ordered_parallel_map(
+            transform, [datafile for datafile, entry in all_files], workers,
+            window=4 * workers)
+
+    def items():
+        for datafile, entry in all_files:
+            batch = None
+            if cache is not None:
+                batch = transform(datafile, cache)
+            elif workers > 1:
+                # parse/transform ran in a worker; time spent waiting on it
+                with metrics.timer(metrics.WAIT):
+                    batch = next(batches)
+            yield datafile, entry, batch
+
+    return write_files(cur, conn, items(), num_files, func, commit_policy,
+                       **kwargs)
+
+
+def write_files(cur, conn, items, num_files, func, commit_policy=None,
+                **kwargs):
+    """
+    This procedure writes files to postgres in order and commits them in
+    groups according to the commit policy. When a group fails it is rolled
+    back as a whole, together with the manifest entries and the run-wide
+    state of its files, and written again, so no file is lost or loaded
+    twice.
+
+    INPUTS:
+    * cur the cursor variable
+    * conn the connection variable
+    * items iterable of (file path, manifest entry or None, batch or None);
+      a batch made by the transform half of func is written with its 
+      write half, otherwise func processes the file
+    * num_files number of items, for progress and the final commit
+    * func process_song_file or process_log_file
+    * commit_policy a CommitPolicy; by default every file is committed on
+      its own
+    * kwargs extra keyword arguments passed on to func; the rows are 
+      written to the sink given there, by default one INSERT per row, and
+      each commit advances the load watermarks of the tables written to
+
+    Returns the number of rows committed per table, leaving out the 
+    tables no row was written to.
+    """
+    policy = commit_policy or CommitPolicy()
+    if kwargs.get("sink") is None:
+        kwargs["sink"] = PostgresSink(cur)
+    sink = kwargs["sink"]
+    rows_before = dict(sink.rows)
+    # run-wide states that must follow the transaction outcome
+    states = [value for value in kwargs.values() if hasattr(value, "rollback")]
+    for state in states:
+        state.begin()
+    write = PARALLEL_STAGES[func][1] if func in PARALLEL_STAGES else None
+
+    def load(datafile, entry, batch):
+        with metrics.process_file(datafile):
+            if batch is not None:
+                rows_loaded = write(cur, batch, **kwargs)
+            else:
+                rows_loaded = func(cur, datafile, **kwargs)
+            if entry is not None:
+                record_file(cur, entry, rows_loaded)
+        return rows_loaded
+
+    # files written since the last commit, kept to write them again
+    group = []
+    policy.reset()
+    for i, (datafile, entry, batch) in enumerate(items, 1):
+        group.append((datafile, entry, batch))
+        try:
+            due = policy.add(load(datafile, entry, batch))
+            if due or i == num_files:
+                _commit(cur, conn, sink)
+                committed = True
+            else:
+                committed = False
+        except psycopg2.Error:
+            _rollback(conn, states)
+            if not policy.retries:
+                raise
+            _retry_group(cur, conn, group, load, states, policy.retries,
+                         sink)
+            committed = True
+        if committed:
+            for state in states:
+                state.commit()
+            group = []
+            policy.reset()
+        # with metrics enabled every file already gets its own record
+        if not metrics.is_enabled():
+            print("{}/{} files processed.".format(i, num_files))
+    return {table: num_rows - rows_before.get(table, 0)
+            for table, num_rows in sink.rows.items()
+            if num_rows > rows_before.get(table, 0)}
+
+
+def process_song_files_bulk(cur, conn, filepath, batch_size=10000,
+                            incremental=False, cache=None):
+    """
+    This procedure loads all song files under filepath in one transaction.
+    The song json is parsed into columnar batches that are COPYed into a
+    temporary staging table, then the songs and artists tables are filled
+    with one INSERT ... SELECT ... ON CONFLICT DO NOTHING each.
+
+    INPUTS: 
+    * cur the cursor variable
+    * conn the connection variable
+    * filepath the directory holding the song files
+    * batch_size number of staged records per COPY
+    * incremental only load files that are new or changed since the last 
+      run, according to the manifest
+    * cache a ColumnarCache to read the song files from
+
+    Returns the number of rows inserted per table.
+    """
+    all_files = list_files(cur, filepath, incremental)
+    num_files = len(all_files)
+    print("{} files found in {}".format(num_files, filepath))
+    if cache is not None:
+        update_cache(cache, filepath, all_files, SONGS)
+
+    cur.execute(song_staging_create)
+    batch = {column: [] for column in SONG_STAGING_COLUMNS}
+    seq = 0
+    for i, (datafile, entry) in enumerate(all_files, 1):
+        with metrics.process_file(datafile):
+            with metrics.timer(metrics.PARSE):
+                if cache is not None:
+                    records = cache.read_song_records(datafile)
+                else:
+                    records = read_song_records(datafile)
+            num_records = len(records["song_id"])
+            batch["seq"].extend(range(seq, seq + num_records))
+            seq += num_records
+            for column in SONG_STAGING_COLUMNS[1:]:
+                batch[column].extend(records[column])
+            if entry is not None:
+                record_file(cur, entry, num_records)
+
+        if len(batch["seq"]) >= batch_size or i == num_files:
+            copy_columns(cur, "song_staging", batch)
+            batch = {column: [] for column in SONG_STAGING_COLUMNS}
+            print("{}/{} files staged.".format(i, num_files))
+
+    rows = {}
+    with metrics.timer(metrics.INSERT, "songs"):
+        cur.execute(song_table_merge)
+        rows["songs"] = cur.rowcount
+    with metrics.timer(metrics.INSERT, "artists"):
+        cur.execute(artist_table_merge)
+        rows["artists"] = cur.rowcount
+    advance_watermarks(cur, loaded_tables(rows))
+    with metrics.timer(metrics.COMMIT):
         conn.commit()
-        print("{}/{} files processed.".format(i, num_files))
+    return rows
+
+
+def loaded_tables(rows):
+    """
+    This procedure returns the tables that rows were written to, from the
+    rows per table returned by the loaders.
+
+    INPUTS:
+    * rows dict of table -> number of rows
+    """
+    return [table for table, num_rows in rows.items() if num_rows]
 
 
-def main():
-    conn = psycopg2.connect(
-        "host=127.0.0.1 dbname=sparkifydb user=student password=student"
-    )
+def build_parser():
+    """
+    This procedure returns the command line parser of the loader.
+    """
+    parser = argparse.ArgumentParser(description="Load the sparkify tables.")
+    parser.add_argument("--bulk-songs", action="store_true",
+                        help="stage all song files with COPY and merge them "
+                             "in one transaction")
+    parser.add_argument("--stage-songplays", action="store_true",
+                        help="COPY the events into songplay_staging and "
+                             "resolve songplays with one INSERT ... SELECT")
+    parser.add_argument("--keep-unmatched", action="store_true",
+                        help="with --stage-songplays, keep events without a "
+                             "matching song with NULL ids")
+    parser.add_argument("--match-tolerance", type=float,
+                        default=DURATION_TOLERANCE,
+                        help="seconds an event length may differ from the "
+                             "song duration and still match")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes parsing files")
+    parser.add_argument("--stream-mb", type=float,
+                        help="process each log file in chunks of N MB of "
+                             "NextSong json lines, so memory follows the "
+                             "chunk rather than the file size; log files are "
+                             "then read from their json and loaded by this "
+                             "process alone")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only load files that are new or changed since "
+                             "the last run")
+    parser.add_argument("--commit-files", type=int,
+                        help="commit after every N files (default 1, or one "
+                             "transaction per directory with --sqlite)")
+    parser.add_argument("--commit-rows", type=int,
+                        help="also commit once N rows are pending")
+    parser.add_argument("--commit-seconds", type=float,
+                        help="also commit once the transaction is T seconds "
+                             "old")
+    parser.add_argument("--commit-retries", type=int, default=0,
+                        help="write a failed commit group again up to N "
+                             "times before giving up")
+    parser.add_argument("--defer-indexes", action="store_true",
+                        help="drop the secondary indexes before loading and "
+                             "rebuild them (and ANALYZE) afterwards")
+    parser.add_argument("--index-workers", type=int, default=1,
+                        help="with --defer-indexes, number of indexes "
+                             "rebuilt in parallel")
+    parser.add_argument("--columnar-cache", metavar="DIR",
+                        help="convert the json trees into Arrow files under "
+                             "DIR once and read the files from there, "
+                             "memory-mapped, instead of parsing them "
+                             "(needs pyarrow)")
+    parser.add_argument("--file-catalog", metavar="PATH",
+                        help="keep the directory listings in PATH between "
+                             "runs and only list the directories whose mtime "
+                             "changed")
+    parser.add_argument("--sink", choices=SINKS, default=POSTGRES,
+                        help="where the rows go: postgres (row inserts, COPY "
+                             "for time), insert (batched INSERTs), copy "
+                             "(binary COPY with merges), csv or parquet files "
+                             "in --sink-dir, or null (rows only counted, for "
+                             "transform-only timings)")
+    parser.add_argument("--sink-dir", default="sink_out",
+                        help="output directory of the csv and parquet sinks")
+    parser.add_argument("--sqlite", metavar="PATH",
+                        help="load into the SQLite database at PATH instead "
+                             "of postgres, creating the tables if needed")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="write per-stage timings and row counts to PATH")
+    parser.add_argument("--metrics-format", choices=metrics.FORMATS,
+                        default="jsonl",
+                        help="jsonl: one line per file plus run totals; "
+                             "prometheus: run totals in text format")
+    return parser
+
+
+def run(args, process=process_data):
+    """
+    This procedure loads the song and log data as selected by the parsed
+    command line arguments.
+
+    INPUTS:
+    * args the arguments parsed by build_parser
+    * process the file loader, process_data or a drop-in replacement 
+      with the same signature; it is given the columnar cache of 
+      --columnar-cache. With --stream-mb the log files are loaded by 
+      process_data in this process instead, so neither another process 
+      nor the cache can be combined with it.
+    """
+    not_streamed = [flag for flag, value in (
+        ("--columnar-cache", args.columnar_cache),
+        ("--stage-songplays", args.stage_songplays),
+        ("a loader other than etl.process_data", process is not process_data))
+        if value]
+    if args.stream_mb and not_streamed:
+        raise ValueError("--stream-mb cannot be combined with {}".format(
+            ", ".join(not_streamed)))
+
+    if args.metrics:
+        metrics.enable(args.metrics, args.metrics_format)
+    if args.file_catalog:
+        file_catalog.enable(args.file_catalog)
+
+    commit_files = args.commit_files
+    if commit_files is None and not args.sqlite:
+        commit_files = 1
+    commit_policy = CommitPolicy(files=commit_files, rows=args.commit_rows,
+                                 seconds=args.commit_seconds,
+                                 retries=args.commit_retries)
+
+    cache = None
+    if args.columnar_cache:
+        cache = ColumnarCache(args.columnar_cache)
+        process = functools.partial(process, cache=cache)
+
+    if args.sqlite or args.sink not in DATABASE_SINKS:
+        run_without_postgres(args, process, commit_policy)
+        metrics.report()
+        metrics.disable()
+        file_catalog.disable()
+        return
+
+    dsn = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+    conn = psycopg2.connect(dsn)
     cur = conn.cursor()
+    sink = make_sink(args.sink, cur)
+
+    typed = is_typed_schema(cur)
+    # the dropped indexes are rebuilt even when the load fails, so a
+    # failed run does not leave the tables without them
+    try:
+        if args.defer_indexes:
+            drop_indexes(cur, conn)
+
+        if args.bulk_songs:
+            process_song_files_bulk(cur, conn, filepath="data/song_data",
+                                    incremental=args.incremental, cache=cache)
+        else:
+            process(cur, conn, filepath="data/song_data",
+                    func=process_song_file, workers=args.workers,
+                    incremental=args.incremental, commit_policy=commit_policy,
+                    sink=sink)
+        partitions = SongplayPartitions.from_database(cur)
+        if args.stage_songplays:
+            events, matched = process_log_files_staged(
+                cur, conn, filepath="data/log_data",
+                keep_unmatched=args.keep_unmatched,
+                incremental=args.incremental, partitions=partitions, typed=typed,
+                tolerance=args.match_tolerance, cache=cache)[:2]
+        else:
+            song_index = load_song_index(cur, typed, args.match_tolerance)
+            time_dimension = TimeDimension.from_database(cur)
+            if args.stream_mb:
+                process_data(cur, conn, filepath="data/log_data",
+                             func=process_log_file_streamed,
+                             incremental=args.incremental,
+                             commit_policy=commit_policy,
+                             chunk_bytes=int(args.stream_mb * (1 << 20)),
+                             song_index=song_index, time_dimension=time_dimension,
+                             partitions=partitions, typed=typed, sink=sink)
+            else:
+                process(cur, conn, filepath="data/log_data",
+                        func=process_log_file, workers=args.workers,
+                        incremental=args.incremental, commit_policy=commit_policy,
+                        song_index=song_index, time_dimension=time_dimension,
+                        partitions=partitions, typed=typed, sink=sink)
+            events, matched = song_index.events, song_index.matched
+        report_match_rate(events, matched)
+        # the loaders advanced the watermarks of their tables with every
+        # commit; the rollups move with their own
+        advance_watermarks(cur, update_rollups(cur, typed=typed))
+        with metrics.timer(metrics.COMMIT):
+            conn.commit()
+    finally:
+        conn.close()
+        if args.defer_indexes:
+            build_indexes(dsn, workers=args.index_workers, typed=typed)
+    metrics.report()
+    metrics.disable()
+    file_catalog.disable()
 
-    process_data(cur, conn, filepath="data/song_data", func=process_song_file)
-    process_data(cur, conn, filepath="data/log_data", func=process_log_file)
 
+def run_without_postgres(args, process, commit_policy):
+    """
+    This procedure loads the song and log data into a SQLite database 
+    (--sqlite) or into a file or null sink, without postgres. The files 
+    are parsed, transformed and matched as in run; the song index and the
+    time dimension come from the SQLite tables, or from the song files and
+    empty for the sinks. Prints the rows written and the rows per second
+    of the song and log loads; building the song index and reading the
+    time dimension are timed apart, as the song_index lookup stage of the
+    metrics.
+
+    INPUTS:
+    * args the arguments parsed by build_parser
+    * process the file loader, see run
+    * commit_policy the CommitPolicy of the run; the rows of a group are 
+      committed to SQLite, or written out by the sink, together
+    """
+    needs_postgres = [flag for flag, value in (
+        ("--bulk-songs", args.bulk_songs),
+        ("--stage-songplays", args.stage_songplays),
+        ("--incremental", args.incremental),
+        ("--defer-indexes", args.defer_indexes)) if value]
+    if args.sqlite and args.sink != POSTGRES:
+        needs_postgres.append("--sink " + args.sink)
+    if needs_postgres:
+        raise ValueError("{} need postgres".format(", ".join(needs_postgres)))
+
+    if args.sqlite:
+        conn = sqlite_backend.connect(args.sqlite)
+        cur = conn.cursor()
+        sqlite_backend.create_tables(cur, conn)
+        sink = SQLiteSink(cur)
+    else:
+        conn, cur = NullConnection(), None
+        sink = make_sink(args.sink, directory=args.sink_dir)
+        # the song files are read again for the index before the timed 
+        # loads, which then time the transform and the writes alone
+        with metrics.timer(metrics.LOOKUP, "song_index"):
+            song_index = build_song_index("data/song_data",
+                                          args.match_tolerance)
+        time_dimension = TimeDimension()
+    start = time.perf_counter()
+    process(cur, conn, filepath="data/song_data", func=process_song_file,
+            workers=args.workers, commit_policy=commit_policy, sink=sink)
+    seconds = time.perf_counter() - start
+    if args.sqlite:
+        with metrics.timer(metrics.LOOKUP, "song_index"):
+            song_index = sqlite_backend.load_song_index(cur,
+                                                        args.match_tolerance)
+            time_dimension = sqlite_backend.load_time_dimension(cur)
+    start = time.perf_counter()
+    if args.stream_mb:
+        process_data(cur, conn, filepath="data/log_data",
+                     func=process_log_file_streamed,
+                     commit_policy=commit_policy,
+                     chunk_bytes=int(args.stream_mb * (1 << 20)),
+                     song_index=song_index, time_dimension=time_dimension,
+                     sink=sink)
+    else:
+        process(cur, conn, filepath="data/log_data", func=process_log_file,
+                workers=args.workers, commit_policy=commit_policy,
+                song_index=song_index, time_dimension=time_dimension,
+                sink=sink)
+    seconds += time.perf_counter() - start
+    sink.close()
     conn.close()
+    report_match_rate(song_index.events, song_index.matched)
+    rows = sink.total_rows()
+    print("{} rows written to {} in {:.2f}s ({:.0f} rows/s).".format(
+        rows, args.sqlite or "the {} sink".format(args.sink), seconds,
+        rows / seconds if seconds else 0))
+
+
+def main(argv=None):
+    run(build_parser().parse_args(argv))
 
 
 if __name__ == "__main__":
@@ -1,32 +1,31 @@
-import os
-import glob
 import psycopg2
 import numpy as np
 import pandas as pd
 from sql_queries import *
 from psycopg2.extensions import register_adapter, AsIs
-from io import StringIO
+from song_index import load_song_index, resolve_songs
+from binary_copy import copy_dataframe_binary
+from time_dimension import TimeDimension
+from manifest import advance_watermarks
+from json_reader import open_text, SUFFIXES
+import file_catalog
 
 
 def copy_dataframe(cur, df, table_name, sep=',', null=False):
-    sio = StringIO()
-    sio.write(df.to_csv(sep=sep, index=None, header=None))
-    # Write the Pandas DataFrame as a csv to the buffer
-    sio.seek(0)
-    if null:
-        cur.copy_from(sio, table_name, columns=df.columns, sep=sep, null="")
-    else:
-        cur.copy_from(sio, table_name, columns=df.columns, sep=sep)
+    # binary COPY straight from the dataframe columns; sep and null are unused
+    copy_dataframe_binary(cur, df, table_name)
 
 
 def process_song_file(cur, filepath):
     # open song file
-    df = pd.read_json(filepath, lines=True)
+    with open_text(filepath) as f:
+        df = pd.read_json(f, lines=True)
     # insert song record
     song_data = list(
         df.loc[0, ["song_id", "title", "artist_id", "year", "duration"]].values
     )
     cur.execute(song_table_insert, song_data)
+    loaded = ["songs"] if cur.rowcount else []
 
     # insert artist record
     artist_data = list(
@@ -46,30 +45,23 @@ def process_song_file(cur, filepath):
         for el in artist_data
     ]
     cur.execute(artist_table_insert, artist_data)
+    if cur.rowcount:
+        loaded.append("artists")
+    return loaded
 
 
-def process_log_file(cur, filepath):
+def process_log_file(cur, filepath, song_index=None, time_dimension=None):
     # open log file
-    df = pd.read_json(filepath, lines=True)
+    with open_text(filepath) as f:
+        df = pd.read_json(f, lines=True)
 
     # filter by NextSong action
     df = df[df["page"] == "NextSong"]
 
-    # convert timestamp column to datetime
-    ts = df["ts"]
-    tsdt = pd.to_datetime(df["ts"],unit='ms')
-
-    # insert time data records
-    time_data = (tsdt.values, tsdt.dt.hour, tsdt.dt.day, tsdt.dt.week,
-                 tsdt.dt.month, tsdt.dt.year, tsdt.dt.weekday)
-    column_labels = ("start_time", "hour", "day",
-                     "week", "month", "year", "weekday")
-    combined_dict = dict(zip(column_labels, time_data))
-    time_df = pd.DataFrame(combined_dict)
-    # remove duplicates
-    time_df.drop_duplicates(subset='start_time', keep="first", inplace=True)
-
-    copy_dataframe(cur, time_df, "time")
+    # copy time records of timestamps not loaded before in this run
+    if time_dimension is None:
+        time_dimension = TimeDimension.from_database(cur)
+    num_time_rows = time_dimension.add(cur, df["ts"].values)
 
     # load user table
     user_df = df[["userId", "firstName", "lastName", "gender", "level"]]
@@ -86,45 +78,36 @@ def process_log_file(cur, filepath):
 
 
 
+    # get songid and artistid for all events in one in-memory lookup
+    if song_index is None:
+        song_index = load_song_index(cur)
+    df = resolve_songs(df, song_index)
+
     # insert songplay records
-    data = []
-    for index, row in df.iterrows():
-
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
-        # insert songplay record
-        songplay_data = (
-            index,
-            row.ts,
-            row.userId,
-            row.level,
-            songid,
-            artistid,
-            row.sessionId,
-            row.location,
-            row.userAgent,
-        )
-        data.append(songplay_data)
-    songplay_columns = ["songplay_id", "start_time", "user_id", "level", "song_id", "artist_id", "session_id",
-                        "location", "user_agent"]
-    songplays_df = pd.DataFrame(data, columns=songplay_columns)
+    songplays_df = pd.DataFrame({
+        "songplay_id": df.index,
+        "start_time": df["ts"].values,
+        "user_id": df["userId"].values,
+        "level": df["level"].values,
+        "song_id": df["song_id"].values,
+        "artist_id": df["artist_id"].values,
+        "session_id": df["sessionId"].values,
+        "location": df["location"].values,
+        "user_agent": df["userAgent"].values,
+    })
     songplays_df.drop_duplicates(subset='songplay_id', keep="first", inplace=True)
     copy_dataframe(cur, songplays_df, "songplays", sep="\t", null=True)
 
+    # tables the file loaded rows into
+    return [table for table, num_rows in (("time", num_time_rows),
+                                          ("users", len(user_df)),
+                                          ("songplays", len(songplays_df)))
+            if num_rows]
+
 
-def process_data(cur, conn, filepath, func):
-    # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root, "*.json"))
-        for f in files:
-            all_files.append(os.path.abspath(f))
+def process_data(cur, conn, filepath, func, **kwargs):
+    # get all plain and compressed json files from directory
+    all_files = file_catalog.scan(filepath, SUFFIXES)
 
     # get total number of files found
     num_files = len(all_files)
@@ -132,7 +115,8 @@ def process_data(cur, conn, filepath, func):
 
     # iterate over files and process
     for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+        # move the load watermarks of the tables loaded in this transaction
+        advance_watermarks(cur, func(cur, datafile, **kwargs))
         conn.commit()
         print("{}/{} files processed.".format(i, num_files))
 
@@ -144,7 +128,10 @@ def main():
     cur = conn.cursor()
 
     process_data(cur, conn, filepath="data/song_data", func=process_song_file)
-    process_data(cur, conn, filepath="data/log_data", func=process_log_file)
+    song_index = load_song_index(cur)
+    time_dimension = TimeDimension.from_database(cur)
+    process_data(cur, conn, filepath="data/log_data", func=process_log_file,
+                 song_index=song_index, time_dimension=time_dimension)
 
     conn.close()
 
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+
+
+CATALOG_VERSION = 1
+
+# directories modified this recently are rescanned on the next scan too,
+# since a change within the same mtime tick would not move their mtime
+RACY_NS = 2 * 10 ** 9
+
+_state = {
+    "path": None,
+    # suffix -> directory -> [mtime_ns or None, file names, subdirectory 
+    # names]
+    "dirs": {},
+}
+
+
+def enable(path):
+    """
+    This procedure turns the persisted catalog on: the directory listings
+    saved in path by earlier scans are loaded, and every scan reuses the
+    listing of each directory whose mtime did not change and saves the
+    catalog again when a directory was rescanned.
+
+    INPUTS:
+    * path the catalog file
+    """
+    dirs = {}
+    try:
+        with open(path) as f:
+            catalog = json.load(f)
+        if catalog.get("version") == CATALOG_VERSION:
+            dirs = catalog["dirs"]
+    except (OSError, ValueError):
+        pass
+    _state.update(path=path, dirs=dirs)
+
+
+def disable():
+    """
+    This procedure turns the persisted catalog off.
+    """
+    _state.update(path=None, dirs={})
+
+
+def save():
+    """
+    This procedure writes the catalog to its file.
+    """
+    path = _state["path"]
+    if path is None:
+        return
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump({"version": CATALOG_VERSION, "dirs": _state["dirs"]}, f)
+    os.replace(tmp, path)
+
+
+def _list_dir(directory, suffix):
+    files = []
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # like os.walk, symbolic links to directories are not followed;
+            # like glob, hidden files are skipped
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif (entry.name.endswith(suffix) and not entry.name.startswith(".")
+                  and entry.is_file()):
+                files.append(entry.name)
+    return sorted(files), sorted(subdirs)
+
+
+def scan(root, suffix=".json"):
+    """
+    This procedure returns the absolute paths of all files under root
+    ending in suffix, in sorted order, listing every directory once with
+    os.scandir. With the catalog enabled, a directory whose mtime is the
+    one recorded is not listed again, only stat'ed.
+
+    INPUTS:
+    * root the directory to search
+    * suffix the file name ending to match, or a tuple of them
+    """
+    root = os.path.abspath(root)
+    dirs = {}
+    if _state["path"] is not None:
+        key = suffix if isinstance(suffix, str) else " ".join(suffix)
+        dirs = _state["dirs"].setdefault(key, {})
+    racy = time.time_ns() - RACY_NS
+    found = []
+    visited = set()
+    rescanned = 0
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        known = dirs.get(directory)
+        if known is not None and known[0] == mtime:
+            files, subdirs = known[1], known[2]
+        else:
+            try:
+                files, subdirs = _list_dir(directory, suffix)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            rescanned += 1
+            dirs[directory] = [mtime if mtime < racy else None, files, subdirs]
+        visited.add(directory)
+        found.extend(os.path.join(directory, name) for name in files)
+        pending.extend(os.path.join(directory, name) for name in subdirs)
+
+    # forget the directories that are gone
+    prefix = os.path.join(root, "")
+    for directory in [d for d in dirs if d == root or d.startswith(prefix)]:
+        if directory not in visited:
+            del dirs[directory]
+            rescanned += 1
+    if rescanned and _state["path"] is not None:
+        save()
+    return sorted(found)
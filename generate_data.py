@@ -0,0 +1,261 @@
+import os
+import gzip
+import json
+import string
+import argparse
+import numpy as np
+from datetime import datetime, timedelta, timezone
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+PAGES = ["NextSong", "Home", "Logout", "Settings", "Help", "About",
+         "Upgrade", "Downgrade", "Save Settings", "Submit Upgrade"]
+PAGE_WEIGHTS = [0.80, 0.07, 0.04, 0.02, 0.02, 0.01, 0.01, 0.01, 0.01, 0.01]
+
+FIRST_NAMES = ["Kaylee", "Walter", "Tegan", "Kate", "Chloe", "Jacob", "Lily",
+               "Aleena", "Mohammad", "Jayden", "Ryan", "Layla", "Matthew",
+               "Sara", "Cienna", "Jordan", "Ava", "Theodore", "Rylan", "Kinsley"]
+LAST_NAMES = ["Summers", "Frye", "Levine", "Harrell", "Cuevas", "Klein",
+              "Koch", "Kirby", "Rodriguez", "Graves", "Smith", "Barrera",
+              "Jones", "Johnson", "Freeman", "Alexander", "Robinson", "Harris"]
+LOCATIONS = ["San Francisco-Oakland-Hayward, CA", "Phoenix-Mesa-Scottsdale, AZ",
+             "Portland-South Portland, ME", "Lansing-East Lansing, MI",
+             "Chicago-Naperville-Elgin, IL-IN-WI", "Atlanta-Sandy Springs-Roswell, GA",
+             "New York-Newark-Jersey City, NY-NJ-PA", "Detroit-Warren-Dearborn, MI",
+             "Los Angeles-Long Beach-Anaheim, CA", "Tampa-St. Petersburg-Clearwater, FL"]
+ARTIST_LOCATIONS = ["", "California - LA", "Memphis, TN", "Nashville, TN.",
+                    "London, England", "New York, NY", "Detroit, MI",
+                    "Hamilton, Ohio", "Wisner, LA", "Chicago, IL"]
+USER_AGENTS = [
+    "\"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36\"",
+    "\"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like "
+    "Gecko) Chrome/35.0.1916.153 Safari/537.36\"",
+    "Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.2; WOW64; Trident/6.0)",
+    "\"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Ubuntu Chromium/36.0.1985.125 Chrome/36.0.1985.125 Safari/537.36\"",
+]
+WORDS = ["love", "night", "heart", "fire", "rain", "gold", "road", "dream",
+         "river", "shadow", "light", "song", "blue", "wild", "home", "city",
+         "dance", "summer", "stone", "ghost", "mercy", "echo", "sky", "run"]
+
+ID_ALPHABET = np.array(list(string.ascii_uppercase + string.digits))
+
+
+def random_ids(rng, prefix, n, length=16):
+    """
+    This procedure returns n distinct ids shaped like the sample ids, e.g.
+    SOMZWCG12A8C13C480 for prefix SO.
+    """
+    ids = set()
+    while len(ids) < n:
+        chars = rng.choice(ID_ALPHABET, size=(n - len(ids), length))
+        ids.update(prefix + "".join(row) for row in chars)
+    return sorted(ids)
+
+
+def random_titles(rng, n):
+    words = rng.choice(WORDS, size=(n, 3))
+    lengths = rng.integers(1, 4, size=n)
+    return [" ".join(row[:k]).title() for row, k in zip(words, lengths)]
+
+
+def zipf_choice(rng, n, size, a=1.2):
+    """
+    This procedure draws size indexes in [0, n) with a zipf-like skew, so a
+    few songs and users account for most of the events as in real logs.
+    """
+    ranks = np.arange(1, n + 1, dtype=np.float64)
+    weights = ranks ** -a
+    return rng.choice(n, size=size, p=weights / weights.sum())
+
+
+def build_catalog(rng, num_songs, songs_per_artist=3):
+    """
+    This procedure builds the song catalog as a list of song records with
+    the fields of the song files.
+    """
+    num_artists = max(1, num_songs // songs_per_artist)
+    artist_ids = random_ids(rng, "AR", num_artists)
+    artist_names = [name.title() for name in random_titles(rng, num_artists)]
+    has_coords = rng.random(num_artists) < 0.4
+    latitudes = np.round(rng.uniform(-60, 70, num_artists), 5)
+    longitudes = np.round(rng.uniform(-150, 150, num_artists), 5)
+    artist_locations = rng.choice(ARTIST_LOCATIONS, size=num_artists)
+
+    song_ids = random_ids(rng, "SO", num_songs)
+    titles = random_titles(rng, num_songs)
+    artist_of_song = zipf_choice(rng, num_artists, num_songs, a=0.8)
+    durations = np.round(rng.gamma(9.0, 27.0, num_songs), 5)
+    years = np.where(rng.random(num_songs) < 0.5, 0,
+                     rng.integers(1960, 2011, num_songs))
+
+    catalog = []
+    for i in range(num_songs):
+        a = artist_of_song[i]
+        catalog.append({
+            "num_songs": 1,
+            "artist_id": artist_ids[a],
+            "artist_latitude": float(latitudes[a]) if has_coords[a] else None,
+            "artist_longitude": float(longitudes[a]) if has_coords[a] else None,
+            "artist_location": str(artist_locations[a]),
+            "artist_name": artist_names[a],
+            "song_id": song_ids[i],
+            "title": titles[i],
+            "duration": float(durations[i]),
+            "year": int(years[i]),
+        })
+    return catalog
+
+
+def open_output(path, compress=None):
+    """
+    This procedure opens a json file for writing text, plain or compressed
+    with gzip ("gz", written to path.gz) or zstd ("zst", path.zst).
+    """
+    if compress == "gz":
+        return gzip.open(path + ".gz", "wt", encoding="utf-8")
+    if compress == "zst":
+        if zstandard is None:
+            raise ImportError("writing .zst files needs zstandard")
+        return zstandard.open(path + ".zst", "wt", encoding="utf-8")
+    return open(path, "w")
+
+
+def write_song_data(catalog, filepath, compress=None):
+    """
+    This procedure writes one song file per record under
+    filepath/<3rd>/<4th>/<5th>/<track id>.json like data/song_data,
+    optionally compressed, see open_output.
+    """
+    for record in catalog:
+        track_id = "TR" + record["song_id"][2:]
+        directory = os.path.join(filepath, *track_id[2:5])
+        os.makedirs(directory, exist_ok=True)
+        with open_output(os.path.join(directory, track_id + ".json"),
+                         compress) as f:
+            f.write(json.dumps(record))
+
+
+def write_log_data(rng, catalog, filepath, num_events, num_users, num_days,
+                   match_rate, start=datetime(2018, 11, 1, tzinfo=timezone.utc),
+                   compress=None):
+    """
+    This procedure writes num_events events spread over num_days daily log
+    files filepath/YYYY/MM/YYYY-MM-DD-events.json like data/log_data,
+    optionally compressed, see open_output.
+    match_rate is the share of NextSong events that play a catalog song;
+    the rest play songs that are not in the catalog, as in the sample.
+    """
+    users = []
+    for user_id in range(1, num_users + 1):
+        users.append({
+            "userId": str(user_id),
+            "firstName": str(rng.choice(FIRST_NAMES)),
+            "lastName": str(rng.choice(LAST_NAMES)),
+            "gender": str(rng.choice(["M", "F"])),
+            "level": "paid" if rng.random() < 0.3 else "free",
+            "location": str(rng.choice(LOCATIONS)),
+            "userAgent": str(rng.choice(USER_AGENTS)),
+            "registration": float(1540000000000 + rng.integers(0, 10 ** 9)),
+        })
+
+    per_day = np.bincount(rng.integers(0, num_days, num_events),
+                          minlength=num_days)
+    session_id = 0
+    for day, count in enumerate(per_day):
+        date = start + timedelta(days=day)
+        directory = os.path.join(filepath, date.strftime("%Y"),
+                                 date.strftime("%m"))
+        os.makedirs(directory, exist_ok=True)
+        day_ms = int(date.timestamp() * 1000)
+
+        ts = np.sort(day_ms + rng.integers(0, 86400 * 1000, count) // 1000 * 1000
+                     + 796)
+        user_idx = zipf_choice(rng, num_users, count, a=1.1)
+        pages = rng.choice(PAGES, size=count, p=PAGE_WEIGHTS)
+        song_idx = zipf_choice(rng, len(catalog), count)
+        matched = rng.random(count) < match_rate
+        unknown_titles = random_titles(rng, count)
+        unknown_lengths = np.round(rng.gamma(9.0, 27.0, count), 5)
+
+        sessions = {}
+        with open_output(os.path.join(directory, date.strftime("%Y-%m-%d")
+                                      + "-events.json"), compress) as f:
+            for i in range(count):
+                user = users[user_idx[i]]
+                if user["userId"] not in sessions:
+                    session_id += 1
+                    sessions[user["userId"]] = [session_id, 0]
+                session = sessions[user["userId"]]
+                page = str(pages[i])
+                song = artist = length = None
+                if page == "NextSong":
+                    if matched[i]:
+                        record = catalog[song_idx[i]]
+                        song, artist = record["title"], record["artist_name"]
+                        length = record["duration"]
+                    else:
+                        song = unknown_titles[i]
+                        artist = catalog[song_idx[i]]["artist_name"]
+                        length = float(unknown_lengths[i])
+                event = {
+                    "artist": artist,
+                    "auth": "Logged In",
+                    "firstName": user["firstName"],
+                    "gender": user["gender"],
+                    "itemInSession": session[1],
+                    "lastName": user["lastName"],
+                    "length": length,
+                    "level": user["level"],
+                    "location": user["location"],
+                    "method": "PUT" if page == "NextSong" else "GET",
+                    "page": page,
+                    "registration": user["registration"],
+                    "sessionId": session[0],
+                    "song": song,
+                    "status": 200,
+                    "ts": int(ts[i]),
+                    "userAgent": user["userAgent"],
+                    "userId": user["userId"],
+                }
+                session[1] += 1
+                if page == "Logout":
+                    del sessions[user["userId"]]
+                f.write(json.dumps(event, separators=(",", ":")))
+                f.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate song_data and log_data trees shaped like data/.")
+    parser.add_argument("output", help="directory to write song_data and "
+                                       "log_data into")
+    parser.add_argument("--songs", type=int, default=10000)
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--match-rate", type=float, default=0.5,
+                        help="share of NextSong events playing a catalog song")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compress", choices=["gz", "zst"],
+                        help="write .json.gz or .json.zst files")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    catalog = build_catalog(rng, args.songs)
+    write_song_data(catalog, os.path.join(args.output, "song_data"),
+                    args.compress)
+    write_log_data(rng, catalog, os.path.join(args.output, "log_data"),
+                   args.events, args.users, args.days, args.match_rate,
+                   compress=args.compress)
+    print("{} songs and {} events written to {}".format(
+        args.songs, args.events, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import io
+import gzip
+import json
+import queue
+import threading
+import numpy as np
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# log fields used by the loaders and their column types
+LOG_FIELDS = {
+    "ts": np.int64,
+    "userId": object,
+    "firstName": object,
+    "lastName": object,
+    "gender": object,
+    "level": object,
+    "song": object,
+    "artist": object,
+    "length": np.float64,
+    "sessionId": np.int64,
+    "location": object,
+    "userAgent": object,
+}
+
+SONG_FIELDS = {
+    "song_id": object,
+    "title": object,
+    "artist_id": object,
+    "year": np.int64,
+    "duration": np.float64,
+    "artist_name": object,
+    "artist_location": object,
+    "artist_latitude": np.float64,
+    "artist_longitude": np.float64,
+}
+
+NEXT_SONG = "NextSong"
+
+# file name endings of the json-lines sources, plain or compressed
+SUFFIXES = (".json", ".json.gz", ".json.zst")
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# decompressed bytes handed over per chunk, and chunks decompressed ahead
+DECOMPRESS_CHUNK = 1 << 20
+DECOMPRESS_AHEAD = 4
+
+
+def _to_arrays(columns, fields):
+    return {name: np.array(values, dtype=fields[name])
+            for name, values in columns.items()}
+
+
+class DecompressingReader(io.RawIOBase):
+    """
+    Readable stream of the decompressed content of a gzip or zstd source.
+    A background thread decompresses the source DECOMPRESS_CHUNK bytes at
+    a time, up to DECOMPRESS_AHEAD chunks ahead of the reader, so
+    decompression (which releases the GIL) overlaps with parsing while
+    only a few chunks are held in memory.
+    """
+
+    def __init__(self, raw, compression):
+        self._raw = raw
+        if compression == "gzip":
+            self._reader = gzip.GzipFile(fileobj=raw, mode="rb")
+        elif zstandard is None:
+            raw.close()
+            raise ImportError("reading .zst sources needs zstandard")
+        else:
+            self._reader = zstandard.ZstdDecompressor().stream_reader(
+                raw, read_across_frames=True)
+        self._chunks = queue.Queue(DECOMPRESS_AHEAD)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b"")
+        self._eof = False
+        self._thread = threading.Thread(target=self._decompress, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _decompress(self):
+        try:
+            while not self._stop.is_set():
+                chunk = self._reader.read(DECOMPRESS_CHUNK)
+                if not chunk:
+                    break
+                self._put(chunk)
+            self._put(None)
+        except Exception as exc:
+            self._put(exc)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk and not self._eof:
+            item = self._chunks.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if item is None:
+                self._eof = True
+            else:
+                self._chunk = memoryview(item)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._reader.close()
+            self._raw.close()
+        super().close()
+
+
+def compression_of(magic):
+    """
+    This procedure returns the compression of a source starting with the
+    bytes magic: "gzip", "zstd" or None.
+
+    INPUTS:
+    * magic the first 4 bytes of the source
+    """
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+def open_text(source):
+    """
+    This procedure opens a json-lines source for reading text: a file
+    path, or the content of a file as bytes (e.g. prefetched by
+    async_etl.py). gzip and zstd compressed sources, told by their magic
+    bytes, are decompressed as a stream by a DecompressingReader.
+
+    INPUTS:
+    * source a file path or bytes
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        raw = io.BytesIO(source)
+    else:
+        raw = open(source, "rb")
+    compression = compression_of(raw.read(len(ZSTD_MAGIC)))
+    raw.seek(0)
+    if compression is not None:
+        raw = io.BufferedReader(DecompressingReader(raw, compression))
+    return io.TextIOWrapper(raw, encoding="utf-8")
+
+
+def iter_log_events(filepath, fields=None, chunk_bytes=None):
+    """
+    This procedure reads the NextSong events of a log file into typed
+    column arrays, chunk_bytes of event lines at a time.
+    Lines that do not contain "NextSong" at all are skipped before they
+    are decoded; the remaining lines are decoded and checked on their page
+    field, and only the requested fields are kept.
+
+    INPUTS:
+    * filepath the file path to the log file, or its content as bytes
+    * fields the fields to keep, default LOG_FIELDS
+    * chunk_bytes size of the NextSong lines decoded per chunk; None reads
+      the whole file as one chunk
+
+    Yields (line numbers, dict of field -> numpy array) per chunk.
+    """
+    fields = list(fields or LOG_FIELDS)
+    columns = {name: [] for name in fields}
+    lines = []
+    size = 0
+    with open_text(filepath) as f:
+        for lineno, line in enumerate(f):
+            if NEXT_SONG not in line:
+                continue
+            record = json.loads(line)
+            if record.get("page") != NEXT_SONG:
+                continue
+            lines.append(lineno)
+            for name in fields:
+                columns[name].append(record.get(name))
+            size += len(line)
+            if chunk_bytes is not None and size >= chunk_bytes:
+                yield np.array(lines, dtype=np.int64), _to_arrays(columns, LOG_FIELDS)
+                columns = {name: [] for name in fields}
+                lines = []
+                size = 0
+    if lines or chunk_bytes is None:
+        yield np.array(lines, dtype=np.int64), _to_arrays(columns, LOG_FIELDS)
+
+
+def read_log_events(filepath, fields=None):
+    """
+    This procedure reads all NextSong events of a log file into typed
+    column arrays, see iter_log_events.
+
+    INPUTS:
+    * filepath the file path to the log file, or its content as bytes
+    * fields the fields to keep, default LOG_FIELDS
+
+    Returns (line numbers, dict of field -> numpy array).
+    """
+    return next(iter_log_events(filepath, fields))
+
+
+def read_log_frame(filepath, fields=None):
+    """
+    This procedure returns the NextSong events of a log file as a
+    dataframe indexed by line number, like
+    pd.read_json(filepath, lines=True) filtered on page == "NextSong".
+
+    INPUTS:
+    * filepath the file path to the log file
+    * fields the fields to keep, default LOG_FIELDS
+    """
+    lines, columns = read_log_events(filepath, fields)
+    return pd.DataFrame(columns, index=lines)
+
+
+def iter_log_frames(filepath, chunk_bytes, fields=None):
+    """
+    This procedure yields the NextSong events of a log file as dataframes
+    indexed by line number, one per chunk_bytes of event lines, so only
+    one chunk is held in memory at a time.
+
+    INPUTS:
+    * filepath the file path to the log file
+    * chunk_bytes size of the NextSong lines per dataframe
+    * fields the fields to keep, default LOG_FIELDS
+    """
+    for lines, columns in iter_log_events(filepath, fields, chunk_bytes):
+        yield pd.DataFrame(columns, index=lines)
+
+
+def read_song_records(filepath):
+    """
+    This procedure reads the records of a song file into typed column
+    arrays. Missing coordinates become NaN.
+
+    INPUTS:
+    * filepath the file path to the song file, or its content as bytes
+    """
+    columns = {name: [] for name in SONG_FIELDS}
+    with open_text(filepath) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            for name in SONG_FIELDS:
+                columns[name].append(record.get(name))
+    return _to_arrays(columns, SONG_FIELDS)
@@ -0,0 +1,112 @@
+import os
+import hashlib
+from sql_queries import manifest_select, manifest_upsert, \
+    load_watermark_advance, load_watermark_notify
+
+
+def file_hash(filepath, block_size=1 << 20):
+    """
+    This procedure returns the sha256 hex digest of a file's content.
+
+    INPUTS:
+    * filepath the file to hash
+    * block_size number of bytes read at a time
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(cur):
+    """
+    This procedure returns the processed-file manifest as a dict of
+    path -> (size, mtime, content_hash).
+
+    INPUTS:
+    * cur the cursor variable
+    """
+    cur.execute(manifest_select)
+    return {path: (size, mtime, content_hash)
+            for path, size, mtime, content_hash in cur.fetchall()}
+
+
+def select_changed_files(cur, all_files, reload_changed=True):
+    """
+    This procedure returns the files that are new or changed since they
+    were last recorded in the manifest, each as a (path, size, mtime,
+    content_hash) tuple ready for record_file.
+    A file whose size and mtime match the manifest is skipped without
+    being read; otherwise its content hash decides, so a file that was
+    only touched is not loaded again.
+    Without reload_changed a file whose content changed since it was
+    loaded raises a ValueError naming the changed files, before anything
+    is returned.
+
+    INPUTS:
+    * cur the cursor variable
+    * all_files the candidate file paths
+    * reload_changed return changed files to be loaded again; only safe
+      when loading a file twice does not duplicate its rows
+    """
+    manifest = load_manifest(cur)
+    changed = []
+    refused = []
+    for path in all_files:
+        stat = os.stat(path)
+        known = manifest.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            continue
+        content_hash = file_hash(path)
+        if known and known[2] == content_hash:
+            # same content, refresh size/mtime so the next run skips it cheaply
+            cur.execute(manifest_upsert, (path, stat.st_size, stat.st_mtime,
+                                          content_hash, None))
+            continue
+        if known and not reload_changed:
+            refused.append(path)
+            continue
+        changed.append((path, stat.st_size, stat.st_mtime, content_hash))
+    if refused:
+        raise ValueError(
+            "{} files changed since they were loaded, e.g. {}; loading them "
+            "again would duplicate the rows they loaded before. Restore them, "
+            "or put the new events in new files, or reload all files without "
+            "--incremental into empty tables".format(len(refused), refused[0]))
+    return changed
+
+
+def record_file(cur, entry, rows_loaded):
+    """
+    This procedure records a processed file in the manifest. It should run
+    in the same transaction as the file's data, so a crashed run resumes
+    exactly after the last committed file.
+
+    INPUTS:
+    * cur the cursor variable
+    * entry a (path, size, mtime, content_hash) tuple from
+      select_changed_files
+    * rows_loaded number of rows the file loaded
+    """
+    path, size, mtime, content_hash = entry
+    cur.execute(manifest_upsert, (path, size, mtime, content_hash, rows_loaded))
+
+
+def advance_watermarks(cur, tables):
+    """
+    This procedure moves the load watermark of tables to now and notifies
+    the listening analytics clients, which drop their cached results for
+    those tables. It should run in the transaction that loaded the data;
+    the notification is delivered when it commits.
+
+    INPUTS:
+    * cur the cursor variable
+    * tables names of the tables that were loaded; nothing is done when
+      there are none
+    """
+    tables = list(tables)
+    if not tables:
+        return
+    cur.execute(load_watermark_advance, (tables,))
+    cur.execute(load_watermark_notify)
@@ -0,0 +1,185 @@
+import json
+import time
+from contextlib import nullcontext
+
+
+# stages timed by the loaders
+PARSE = "parse"
+TRANSFORM = "transform"
+LOOKUP = "lookup"
+COPY = "copy"
+INSERT = "insert"
+COMMIT = "commit"
+WAIT = "wait"
+MATCH = "match"
+
+FORMATS = ("jsonl", "prometheus")
+
+_NULL_TIMER = nullcontext()
+
+_state = {
+    "enabled": False,
+    "path": None,
+    "format": "jsonl",
+    "out": None,
+    # (stage, table) -> [seconds, calls, rows] for the whole run
+    "totals": {},
+    # same for the file being processed, or None outside process_file
+    "file": None,
+}
+
+
+def enable(path, fmt="jsonl"):
+    """
+    This procedure turns instrumentation on.
+    With the jsonl format one line per processed file is appended to path
+    as files complete, followed by the run totals on report(); with the
+    prometheus format report() writes the run totals to path in the
+    Prometheus text exposition format.
+
+    INPUTS:
+    * path the output file
+    * fmt jsonl or prometheus
+    """
+    if fmt not in FORMATS:
+        raise ValueError("unknown metrics format {}".format(fmt))
+    _state.update(enabled=True, path=path, format=fmt, totals={}, file=None,
+                  out=open(path, "a") if fmt == "jsonl" else None)
+
+
+def disable():
+    """
+    This procedure turns instrumentation off and closes the output.
+    """
+    if _state["out"] is not None:
+        _state["out"].close()
+    _state.update(enabled=False, out=None, file=None)
+
+
+def is_enabled():
+    return _state["enabled"]
+
+
+def _add(stage, table, seconds, calls, rows):
+    for bucket in (_state["totals"], _state["file"]):
+        if bucket is None:
+            continue
+        entry = bucket.setdefault((stage, table), [0.0, 0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+        entry[2] += rows
+
+
+class _Timer:
+    __slots__ = ("stage", "table", "rows", "start")
+
+    def __init__(self, stage, table, rows):
+        self.stage = stage
+        self.table = table
+        self.rows = rows
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _add(self.stage, self.table, time.perf_counter() - self.start, 1,
+             self.rows)
+        return False
+
+
+def timer(stage, table="", rows=0):
+    """
+    This procedure returns a context manager timing one stage, optionally
+    for one table and a known number of rows. When instrumentation is off
+    it returns a shared no-op context manager.
+
+    INPUTS:
+    * stage one of the stage names above
+    * table the table written, if any
+    * rows number of rows handled
+    """
+    if not _state["enabled"]:
+        return _NULL_TIMER
+    return _Timer(stage, table, rows)
+
+
+def count(stage, table, rows):
+    """
+    This procedure adds rows to a stage/table counter.
+    """
+    if _state["enabled"]:
+        _add(stage, table, 0.0, 0, rows)
+
+
+def _records(bucket):
+    return [{"stage": stage, "table": table, "seconds": round(seconds, 6),
+             "calls": calls, "rows": rows}
+            for (stage, table), (seconds, calls, rows) in sorted(bucket.items())]
+
+
+class _FileScope:
+    __slots__ = ("path", "start")
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        _state["file"] = {}
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stages, _state["file"] = _state["file"], None
+        if _state["out"] is not None:
+            _state["out"].write(json.dumps({
+                "type": "file", "file": self.path, "seconds": round(seconds, 6),
+                "ok": exc[0] is None, "stages": _records(stages)}) + "\n")
+        return False
+
+
+def process_file(path):
+    """
+    This procedure returns a context manager collecting the timings of one
+    file, emitted as one json line when the file is done.
+
+    INPUTS:
+    * path the file being processed
+    """
+    if not _state["enabled"]:
+        return _NULL_TIMER
+    return _FileScope(path)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def report():
+    """
+    This procedure writes the run totals, as one json line per stage/table
+    or as a Prometheus text file, depending on the format.
+    """
+    if not _state["enabled"]:
+        return
+    records = _records(_state["totals"])
+    if _state["format"] == "jsonl":
+        for record in records:
+            _state["out"].write(json.dumps(dict(record, type="total")) + "\n")
+        _state["out"].flush()
+        return
+
+    metrics = [
+        ("etl_stage_seconds_total", "seconds", "Time spent per ETL stage and table."),
+        ("etl_stage_calls_total", "calls", "Timed calls per ETL stage and table."),
+        ("etl_rows_total", "rows", "Rows handled per ETL stage and table."),
+    ]
+    with open(_state["path"], "w") as f:
+        for name, field, help_text in metrics:
+            f.write("# HELP {} {}\n# TYPE {} counter\n".format(
+                name, help_text, name))
+            for record in records:
+                f.write('{}{{stage="{}",table="{}"}} {}\n'.format(
+                    name, _label(record["stage"]), _label(record["table"]),
+                    record[field]))
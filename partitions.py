@@ -0,0 +1,157 @@
+import numpy as np
+from binary_copy import copy_columns, get_column_types, TIMESTAMP_TYPES
+from time_dimension import civil_from_days, days_from_civil
+from sql_queries import songplays_partitioned_select, \
+    songplay_partitions_select, songplay_partition_create, \
+    songplay_partition_detach, songplay_partition_drop
+
+
+SECONDS_PER_DAY = 86400
+
+
+def month_starts(start_time):
+    """
+    This procedure returns the epoch second of the first instant of the
+    (UTC) month of every epoch second in start_time.
+
+    INPUTS:
+    * start_time int64 array of epoch seconds, or datetime64 array
+    """
+    start_time = np.asarray(start_time)
+    if np.issubdtype(start_time.dtype, np.datetime64):
+        start_time = start_time.astype("datetime64[s]")
+    days = np.floor_divide(start_time.astype(np.int64), SECONDS_PER_DAY)
+    year, month, day = civil_from_days(days)
+    return days_from_civil(year, month, np.ones_like(month)) * SECONDS_PER_DAY
+
+
+def next_month_start(month_start):
+    year, month, day = civil_from_days(np.int64(month_start) // SECONDS_PER_DAY)
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return int(days_from_civil(year, month, 1)) * SECONDS_PER_DAY
+
+
+def partition_name(year, month):
+    return "songplays_y{:04d}m{:02d}".format(year, month)
+
+
+def _name_of(month_start):
+    year, month, day = civil_from_days(np.int64(month_start) // SECONDS_PER_DAY)
+    return partition_name(int(year), int(month))
+
+
+class SongplayPartitions:
+    """
+    The monthly partitions of a range-partitioned songplays table.
+    Partitions are created the first time a month shows up in a batch, and
+    copy() routes each batch straight into the partitions of its months.
+    The partition key is epoch seconds, or a timestamp with typed set.
+    """
+
+    def __init__(self, names=(), typed=False):
+        self.names = set(names)
+        self.typed = typed
+        # partitions created since the last commit, while tracking
+        self._uncommitted = None
+
+    @classmethod
+    def from_database(cls, cur):
+        """
+        This procedure returns the partitions of songplays, or None when
+        songplays is not a partitioned table.
+
+        INPUTS:
+        * cur the cursor variable
+        """
+        cur.execute(songplays_partitioned_select)
+        if not cur.fetchone()[0]:
+            return None
+        typed = get_column_types(cur, "songplays")["start_time"] in TIMESTAMP_TYPES
+        cur.execute(songplay_partitions_select)
+        return cls((row[0] for row in cur.fetchall()), typed=typed)
+
+    def _bound(self, month_start):
+        if self.typed:
+            return "'{}'".format(np.datetime64(month_start, "s"))
+        return month_start
+
+    def ensure(self, cur, start_time):
+        """
+        This procedure creates the missing partitions for the months of
+        start_time and returns the month start of every row.
+
+        INPUTS:
+        * cur the cursor variable
+        * start_time int64 array of epoch seconds, or datetime64 array
+        """
+        starts = month_starts(start_time)
+        for month_start in np.unique(starts).tolist():
+            name = _name_of(month_start)
+            if name not in self.names:
+                cur.execute(songplay_partition_create.format(
+                    name=name, start=self._bound(month_start),
+                    end=self._bound(next_month_start(month_start))))
+                self.names.add(name)
+                if self._uncommitted is not None:
+                    self._uncommitted.append(name)
+        return starts
+
+    def begin(self):
+        """
+        This procedure starts tracking the partitions created in the open
+        transaction, so they can be forgotten if it is rolled back.
+        """
+        self._uncommitted = []
+
+    def commit(self):
+        if self._uncommitted is not None:
+            self._uncommitted = []
+
+    def rollback(self):
+        """
+        This procedure forgets the partitions created since the last
+        commit, whose CREATE TABLE was rolled back with the transaction.
+        """
+        if self._uncommitted:
+            self.names.difference_update(self._uncommitted)
+            self._uncommitted = []
+
+    def copy(self, cur, columns):
+        """
+        This procedure COPYs songplay rows into their monthly partitions,
+        one COPY per month in the batch.
+
+        INPUTS:
+        * cur the cursor variable
+        * columns a dict of songplays column name -> array, with start_time
+          in epoch seconds, or as datetime64 for the typed layout
+        """
+        columns = {name: np.asarray(values) for name, values in columns.items()}
+        starts = self.ensure(cur, columns["start_time"])
+        for month_start in np.unique(starts).tolist():
+            rows = starts == month_start
+            copy_columns(cur, _name_of(month_start),
+                         {name: values[rows] for name, values in columns.items()})
+
+
+def detach_month(cur, year, month):
+    """
+    This procedure detaches the partition of one month from songplays; the
+    rows stay in the detached table, e.g. for archiving.
+
+    INPUTS:
+    * cur the cursor variable
+    * year, month the month to detach
+    """
+    cur.execute(songplay_partition_detach.format(name=partition_name(year, month)))
+
+
+def drop_month(cur, year, month):
+    """
+    This procedure drops the partition of one month with all its rows.
+
+    INPUTS:
+    * cur the cursor variable
+    * year, month the month to drop
+    """
+    cur.execute(songplay_partition_drop.format(name=partition_name(year, month)))
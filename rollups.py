@@ -0,0 +1,36 @@
+import metrics
+from sql_queries import songplays_high_select, rollup_watermark_select, \
+    rollup_watermark_upsert, rollup_updates, rollup_updates_typed
+from typed_schema import is_typed_schema
+
+
+def update_rollups(cur, typed=None):
+    """
+    This procedure folds the songplays loaded since the last update into
+    the rollup tables (plays and distinct users per artist x hour x
+    location and per artist x level x day) and advances the watermark of
+    each rollup in the same transaction, so every songplay is counted
+    exactly once. Returns the rollup tables that were updated.
+
+    INPUTS:
+    * cur the cursor variable
+    * typed whether the tables use the typed layout; looked up when not
+      provided
+    """
+    if typed is None:
+        typed = is_typed_schema(cur)
+    cur.execute(songplays_high_select)
+    high = cur.fetchone()[0]
+    updated = []
+    for name, query in (rollup_updates_typed if typed else rollup_updates):
+        cur.execute(rollup_watermark_select, (name,))
+        row = cur.fetchone()
+        low = row[0] if row else 0
+        if high <= low:
+            continue
+        with metrics.timer(metrics.INSERT, name):
+            cur.execute(query, {"low": low, "high": high})
+        cur.execute(rollup_watermark_upsert, (name, high))
+        # each plays rollup keeps its distinct users beside it
+        updated += [name, name.replace("_plays", "_users")]
+    return updated
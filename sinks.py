@@ -0,0 +1,417 @@
+import abc
+import os
+import csv
+import numpy as np
+import pandas as pd
+from psycopg2.extras import execute_batch
+import metrics
+from binary_copy import copy_columns
+from sql_queries import song_table_insert, artist_table_insert, \
+    user_table_insert, time_table_insert, songplay_table_insert, \
+    songplay_table_insert_typed, sink_staging_create, sink_staging_truncate, \
+    sink_merge, sink_merge_keys, sqlite_inserts
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# sink names accepted by make_sink; the first three write to postgres
+POSTGRES = "postgres"
+INSERT = "insert"
+COPY = "copy"
+CSV = "csv"
+PARQUET = "parquet"
+NULL = "null"
+SINKS = (POSTGRES, INSERT, COPY, CSV, PARQUET, NULL)
+DATABASE_SINKS = (POSTGRES, INSERT, COPY)
+
+# columns of the rows written to each table, in the order of its insert
+TABLE_COLUMNS = {
+    "songs": ["song_id", "title", "artist_id", "year", "duration"],
+    "artists": ["artist_id", "name", "location", "latitude", "longitude"],
+    "users": ["user_id", "first_name", "last_name", "gender", "level"],
+    "time": ["start_time", "hour", "day", "week", "month", "year", "weekday"],
+    "songplays": ["start_time", "user_id", "level", "song_id", "artist_id",
+                  "session_id", "location", "user_agent"],
+}
+TYPED_SONGPLAY_COLUMNS = ["start_time", "user_id", "level", "song_key",
+                          "artist_key", "session_id", "location", "user_agent"]
+
+TABLE_INSERTS = {
+    "songs": song_table_insert,
+    "artists": artist_table_insert,
+    "users": user_table_insert,
+    "time": time_table_insert,
+    "songplays": songplay_table_insert,
+}
+
+
+def table_columns(table, rows):
+    """
+    This procedure turns row lists, as built by etl.transform_song_file,
+    into the columns of table.
+
+    INPUTS:
+    * table the table the rows belong to
+    * rows list of rows in TABLE_COLUMNS order
+    """
+    return {name: [row[i] for row in rows]
+            for i, name in enumerate(TABLE_COLUMNS[table])}
+
+
+def _length(columns):
+    return len(next(iter(columns.values()))) if columns else 0
+
+
+def _values(values):
+    # numpy and pandas scalars become python ones, datetime64 datetimes
+    return values.tolist() if hasattr(values, "tolist") else list(values)
+
+
+def _insert_of(table, columns):
+    """
+    This procedure returns the insert statement for the rows of table and
+    the column order of its parameters.
+    """
+    if table == "songplays" and "song_key" in columns:
+        return songplay_table_insert_typed, TYPED_SONGPLAY_COLUMNS
+    return TABLE_INSERTS[table], TABLE_COLUMNS[table]
+
+
+def _rows(columns, names):
+    return zip(*(_values(columns[name]) for name in names))
+
+
+class Sink(abc.ABC):
+    """
+    Destination of the rows written by the loaders. write() takes the rows
+    of one table as a dict of column name -> array-like, named as the
+    columns of the star tables. Songs and artists keep the first row
+    written per key, users take the level of the last one, time rows are
+    only written once per run (TimeDimension) and songplays are appended.
+    Like the other run-wide states of etl.write_files, a sink follows the
+    transaction through begin/commit/rollback; rows counts the rows
+    committed per table.
+    """
+
+    # whether the rows go to the postgres tables whose load watermarks the
+    # loaders advance
+    advances_watermarks = False
+
+    def __init__(self):
+        self.rows = {}
+        # rows written per table since the last commit
+        self._pending = {}
+
+    def write(self, table, columns):
+        """
+        This procedure writes the rows of one table to the sink.
+
+        INPUTS:
+        * table songs, artists, users, time or songplays
+        * columns a dict of column name -> array-like, all of the same
+          length
+        """
+        num_rows = _length(columns)
+        self.record(table, num_rows)
+        self._write(table, columns, num_rows)
+
+    def record(self, table, num_rows):
+        """
+        This procedure counts rows written to table past the sink, like the
+        songplays COPYed into their partitions, with the rows of the
+        transaction.
+
+        INPUTS:
+        * table the table the rows were written to
+        * num_rows number of rows written
+        """
+        self._pending[table] = self._pending.get(table, 0) + num_rows
+
+    @abc.abstractmethod
+    def _write(self, table, columns, num_rows):
+        """
+        This procedure writes the rows of one table to the destination.
+
+        INPUTS:
+        * table the table name
+        * columns dict of column name -> array-like with the rows
+        * num_rows number of rows
+        """
+
+    def pending_tables(self):
+        """
+        This procedure returns the tables rows were written to since the
+        last commit.
+        """
+        return [table for table, num_rows in self._pending.items() if num_rows]
+
+    def begin(self):
+        self._pending = {}
+
+    def commit(self):
+        for table, num_rows in self._pending.items():
+            self.rows[table] = self.rows.get(table, 0) + num_rows
+        self._pending = {}
+
+    def rollback(self):
+        self._pending = {}
+
+    def total_rows(self):
+        return sum(self.rows.values())
+
+    def close(self):
+        pass
+
+
+class PostgresSink(Sink):
+    """
+    The loader's own write path: one INSERT per row with the ON CONFLICT
+    rules of sql_queries.py, and one binary COPY per batch of time rows.
+    """
+
+    advances_watermarks = True
+
+    def __init__(self, cur):
+        super().__init__()
+        self.cur = cur
+
+    def _write(self, table, columns, num_rows):
+        if table == "time":
+            copy_columns(self.cur, table, columns)
+            return
+        query, names = _insert_of(table, columns)
+        with metrics.timer(metrics.INSERT, table, num_rows):
+            for row in _rows(columns, names):
+                self.cur.execute(query, row)
+
+
+class PostgresInsertSink(Sink):
+    """
+    INSERT statements for every table, time included, sent page_size rows
+    per round trip with psycopg2.extras.execute_batch.
+    """
+
+    advances_watermarks = True
+
+    def __init__(self, cur, page_size=100):
+        super().__init__()
+        self.cur = cur
+        self.page_size = page_size
+
+    def _write(self, table, columns, num_rows):
+        if not num_rows:
+            return
+        query, names = _insert_of(table, columns)
+        with metrics.timer(metrics.INSERT, table, num_rows):
+            execute_batch(self.cur, query, list(_rows(columns, names)),
+                          page_size=self.page_size)
+
+
+class PostgresCopySink(Sink):
+    """
+    Binary COPY for every table. Time rows and songplays are COPYed
+    straight into their table; songs, artists and users are COPYed into a
+    temporary table with their order and merged with one INSERT ... SELECT
+    keeping the ON CONFLICT rules of the per-row inserts.
+    """
+
+    advances_watermarks = True
+
+    def __init__(self, cur):
+        super().__init__()
+        self.cur = cur
+
+    def _write(self, table, columns, num_rows):
+        if not num_rows:
+            return
+        if table not in sink_merge_keys:
+            copy_columns(self.cur, table, columns)
+            return
+        names = ", ".join(TABLE_COLUMNS[table])
+        key, order, action = sink_merge_keys[table]
+        self.cur.execute(sink_staging_create.format(table=table, columns=names))
+        copy_columns(self.cur, table + "_sink",
+                     dict({"seq": np.arange(num_rows)},
+                          **{name: columns[name] for name in TABLE_COLUMNS[table]}))
+        with metrics.timer(metrics.INSERT, table, num_rows):
+            self.cur.execute(sink_merge.format(table=table, columns=names,
+                                               key=key, order=order,
+                                               action=action))
+        self.cur.execute(sink_staging_truncate.format(table=table))
+
+
+# parquet types of the columns a batch may hold no value of, e.g. the
+# coordinates of an artist or the song of an unmatched event; other columns
+# without a value are strings
+NULL_COLUMN_TYPES = {"latitude": "double", "longitude": "double",
+                     "song_key": "int64", "artist_key": "int64"}
+
+
+def _arrow_column(name, values):
+    if isinstance(values, pd.Series):
+        values = values.values
+    if isinstance(values, np.ndarray) and values.dtype != object:
+        return pa.array(values)
+    array = pa.array(values, from_pandas=True)
+    if array.type == pa.null():
+        # a batch without a single value gives no type to infer
+        return array.cast(pa.type_for_alias(NULL_COLUMN_TYPES.get(name, "string")))
+    return array
+
+
+class FileSink(Sink):
+    """
+    One CSV or Parquet file per table in directory, written afresh by each
+    sink. Rows are held until the commit and then appended, so a rolled
+    back group never reaches the files. Rows are not deduplicated by key:
+    a song, artist or user written twice is in the file twice.
+    """
+
+    def __init__(self, directory, fmt=CSV):
+        super().__init__()
+        if fmt not in (CSV, PARQUET):
+            raise ValueError("unknown file sink format {}".format(fmt))
+        if fmt == PARQUET and pq is None:
+            raise ImportError("the parquet sink needs pyarrow")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fmt = fmt
+        self._batches = {}
+        # table -> open csv file or ParquetWriter
+        self._files = {}
+
+    def path(self, table):
+        return os.path.join(self.directory, "{}.{}".format(table, self.fmt))
+
+    def _write(self, table, columns, num_rows):
+        if num_rows:
+            self._batches.setdefault(table, []).append(columns)
+
+    def begin(self):
+        super().begin()
+        self._batches = {}
+
+    def commit(self):
+        for table, batches in self._batches.items():
+            num_rows = sum(_length(columns) for columns in batches)
+            with metrics.timer(metrics.INSERT, table, num_rows):
+                if self.fmt == CSV:
+                    self._write_csv(table, batches)
+                else:
+                    self._write_parquet(table, batches)
+        self._batches = {}
+        super().commit()
+
+    def rollback(self):
+        super().rollback()
+        self._batches = {}
+
+    def _write_csv(self, table, batches):
+        f = self._files.get(table)
+        if f is None:
+            f = self._files[table] = open(self.path(table), "w", newline="")
+            csv.writer(f).writerow(list(batches[0]))
+        writer = csv.writer(f)
+        for columns in batches:
+            writer.writerows(_rows(columns, list(columns)))
+        f.flush()
+
+    def _write_parquet(self, table, batches):
+        tables = [pa.table({name: _arrow_column(name, values)
+                            for name, values in columns.items()})
+                  for columns in batches]
+        writer = self._files.get(table)
+        if writer is None:
+            writer = self._files[table] = pq.ParquetWriter(self.path(table),
+                                                           tables[0].schema)
+        # one row group per commit, in the types of the first one
+        writer.write_table(pa.concat_tables(
+            [data.cast(writer.schema) for data in tables]))
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+class CountingSink(Sink):
+    """
+    No-op sink: the rows are dropped and only counted, so a run against it
+    times the parse, transform and lookup work alone.
+    """
+
+    def _write(self, table, columns, num_rows):
+        pass
+
+
+def _sqlite_values(values):
+    if isinstance(values, np.ndarray) and values.dtype.kind == "M":
+        # timestamps as text, which the SQLite date functions read
+        return np.char.replace(np.datetime_as_string(values, unit="ms"),
+                               "T", " ").tolist()
+    return _values(values)
+
+
+class SQLiteSink(Sink):
+    """
+    Writes to a SQLite database (sqlite_backend.py) with one executemany of
+    the table's insert per batch, under the ON CONFLICT rules of the
+    postgres inserts. Only the original layout is supported.
+    """
+
+    def __init__(self, cur):
+        super().__init__()
+        self.cur = cur
+
+    def _write(self, table, columns, num_rows):
+        if not num_rows:
+            return
+        if table == "songplays" and "song_key" in columns:
+            raise ValueError("the SQLite target has no typed layout")
+        rows = zip(*(_sqlite_values(columns[name])
+                     for name in TABLE_COLUMNS[table]))
+        with metrics.timer(metrics.INSERT, table, num_rows):
+            self.cur.executemany(sqlite_inserts[table], rows)
+
+
+class NullConnection:
+    """
+    Stand-in for the connection of a run without a database; the sink
+    follows the commits and rollbacks as a run-wide state instead.
+    """
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_sink(name, cur=None, directory="sink_out"):
+    """
+    This procedure returns the sink of one of the SINKS names.
+
+    INPUTS:
+    * name the sink name
+    * cur the cursor variable, for the postgres sinks
+    * directory the output directory of the csv and parquet sinks
+    """
+    if name == POSTGRES:
+        return PostgresSink(cur)
+    if name == INSERT:
+        return PostgresInsertSink(cur)
+    if name == COPY:
+        return PostgresCopySink(cur)
+    if name in (CSV, PARQUET):
+        return FileSink(directory, name)
+    if name == NULL:
+        return CountingSink()
+    raise ValueError("unknown sink {}".format(name))
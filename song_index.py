@@ -0,0 +1,282 @@
+import json
+import numpy as np
+import pandas as pd
+import file_catalog
+from json_reader import SUFFIXES, open_text
+from binary_copy import copy_columns
+from sql_queries import song_index_select, song_index_select_typed, \
+    song_match_new_select, song_match_new_select_typed
+
+
+SONG_INDEX_KEYS = ["title", "name", "duration"]
+SONG_INDEX_COLUMNS = SONG_INDEX_KEYS + ["song_id", "artist_id"]
+SONG_INDEX_COLUMNS_TYPED = SONG_INDEX_COLUMNS + ["song_key", "artist_key"]
+
+# seconds a log event length may differ from songs.duration and still match
+DURATION_TOLERANCE = 1.0
+
+# every run of characters other than letters and digits
+_NON_ALNUM = r"[\W_]+"
+
+
+def match_keys(values):
+    """
+    This procedure normalizes song titles or artist names for matching:
+    lower case, with every run of characters other than letters and digits
+    collapsed to one space and no leading or trailing space. Missing 
+    values stay missing. The keys of the song_match table and of the 
+    staged events are computed here too, never in SQL, so the in-memory 
+    and the staged matches agree whatever the locale of the database.
+
+    INPUTS:
+    * values array-like of strings
+    """
+    values = pd.Series(np.asarray(values, dtype=object), dtype=object)
+    return (values.str.lower().str.replace(_NON_ALNUM, " ", regex=True)
+            .str.strip().values)
+
+
+class SongIndex:
+    """
+    Run-wide in-memory lookup of songs by normalized title, normalized
+    artist name and whole-second duration bucket. Each event probes the
+    buckets its tolerance window covers with hash lookups and takes the
+    song of the closest duration, then of the lowest song_id, like the
+    song_match lookup of the staged load. Counts the events resolved and
+    matched, for the match rate of the run; the counts follow commits and
+    rollbacks like the TimeDimension.
+    """
+
+    def __init__(self, df, tolerance=DURATION_TOLERANCE):
+        """
+        INPUTS:
+        * df dataframe with the SONG_INDEX_COLUMNS columns, and optionally
+          the song_key and artist_key surrogate keys
+        * tolerance seconds an event length may differ from the duration
+        """
+        self.tolerance = float(tolerance)
+        self.columns = [column for column in SONG_INDEX_COLUMNS_TYPED[3:]
+                        if column in df]
+        df = df.dropna(subset=SONG_INDEX_COLUMNS)
+        df = df.assign(title_key=match_keys(df["title"]),
+                       name_key=match_keys(df["name"]),
+                       bucket=np.floor(df["duration"].astype(float))
+                       .astype(np.int64))
+        df = df.dropna(subset=["title_key", "name_key"])
+        df = df.sort_values(["title_key", "name_key", "bucket", "song_id"],
+                            kind="stable").reset_index(drop=True)
+
+        # one hash entry per (title_key, name_key, bucket) pointing at the
+        # run of its songs in df
+        keys = df[["title_key", "name_key", "bucket"]]
+        first = ~keys.duplicated().values
+        self._starts = np.flatnonzero(first)
+        self._ends = np.append(self._starts[1:], len(df))
+        self._keys = pd.MultiIndex.from_frame(keys[first])
+        self._durations = df["duration"].values.astype(float)
+        self._song_ranks = np.argsort(np.argsort(df["song_id"].values,
+                                                 kind="stable"))
+        self._values = {column: df[column].values for column in self.columns}
+        self.events = 0
+        self.matched = 0
+        self._committed = (0, 0)
+
+    def __len__(self):
+        return len(self._durations)
+
+    def match(self, songs, artists, lengths):
+        """
+        This procedure returns, for every event, the position of its
+        matching song in the index or -1.
+
+        INPUTS:
+        * songs, artists, lengths the song title, artist name and length of
+          every event
+        """
+        titles = match_keys(songs)
+        names = match_keys(artists)
+        lengths = np.asarray(lengths, dtype=float)
+        best = np.full(len(lengths), -1, dtype=np.int64)
+        valid = pd.notna(titles) & pd.notna(names) & ~np.isnan(lengths)
+        if not valid.any() or not len(self._keys):
+            return best
+
+        # probe every bucket from floor(length - tolerance) to
+        # floor(length + tolerance)
+        events = np.flatnonzero(valid)
+        low = np.floor(lengths[events] - self.tolerance).astype(np.int64)
+        high = np.floor(lengths[events] + self.tolerance).astype(np.int64)
+        probe_events, probe_buckets = [], []
+        for step in range(int(np.max(high - low)) + 1):
+            within = low + step <= high
+            probe_events.append(events[within])
+            probe_buckets.append(low[within] + step)
+        probe_events = np.concatenate(probe_events)
+        probe_buckets = np.concatenate(probe_buckets)
+        groups = self._keys.get_indexer(pd.MultiIndex.from_arrays(
+            [titles[probe_events], names[probe_events], probe_buckets]))
+        found = groups >= 0
+        probe_events, groups = probe_events[found], groups[found]
+
+        # every song of the probed buckets, closest duration first
+        counts = self._ends[groups] - self._starts[groups]
+        candidate_events = np.repeat(probe_events, counts)
+        candidates = (np.repeat(self._starts[groups], counts)
+                      + np.arange(counts.sum())
+                      - np.repeat(np.cumsum(counts) - counts, counts))
+        distance = np.abs(self._durations[candidates]
+                          - lengths[candidate_events])
+        close = distance <= self.tolerance
+        candidate_events = candidate_events[close]
+        candidates = candidates[close]
+        order = np.lexsort((self._song_ranks[candidates], distance[close],
+                            candidate_events))
+        candidate_events, candidates = candidate_events[order], candidates[order]
+        first = np.ones(len(candidates), dtype=bool)
+        first[1:] = candidate_events[1:] != candidate_events[:-1]
+        best[candidate_events[first]] = candidates[first]
+        return best
+
+    def resolve(self, df, length=None):
+        """
+        This procedure returns a copy of a log dataframe with the song_id
+        and artist_id (and the surrogate keys, when the index holds them)
+        of every event. Events without a match get None for all of them.
+        The index of df is preserved.
+
+        INPUTS:
+        * df the log dataframe (song, artist and length columns)
+        * length optional series to match against songs.duration instead
+          of df["length"]
+        """
+        if length is None:
+            length = df["length"]
+        positions = self.match(df["song"].values, df["artist"].values, length)
+        found = positions >= 0
+        self.events += len(df)
+        self.matched += int(found.sum())
+
+        df = df.copy()
+        for column in self.columns:
+            values = np.full(len(df), None, dtype=object)
+            values[found] = self._values[column][positions[found]]
+            df[column] = values
+        return df
+
+    def begin(self):
+        """
+        This procedure starts counting the events of the open transaction,
+        so they can be taken back if it is rolled back.
+        """
+        self._committed = (self.events, self.matched)
+
+    def commit(self):
+        self._committed = (self.events, self.matched)
+
+    def rollback(self):
+        """
+        This procedure takes back the events counted since the last
+        commit, whose songplays were rolled back with the transaction.
+        """
+        self.events, self.matched = self._committed
+
+    def match_rate(self):
+        """
+        This procedure returns the share of the resolved events that
+        matched a song, or None before any event was resolved.
+        """
+        return self.matched / self.events if self.events else None
+
+
+def load_song_index(cur, typed=False, tolerance=DURATION_TOLERANCE):
+    """
+    This procedure loads the song lookup index from the songs and
+    artists tables with a single query.
+    It should be called once per run, after the song files are loaded.
+
+    INPUTS:
+    * cur the cursor variable
+    * typed whether the tables use the typed layout; the index then also
+      resolves the song_key and artist_key surrogate keys
+    * tolerance seconds an event length may differ from the duration
+    """
+    if typed:
+        cur.execute(song_index_select_typed)
+        df = pd.DataFrame(cur.fetchall(), columns=SONG_INDEX_COLUMNS_TYPED)
+    else:
+        cur.execute(song_index_select)
+        df = pd.DataFrame(cur.fetchall(), columns=SONG_INDEX_COLUMNS)
+    return SongIndex(df, tolerance)
+
+
+def build_song_index(filepath, tolerance=DURATION_TOLERANCE):
+    """
+    This procedure builds the song lookup index straight from the song
+    json files, without touching the database.
+
+    INPUTS:
+    * filepath the directory holding the song files
+    * tolerance seconds an event length may differ from the duration
+    """
+    records = []
+    for f in file_catalog.scan(filepath, SUFFIXES):
+        with open_text(f) as fh:
+            for line in fh:
+                if line.strip():
+                    records.append(json.loads(line))
+
+    df = pd.DataFrame(records, columns=["title", "artist_name", "duration",
+                                        "song_id", "artist_id"])
+    df = df.rename(columns={"artist_name": "name"})
+    return SongIndex(df, tolerance)
+
+
+def resolve_songs(df, song_index, length=None):
+    """
+    This procedure resolves song_id and artist_id for every event of a
+    log dataframe with hash lookups over the whole frame, see
+    SongIndex.resolve.
+
+    INPUTS:
+    * df the log dataframe (song, artist and length columns)
+    * song_index the index returned by load_song_index/build_song_index
+    * length optional series to match against songs.duration instead of
+      df["length"]
+    """
+    return song_index.resolve(df, length)
+
+
+def update_song_match(cur, typed=False):
+    """
+    This procedure adds the songs loaded since the last update to the
+    song_match table the staged load matches events against, keyed by
+    match_keys.
+
+    INPUTS:
+    * cur the cursor variable
+    * typed whether the tables use the typed layout
+    """
+    if typed:
+        cur.execute(song_match_new_select_typed)
+        df = pd.DataFrame(cur.fetchall(), columns=SONG_INDEX_COLUMNS_TYPED)
+    else:
+        cur.execute(song_match_new_select)
+        df = pd.DataFrame(cur.fetchall(), columns=SONG_INDEX_COLUMNS)
+    df = df.assign(title_key=match_keys(df["title"]),
+                   name_key=match_keys(df["name"]))
+    df = df.dropna(subset=["title_key", "name_key"])
+    if not len(df):
+        return
+    duration = df["duration"].values.astype(float)
+    columns = {
+        "title_key": df["title_key"].values,
+        "name_key": df["name_key"].values,
+        "duration_bucket": np.floor(duration).astype(np.int64),
+        "duration": duration,
+        "song_id": df["song_id"].values,
+        "artist_id": df["artist_id"].values,
+    }
+    if typed:
+        columns["song_key"] = df["song_key"].values
+        columns["artist_key"] = df["artist_key"].values
+    copy_columns(cur, "song_match", columns)
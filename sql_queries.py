@@ -5,6 +5,15 @@ user_table_drop = "DROP TABLE IF EXISTS users CASCADE;"
 song_table_drop = "DROP TABLE IF EXISTS songs CASCADE;"
 artist_table_drop = "DROP TABLE IF EXISTS artists CASCADE;"
 time_table_drop = "DROP TABLE IF EXISTS time CASCADE;"
+songplay_staging_drop = "DROP TABLE IF EXISTS songplay_staging;"
+manifest_table_drop = "DROP TABLE IF EXISTS load_manifest;"
+artist_hour_location_plays_drop = "DROP TABLE IF EXISTS artist_hour_location_plays;"
+artist_hour_location_users_drop = "DROP TABLE IF EXISTS artist_hour_location_users;"
+artist_level_day_plays_drop = "DROP TABLE IF EXISTS artist_level_day_plays;"
+artist_level_day_users_drop = "DROP TABLE IF EXISTS artist_level_day_users;"
+rollup_watermark_drop = "DROP TABLE IF EXISTS rollup_watermark;"
+load_watermark_drop = "DROP TABLE IF EXISTS load_watermark;"
+song_match_drop = "DROP TABLE IF EXISTS song_match;"
 
 # CREATE TABLES
 
@@ -20,6 +29,21 @@ songplay_table_create = (""" CREATE TABLE IF NOT EXISTS songplays (
             user_agent varchar(255)
             );""")
 
+# songplays range-partitioned by month of start_time (epoch seconds); the 
+# partition key has to be part of the primary key
+songplay_table_create_partitioned = (""" CREATE TABLE IF NOT EXISTS songplays (
+            songplay_id serial, 
+            start_time bigint NOT NULL,
+            user_id varchar NOT NULL, 
+            level varchar(255), 
+            song_id varchar(255), 
+            artist_id varchar(255), 
+            session_id int, 
+            location varchar(255), 
+            user_agent varchar(255), 
+            PRIMARY KEY (songplay_id, start_time)
+            ) PARTITION BY RANGE (start_time);""")
+
 user_table_create = ("""
             CREATE TABLE IF NOT EXISTS users (
             user_id varchar PRIMARY KEY, 
@@ -58,6 +82,79 @@ time_table_create = ("""
             weekday int NOT NULL);
 """)
 
+# TYPED SCHEMA
+# tightened layout (create_tables.py --typed-schema, typed_schema.py): 
+# integer user ids, numeric coordinates, songplays.start_time of the same 
+# type and value as time.start_time, integer surrogate keys for songs and 
+# artists in the fact table (the natural ids stay unique in the 
+# dimensions), and the fixed-width columns first, widest to narrowest, so 
+# no alignment padding is needed between them
+
+songplay_table_create_typed = (""" CREATE TABLE IF NOT EXISTS songplays (
+            start_time timestamp NOT NULL, 
+            songplay_id serial PRIMARY KEY, 
+            user_id int NOT NULL, 
+            session_id int, 
+            song_key int, 
+            artist_key int, 
+            level varchar(4), 
+            location varchar, 
+            user_agent varchar
+            );""")
+
+songplay_table_create_typed_partitioned = (""" CREATE TABLE IF NOT EXISTS songplays (
+            start_time timestamp NOT NULL, 
+            songplay_id serial, 
+            user_id int NOT NULL, 
+            session_id int, 
+            song_key int, 
+            artist_key int, 
+            level varchar(4), 
+            location varchar, 
+            user_agent varchar, 
+            PRIMARY KEY (songplay_id, start_time)
+            ) PARTITION BY RANGE (start_time);""")
+
+user_table_create_typed = ("""
+            CREATE TABLE IF NOT EXISTS users (
+            user_id int PRIMARY KEY, 
+            gender char(1), 
+            first_name varchar NOT NULL, 
+            last_name varchar NOT NULL, 
+            level varchar(4) NOT NULL);
+""")
+
+song_table_create_typed = ("""
+            CREATE TABLE IF NOT EXISTS songs (
+            duration double precision, 
+            song_key serial PRIMARY KEY, 
+            year smallint, 
+            song_id varchar(18) NOT NULL UNIQUE, 
+            title varchar NOT NULL, 
+            artist_id varchar(18) NOT NULL);
+""")
+
+artist_table_create_typed = ("""
+            CREATE TABLE IF NOT EXISTS artists (
+            latitude double precision, 
+            longitude double precision, 
+            artist_key serial PRIMARY KEY, 
+            artist_id varchar(18) NOT NULL UNIQUE, 
+            name varchar NOT NULL, 
+            location varchar);
+""")
+
+time_table_create_typed = ("""
+            CREATE TABLE IF NOT EXISTS time (
+            start_time timestamp PRIMARY KEY, 
+            year smallint NOT NULL, 
+            hour smallint NOT NULL, 
+            day smallint NOT NULL, 
+            week smallint NOT NULL, 
+            month smallint NOT NULL, 
+            weekday smallint NOT NULL);
+""")
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""
@@ -73,6 +170,19 @@ songplay_table_insert = ("""
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
 """)
 
+songplay_table_insert_typed = ("""
+            INSERT INTO songplays (
+            start_time, 
+            user_id, 
+            level, 
+            song_key, 
+            artist_key, 
+            session_id, 
+            location, 
+            user_agent) 
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+""")
+
 user_table_insert = ("""
             INSERT INTO users (
             user_id, 
@@ -131,6 +241,582 @@ time_table_insert = ("""
             DO NOTHING;
 """)
 
+# one row per loaded source file, used for incremental loads
+manifest_table_create = ("""
+            CREATE TABLE IF NOT EXISTS load_manifest (
+            path varchar PRIMARY KEY, 
+            size bigint NOT NULL, 
+            mtime double precision NOT NULL, 
+            content_hash char(64) NOT NULL, 
+            rows_loaded int, 
+            loaded_at timestamp NOT NULL DEFAULT now());
+""")
+
+# ROLLUP TABLES
+# plays and distinct users per key; the *_users tables hold the distinct 
+# (key, user) pairs so the user counts can be maintained incrementally
+
+artist_hour_location_plays_create = ("""
+            CREATE TABLE IF NOT EXISTS artist_hour_location_plays (
+            artist_id varchar NOT NULL, 
+            hour int NOT NULL, 
+            location varchar NOT NULL, 
+            plays bigint NOT NULL, 
+            users bigint NOT NULL, 
+            PRIMARY KEY (artist_id, hour, location));
+""")
+
+artist_hour_location_users_create = ("""
+            CREATE TABLE IF NOT EXISTS artist_hour_location_users (
+            artist_id varchar NOT NULL, 
+            hour int NOT NULL, 
+            location varchar NOT NULL, 
+            user_id varchar NOT NULL, 
+            PRIMARY KEY (artist_id, hour, location, user_id));
+""")
+
+artist_level_day_plays_create = ("""
+            CREATE TABLE IF NOT EXISTS artist_level_day_plays (
+            artist_id varchar NOT NULL, 
+            level varchar NOT NULL, 
+            day date NOT NULL, 
+            plays bigint NOT NULL, 
+            users bigint NOT NULL, 
+            PRIMARY KEY (artist_id, level, day));
+""")
+
+artist_level_day_users_create = ("""
+            CREATE TABLE IF NOT EXISTS artist_level_day_users (
+            artist_id varchar NOT NULL, 
+            level varchar NOT NULL, 
+            day date NOT NULL, 
+            user_id varchar NOT NULL, 
+            PRIMARY KEY (artist_id, level, day, user_id));
+""")
+
+# highest songplay_id already folded into each rollup
+rollup_watermark_create = ("""
+            CREATE TABLE IF NOT EXISTS rollup_watermark (
+            name varchar PRIMARY KEY, 
+            last_songplay_id bigint NOT NULL);
+""")
+
+# time of the last load of each table, advanced by the ETL and used to 
+# invalidate cached analytics results
+load_watermark_create = ("""
+            CREATE TABLE IF NOT EXISTS load_watermark (
+            table_name varchar PRIMARY KEY, 
+            loaded_at timestamp with time zone NOT NULL);
+""")
+
+# SONG MATCHING
+# songs by normalized title and artist name (song_index.match_keys, 
+# computed in python for the songs and the staged events alike, so the 
+# keys do not depend on the locale of the database) and whole-second 
+# duration bucket. A log event matches the song of the closest duration 
+# within a tolerance, looked up by probing the few buckets the tolerance 
+# window covers; song_index.py does the same in memory
+
+song_match_create = ("""
+            CREATE TABLE IF NOT EXISTS song_match (
+            title_key varchar NOT NULL, 
+            name_key varchar NOT NULL, 
+            duration_bucket int NOT NULL, 
+            duration double precision NOT NULL, 
+            song_id varchar NOT NULL, 
+            artist_id varchar NOT NULL, 
+            song_key int, 
+            artist_key int, 
+            PRIMARY KEY (title_key, name_key, duration_bucket, song_id));
+""")
+
+# the songs not matched on yet, in the columns of song_index_select; the
+# surrogate keys are only selected for the typed layout
+song_match_new_select_template = ("""
+            SELECT 
+            songs.title, 
+            artists.name, 
+            songs.duration, 
+            songs.song_id, 
+            artists.artist_id{keys} 
+            FROM songs JOIN artists 
+            ON songs.artist_id = artists.artist_id 
+            WHERE songs.duration IS NOT NULL 
+            AND NOT EXISTS (
+                SELECT 1 FROM song_match m WHERE m.song_id = songs.song_id);
+""")
+
+song_match_new_select = song_match_new_select_template.format(keys="")
+song_match_new_select_typed = song_match_new_select_template.format(
+    keys=", \n            songs.song_key, \n            artists.artist_key")
+song_match_truncate = "TRUNCATE song_match;"
+
+# STAGING TABLES
+
+songplay_staging_create = ("""
+            CREATE UNLOGGED TABLE IF NOT EXISTS songplay_staging (
+            seq bigint NOT NULL, 
+            start_time bigint NOT NULL, 
+            user_id varchar NOT NULL, 
+            level varchar(255), 
+            session_id int, 
+            location varchar(255), 
+            user_agent varchar(255), 
+            song varchar, 
+            artist varchar, 
+            length float, 
+            title_key varchar, 
+            name_key varchar);
+""")
+
+songplay_staging_truncate = "TRUNCATE songplay_staging;"
+
+song_staging_create = ("""
+            CREATE TEMP TABLE IF NOT EXISTS song_staging (
+            seq bigint NOT NULL, 
+            song_id varchar, 
+            title varchar, 
+            artist_id varchar, 
+            year int, 
+            duration float, 
+            artist_name varchar, 
+            artist_location varchar, 
+            artist_latitude double precision, 
+            artist_longitude double precision)
+            ON COMMIT DROP;
+""")
+
+# MERGE STAGED RECORDS
+# the first staged row per key wins, like the per-file DO NOTHING inserts
+
+song_table_merge = ("""
+            INSERT INTO songs (
+            song_id, 
+            title, 
+            artist_id, 
+            year, 
+            duration) 
+            SELECT DISTINCT ON (song_id) 
+            song_id, title, artist_id, year, duration 
+            FROM song_staging 
+            WHERE song_id IS NOT NULL 
+            ORDER BY song_id, seq
+            ON CONFLICT (song_id)
+            DO NOTHING;
+""")
+
+artist_table_merge = ("""
+            INSERT INTO artists (
+            artist_id, 
+            name, 
+            location, 
+            latitude, 
+            longitude) 
+            SELECT DISTINCT ON (artist_id) 
+            artist_id, artist_name, artist_location, 
+            artist_latitude, artist_longitude 
+            FROM song_staging 
+            WHERE artist_id IS NOT NULL 
+            ORDER BY artist_id, seq
+            ON CONFLICT (artist_id)
+            DO NOTHING;
+""")
+
+# the songs, artists and users batches of sinks.PostgresCopySink are COPYed
+# into a temporary table of the same columns plus their order (seq) and
+# merged like the per-row inserts: the first row per key wins for songs
+# and artists, the last one sets the user level
+sink_staging_create = ("""
+            CREATE TEMP TABLE IF NOT EXISTS {table}_sink
+            ON COMMIT DROP AS
+            SELECT 0::bigint AS seq, {columns}
+            FROM {table}
+            WITH NO DATA;
+""")
+
+sink_staging_truncate = "TRUNCATE {table}_sink;"
+
+sink_merge = ("""
+            INSERT INTO {table} ({columns})
+            SELECT DISTINCT ON ({key}) {columns}
+            FROM {table}_sink
+            ORDER BY {key}, seq {order}
+            ON CONFLICT ({key})
+            {action};
+""")
+
+# table -> (key, seq order, conflict action) of sink_merge
+sink_merge_keys = {
+    "songs": ("song_id", "ASC", "DO NOTHING"),
+    "artists": ("artist_id", "ASC", "DO NOTHING"),
+    "users": ("user_id", "DESC", "DO UPDATE SET level = EXCLUDED.level"),
+}
+
+# every event probes the duration buckets its tolerance window covers 
+# with one equi-join of the whole staging table against song_match, and 
+# DISTINCT ON keeps at most one song per event (the closest duration, then
+# the lowest song_id), so the join below cannot multiply events; returns 
+# the number of songplays inserted and how many of them matched a song
+songplay_staging_insert = ("""
+            WITH inserted AS (
+            INSERT INTO songplays (
+            start_time, 
+            user_id, 
+            level, 
+            {song}, 
+            {artist}, 
+            session_id, 
+            location, 
+            user_agent) 
+            SELECT 
+            {start_time}, {user_id}, e.level, m.{song}, m.{artist}, 
+            e.session_id, e.location, e.user_agent 
+            FROM songplay_staging e 
+            LEFT JOIN (
+                SELECT DISTINCT ON (e.seq) e.seq, m.{song}, m.{artist} 
+                FROM songplay_staging e 
+                CROSS JOIN generate_series(
+                    floor(e.length - %(tolerance)s)::int, 
+                    floor(e.length + %(tolerance)s)::int) AS b(bucket) 
+                JOIN song_match m 
+                ON m.title_key = e.title_key 
+                AND m.name_key = e.name_key 
+                AND m.duration_bucket = b.bucket 
+                WHERE abs(m.duration - e.length) <= %(tolerance)s 
+                ORDER BY e.seq, abs(m.duration - e.length), m.song_id
+            ) m ON m.seq = e.seq 
+            {where}
+            ORDER BY e.seq 
+            RETURNING {song})
+            SELECT count(*), count({song}) FROM inserted;
+""")
+
+# songplay_staging.start_time holds epoch seconds for the bigint layout and
+# epoch milliseconds for the typed one, whose songplays reference songs and
+# artists by surrogate key
+songplay_staging_insert_all = songplay_staging_insert.format(
+    where="", start_time="e.start_time", user_id="e.user_id",
+    song="song_id", artist="artist_id")
+songplay_staging_insert_matched = songplay_staging_insert.format(
+    where="WHERE m.song_id IS NOT NULL", start_time="e.start_time",
+    user_id="e.user_id", song="song_id", artist="artist_id")
+songplay_staging_insert_all_typed = songplay_staging_insert.format(
+    where="", start_time="to_timestamp(e.start_time / 1000.0) AT TIME ZONE 'UTC'",
+    user_id="e.user_id::int", song="song_key", artist="artist_key")
+songplay_staging_insert_matched_typed = songplay_staging_insert.format(
+    where="WHERE m.song_key IS NOT NULL",
+    start_time="to_timestamp(e.start_time / 1000.0) AT TIME ZONE 'UTC'",
+    user_id="e.user_id::int", song="song_key", artist="artist_key")
+
+# ROLLUPS
+# each update folds the songplays with low < songplay_id <= high into the 
+# rollup: plays are added up, users grow by the (key, user) pairs not seen 
+# before
+
+songplays_high_select = "SELECT coalesce(max(songplay_id), 0) FROM songplays;"
+
+rollup_watermark_select = ("""
+            SELECT last_songplay_id 
+            FROM rollup_watermark 
+            WHERE name = %s;
+""")
+
+rollup_watermark_upsert = ("""
+            INSERT INTO rollup_watermark (name, last_songplay_id) 
+            VALUES (%s, %s)
+            ON CONFLICT (name)
+            DO UPDATE
+            SET last_songplay_id = EXCLUDED.last_songplay_id;
+""")
+
+artist_hour_location_plays_update_template = ("""
+            WITH new_plays AS (
+                SELECT 
+                {artist_id} AS artist_id, 
+                extract(hour FROM {ts})::int AS hour, 
+                coalesce(sp.location, '') AS location, 
+                sp.user_id 
+                FROM songplays sp {artist_join}
+                WHERE sp.songplay_id > %(low)s AND sp.songplay_id <= %(high)s 
+                AND {artist_id} IS NOT NULL
+            ), plays AS (
+                SELECT artist_id, hour, location, count(*) AS plays 
+                FROM new_plays 
+                GROUP BY artist_id, hour, location
+            ), new_users AS (
+                INSERT INTO artist_hour_location_users 
+                SELECT DISTINCT artist_id, hour, location, user_id FROM new_plays 
+                ON CONFLICT DO NOTHING 
+                RETURNING artist_id, hour, location
+            ), users AS (
+                SELECT artist_id, hour, location, count(*) AS users 
+                FROM new_users 
+                GROUP BY artist_id, hour, location
+            )
+            INSERT INTO artist_hour_location_plays 
+            SELECT p.artist_id, p.hour, p.location, p.plays, coalesce(u.users, 0) 
+            FROM plays p LEFT JOIN users u 
+            USING (artist_id, hour, location)
+            ON CONFLICT (artist_id, hour, location)
+            DO UPDATE
+            SET plays = artist_hour_location_plays.plays + EXCLUDED.plays, 
+            users = artist_hour_location_plays.users + EXCLUDED.users;
+""")
+
+artist_level_day_plays_update_template = ("""
+            WITH new_plays AS (
+                SELECT 
+                {artist_id} AS artist_id, 
+                coalesce(sp.level, '') AS level, 
+                ({ts})::date AS day, 
+                sp.user_id 
+                FROM songplays sp {artist_join}
+                WHERE sp.songplay_id > %(low)s AND sp.songplay_id <= %(high)s 
+                AND {artist_id} IS NOT NULL
+            ), plays AS (
+                SELECT artist_id, level, day, count(*) AS plays 
+                FROM new_plays 
+                GROUP BY artist_id, level, day
+            ), new_users AS (
+                INSERT INTO artist_level_day_users 
+                SELECT DISTINCT artist_id, level, day, user_id FROM new_plays 
+                ON CONFLICT DO NOTHING 
+                RETURNING artist_id, level, day
+            ), users AS (
+                SELECT artist_id, level, day, count(*) AS users 
+                FROM new_users 
+                GROUP BY artist_id, level, day
+            )
+            INSERT INTO artist_level_day_plays 
+            SELECT p.artist_id, p.level, p.day, p.plays, coalesce(u.users, 0) 
+            FROM plays p LEFT JOIN users u 
+            USING (artist_id, level, day)
+            ON CONFLICT (artist_id, level, day)
+            DO UPDATE
+            SET plays = artist_level_day_plays.plays + EXCLUDED.plays, 
+            users = artist_level_day_plays.users + EXCLUDED.users;
+""")
+
+# LOAD WATERMARKS
+
+load_watermark_advance = ("""
+            INSERT INTO load_watermark (table_name, loaded_at) 
+            SELECT unnest(%s::varchar[]), clock_timestamp()
+            ON CONFLICT (table_name)
+            DO UPDATE
+            SET loaded_at = EXCLUDED.loaded_at;
+""")
+
+load_watermark_select = "SELECT table_name, loaded_at FROM load_watermark;"
+load_watermark_listen = "LISTEN load_watermark;"
+load_watermark_notify = "NOTIFY load_watermark;"
+
+# ANALYTICS
+# parameterized versions of the common questions; times are passed as 
+# timestamps and compared against constant expressions of the 
+# songplays.start_time type so the songplays indexes stay usable
+
+top_artists_by_hour_location_select = ("""
+            SELECT a.name, count(DISTINCT u.user_id) AS users 
+            FROM artist_hour_location_users u 
+            JOIN artists a ON a.artist_id = u.artist_id 
+            WHERE u.hour >= %(min_hour)s AND u.hour <= %(max_hour)s 
+            AND u.location LIKE %(location)s 
+            GROUP BY a.name 
+            ORDER BY users DESC, a.name 
+            LIMIT %(limit)s;
+""")
+
+artist_revenue_by_location_select_template = ("""
+            SELECT sp.location, count(*) AS paid_plays 
+            FROM songplays sp 
+            JOIN artists a ON {artist_match} 
+            WHERE a.name = %(artist)s AND sp.level = 'paid' 
+            AND sp.location LIKE %(location)s 
+            GROUP BY sp.location 
+            ORDER BY paid_plays DESC, sp.location;
+""")
+
+artist_daily_plays_select = ("""
+            SELECT r.day, r.level, r.plays, r.users 
+            FROM artist_level_day_plays r 
+            JOIN artists a ON a.artist_id = r.artist_id 
+            WHERE a.name = %(artist)s 
+            AND r.day >= %(start)s AND r.day < %(end)s 
+            ORDER BY r.day, r.level;
+""")
+
+top_songs_select_template = ("""
+            SELECT s.title, a.name, count(*) AS plays 
+            FROM songplays sp 
+            JOIN songs s ON {song_match} 
+            JOIN artists a ON {artist_match} 
+            WHERE sp.start_time >= {start} AND sp.start_time < {end} 
+            GROUP BY s.title, a.name 
+            ORDER BY plays DESC, s.title 
+            LIMIT %(limit)s;
+""")
+
+user_plays_select_template = ("""
+            SELECT {ts} AS played_at, 
+            s.title, a.name, sp.level 
+            FROM songplays sp 
+            LEFT JOIN songs s ON {song_match} 
+            LEFT JOIN artists a ON {artist_match} 
+            WHERE sp.user_id = %(user_id)s 
+            AND sp.start_time >= {start} AND sp.start_time < {end} 
+            ORDER BY sp.start_time;
+""")
+
+plays_by_hour_select_template = ("""
+            SELECT extract(hour FROM {ts})::int AS hour, 
+            count(*) AS plays, count(DISTINCT sp.user_id) AS users 
+            FROM songplays sp 
+            WHERE sp.start_time >= {start} AND sp.start_time < {end} 
+            GROUP BY 1 
+            ORDER BY 1;
+""")
+
+# the layout-dependent parts of the songplays queries, for the bigint 
+# (epoch seconds, natural keys) and the typed layout: 
+# * ts songplays.start_time as a UTC timestamp
+# * start, end timestamp parameters as songplays.start_time values; the 
+#   epoch seconds are rounded up to bigint, which keeps the half-open 
+#   range of the timestamps and lets the bigint start_time be compared 
+#   (and its index used) without a cast to numeric
+# * song_match, artist_match join conditions of songplays sp to songs s 
+#   and artists a
+# * artist_id, artist_join the natural artist id of a songplay and the 
+#   join it needs
+SONGPLAY_LAYOUT = {
+    "ts": "to_timestamp(sp.start_time) AT TIME ZONE 'UTC'",
+    "start": "ceil(extract(epoch FROM %(start)s::timestamp))::bigint",
+    "end": "ceil(extract(epoch FROM %(end)s::timestamp))::bigint",
+    "song_match": "s.song_id = sp.song_id",
+    "artist_match": "a.artist_id = sp.artist_id",
+    "artist_id": "sp.artist_id",
+    "artist_join": "",
+}
+SONGPLAY_LAYOUT_TYPED = {
+    "ts": "sp.start_time",
+    "start": "%(start)s::timestamp",
+    "end": "%(end)s::timestamp",
+    "song_match": "s.song_key = sp.song_key",
+    "artist_match": "a.artist_key = sp.artist_key",
+    "artist_id": "a.artist_id",
+    "artist_join": "JOIN artists a ON a.artist_key = sp.artist_key",
+}
+
+artist_hour_location_plays_update = artist_hour_location_plays_update_template.format(**SONGPLAY_LAYOUT)
+artist_level_day_plays_update = artist_level_day_plays_update_template.format(**SONGPLAY_LAYOUT)
+artist_revenue_by_location_select = artist_revenue_by_location_select_template.format(**SONGPLAY_LAYOUT)
+top_songs_select = top_songs_select_template.format(**SONGPLAY_LAYOUT)
+user_plays_select = user_plays_select_template.format(**SONGPLAY_LAYOUT)
+plays_by_hour_select = plays_by_hour_select_template.format(**SONGPLAY_LAYOUT)
+
+artist_hour_location_plays_update_typed = artist_hour_location_plays_update_template.format(**SONGPLAY_LAYOUT_TYPED)
+artist_level_day_plays_update_typed = artist_level_day_plays_update_template.format(**SONGPLAY_LAYOUT_TYPED)
+artist_revenue_by_location_select_typed = artist_revenue_by_location_select_template.format(**SONGPLAY_LAYOUT_TYPED)
+top_songs_select_typed = top_songs_select_template.format(**SONGPLAY_LAYOUT_TYPED)
+user_plays_select_typed = user_plays_select_template.format(**SONGPLAY_LAYOUT_TYPED)
+plays_by_hour_select_typed = plays_by_hour_select_template.format(**SONGPLAY_LAYOUT_TYPED)
+
+# MIGRATION TO THE TYPED SCHEMA
+# the current table is renamed aside, the typed one is created under the 
+# original name and filled with converted rows; songs and artists go 
+# first so songplays can pick up their surrogate keys. The bigint 
+# songplays start_time was rounded to seconds; the time row it was 
+# rounded from is looked up to restore the exact timestamp
+
+table_row_size_select = "SELECT count(*), coalesce(avg(pg_column_size(t.*)), 0) FROM {table} t;"
+table_rename = "ALTER TABLE {table} RENAME TO {table}_legacy;"
+index_rename = "ALTER INDEX {table}_pkey RENAME TO {table}_legacy_pkey;"
+songplay_sequence_rename = "ALTER SEQUENCE songplays_songplay_id_seq RENAME TO songplays_legacy_songplay_id_seq;"
+legacy_table_drop = "DROP TABLE {table}_legacy CASCADE;"
+
+songplay_table_migrate = ("""
+            INSERT INTO songplays (
+            start_time, songplay_id, user_id, session_id, song_key, 
+            artist_key, level, location, user_agent) 
+            SELECT 
+            coalesce(
+                (SELECT min(t.start_time) FROM time t 
+                 WHERE t.start_time >= to_timestamp(l.start_time - 0.5) AT TIME ZONE 'UTC' 
+                 AND t.start_time < to_timestamp(l.start_time + 0.5) AT TIME ZONE 'UTC'), 
+                to_timestamp(l.start_time) AT TIME ZONE 'UTC'), 
+            l.songplay_id, l.user_id::int, l.session_id, s.song_key, 
+            a.artist_key, l.level, l.location, l.user_agent 
+            FROM songplays_legacy l 
+            LEFT JOIN songs s ON s.song_id = l.song_id 
+            LEFT JOIN artists a ON a.artist_id = l.artist_id;
+""")
+
+songplay_sequence_sync = ("""
+            SELECT setval(pg_get_serial_sequence('songplays', 'songplay_id'), 
+            coalesce(max(songplay_id), 0) + 1, false) FROM songplays;
+""")
+
+user_table_migrate = ("""
+            INSERT INTO users (user_id, gender, first_name, last_name, level) 
+            SELECT user_id::int, gender, first_name, last_name, level 
+            FROM users_legacy;
+""")
+
+song_table_migrate = ("""
+            INSERT INTO songs (duration, year, song_id, title, artist_id) 
+            SELECT duration, year, song_id, title, artist_id 
+            FROM songs_legacy;
+""")
+
+artist_table_migrate = ("""
+            INSERT INTO artists (latitude, longitude, artist_id, name, location) 
+            SELECT 
+            nullif(latitude, '')::double precision, 
+            nullif(longitude, '')::double precision, 
+            artist_id, name, location 
+            FROM artists_legacy;
+""")
+
+time_table_migrate = ("""
+            INSERT INTO time (start_time, year, hour, day, week, month, weekday) 
+            SELECT start_time, year, hour, day, week, month, weekday 
+            FROM time_legacy;
+""")
+
+# MANIFEST
+
+manifest_select = ("""
+            SELECT path, size, mtime, content_hash 
+            FROM load_manifest;
+""")
+
+# rows_loaded is kept when only size/mtime are refreshed (NULL passed)
+manifest_upsert = ("""
+            INSERT INTO load_manifest (
+            path, 
+            size, 
+            mtime, 
+            content_hash, 
+            rows_loaded) 
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (path)
+            DO UPDATE
+            SET size = EXCLUDED.size, 
+            mtime = EXCLUDED.mtime, 
+            content_hash = EXCLUDED.content_hash, 
+            rows_loaded = COALESCE(EXCLUDED.rows_loaded, load_manifest.rows_loaded), 
+            loaded_at = now();
+""")
+
+# TIME KEYS
+
+# epoch milliseconds of the rows already in time, loaded once per run
+time_keys_select = ("""
+            SELECT 
+            round(extract(epoch FROM start_time) * 1000)::bigint 
+            FROM time;
+""")
+
 # FIND SONGS
 
 
@@ -145,7 +831,147 @@ song_select = ("""
             AND songs.duration = %s AND songs.song_id is not null;
 """)
 
+# loaded once per run by song_index.load_song_index in place of song_select
+song_index_select = ("""
+            SELECT 
+            songs.title, 
+            artists.name, 
+            songs.duration, 
+            songs.song_id, 
+            artists.artist_id 
+            FROM songs JOIN artists 
+            ON songs.artist_id = artists.artist_id 
+            WHERE songs.song_id is not null;
+""")
+
+song_index_select_typed = ("""
+            SELECT 
+            songs.title, 
+            artists.name, 
+            songs.duration, 
+            songs.song_id, 
+            artists.artist_id, 
+            songs.song_key, 
+            artists.artist_key 
+            FROM songs JOIN artists 
+            ON songs.artist_id = artists.artist_id 
+            WHERE songs.song_id is not null;
+""")
+
+# DESCRIBE TABLES
+
+# column types for binary COPY, resolved through the search path so
+# temporary staging tables are found too
+column_types_select = ("""
+            SELECT 
+            attname, 
+            format_type(atttypid, NULL) 
+            FROM pg_attribute 
+            WHERE attrelid = %s::regclass 
+            AND attnum > 0 
+            AND NOT attisdropped;
+""")
+
+# SONGPLAY PARTITIONS
+
+songplays_partitioned_select = ("""
+            SELECT count(*) > 0 
+            FROM pg_partitioned_table 
+            WHERE partrelid = 'songplays'::regclass;
+""")
+
+songplay_partitions_select = ("""
+            SELECT c.relname 
+            FROM pg_inherits i JOIN pg_class c 
+            ON c.oid = i.inhrelid 
+            WHERE i.inhparent = 'songplays'::regclass;
+""")
+
+songplay_partition_create = ("""
+            CREATE TABLE IF NOT EXISTS {name} 
+            PARTITION OF songplays 
+            FOR VALUES FROM ({start}) TO ({end});
+""")
+
+songplay_partition_detach = "ALTER TABLE songplays DETACH PARTITION {name};"
+songplay_partition_drop = "DROP TABLE IF EXISTS {name};"
+
+# INDEXES
+# secondary indexes for the song lookups and the analytic filters on 
+# songplays; primary keys are not listed, ON CONFLICT needs them during loads
+
+index_catalog = [
+    # (index name, table, columns)
+    ("songs_title_duration_idx", "songs", "title, duration"),
+    ("songs_artist_id_idx", "songs", "artist_id"),
+    ("artists_name_idx", "artists", "name"),
+    ("songplays_start_time_idx", "songplays", "start_time"),
+    ("songplays_user_id_idx", "songplays", "user_id"),
+    ("songplays_artist_id_idx", "songplays", "artist_id"),
+]
+# the typed songplays reference artists by surrogate key
+typed_index_catalog = [entry for entry in index_catalog if entry[0] != "songplays_artist_id_idx"] + [
+    ("songplays_artist_key_idx", "songplays", "artist_key"),
+]
+
+index_create = "CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns});"
+index_drop = "DROP INDEX IF EXISTS {name};"
+table_analyze = "ANALYZE {table};"
+
+# SQLITE
+# the embedded SQLite target of sqlite_backend.py holds the star tables in
+# the original layout with the same DDL, except songplays, whose serial key
+# becomes an INTEGER PRIMARY KEY (the rowid), and the same secondary
+# indexes; rows are written with the postgres inserts, with ? placeholders
+
+sqlite_songplay_table_create = (""" CREATE TABLE IF NOT EXISTS songplays (
+            songplay_id INTEGER PRIMARY KEY, 
+            start_time bigint NOT NULL,
+            user_id varchar NOT NULL, 
+            level varchar(255), 
+            song_id varchar(255), 
+            artist_id varchar(255), 
+            session_id int, 
+            location varchar(255), 
+            user_agent varchar(255)
+            );""")
+
+sqlite_table_drop = "DROP TABLE IF EXISTS {table};"
+
+sqlite_inserts = {table: query.replace("%s", "?") for table, query in [
+    ("songs", song_table_insert),
+    ("artists", artist_table_insert),
+    ("users", user_table_insert),
+    ("time", time_table_insert),
+    ("songplays", songplay_table_insert),
+]}
+
+# epoch milliseconds of the rows already in time, whose start_time is
+# stored as 'YYYY-MM-DD HH:MM:SS.SSS' text
+sqlite_time_keys_select = ("""
+            SELECT 
+            CAST(strftime('%s', start_time) AS INTEGER) * 1000 
+            + CAST(substr(strftime('%f', start_time), 4) AS INTEGER) 
+            FROM time;
+""")
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_staging_create, manifest_table_create, artist_hour_location_plays_create, artist_hour_location_users_create, artist_level_day_plays_create, artist_level_day_users_create, rollup_watermark_create, load_watermark_create, song_match_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, songplay_staging_drop, manifest_table_drop, artist_hour_location_plays_drop, artist_hour_location_users_drop, artist_level_day_plays_drop, artist_level_day_users_drop, rollup_watermark_drop, load_watermark_drop, song_match_drop]
+create_index_queries = [index_create.format(name=name, table=table, columns=columns) for name, table, columns in index_catalog]
+create_index_queries_typed = [index_create.format(name=name, table=table, columns=columns) for name, table, columns in typed_index_catalog]
+drop_index_queries = [index_drop.format(name=name) for name in dict.fromkeys(name for name, table, columns in index_catalog + typed_index_catalog)]
+sqlite_create_table_queries = [sqlite_songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
+sqlite_drop_table_queries = [sqlite_table_drop.format(table=table) for table in ["songplays", "users", "songs", "artists", "time"]]
+analyze_queries = [table_analyze.format(table=table) for table in dict.fromkeys(table for name, table, columns in index_catalog)]
+rollup_updates = [("artist_hour_location_plays", artist_hour_location_plays_update), ("artist_level_day_plays", artist_level_day_plays_update)]
+rollup_updates_typed = [("artist_hour_location_plays", artist_hour_location_plays_update_typed), ("artist_level_day_plays", artist_level_day_plays_update_typed)]
+# (table, bigint layout create, typed create, migration), in migration order
+typed_tables = [
+    ("songs", song_table_create, song_table_create_typed, song_table_migrate),
+    ("artists", artist_table_create, artist_table_create_typed, artist_table_migrate),
+    ("users", user_table_create, user_table_create_typed, user_table_migrate),
+    ("time", time_table_create, time_table_create_typed, time_table_migrate),
+    ("songplays", songplay_table_create, songplay_table_create_typed, songplay_table_migrate),
+]
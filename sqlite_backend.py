@@ -0,0 +1,88 @@
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from sql_queries import sqlite_create_table_queries, \
+    sqlite_drop_table_queries, create_index_queries, song_index_select, \
+    sqlite_time_keys_select
+from song_index import SongIndex, SONG_INDEX_COLUMNS, DURATION_TOLERANCE
+from time_dimension import TimeDimension
+
+
+def connect(path):
+    """
+    This procedure opens the SQLite database at path (":memory:" for an
+    in-memory one) for a load: write-ahead logging with fsyncs at
+    checkpoints only, and numpy integers bound as python ints. The
+    connection may be used from another thread, like the writer thread of
+    async_etl.py, as long as one thread uses it at a time.
+
+    INPUTS:
+    * path the database file
+    """
+    sqlite3.register_adapter(np.int64, int)
+    sqlite3.register_adapter(np.int32, int)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    return conn
+
+
+def drop_tables(cur, conn):
+    for query in sqlite_drop_table_queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def create_tables(cur, conn):
+    """
+    Creates the star tables in the original layout and their secondary
+    indexes, where missing.
+    """
+    for query in sqlite_create_table_queries + create_index_queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def load_song_index(cur, tolerance=DURATION_TOLERANCE):
+    """
+    This procedure loads the song lookup index from the songs and artists
+    tables of a SQLite database, like song_index.load_song_index.
+
+    INPUTS:
+    * cur the cursor variable
+    * tolerance seconds an event length may differ from the duration
+    """
+    cur.execute(song_index_select)
+    return SongIndex(pd.DataFrame(cur.fetchall(), columns=SONG_INDEX_COLUMNS),
+                     tolerance)
+
+
+def load_time_dimension(cur):
+    """
+    This procedure creates a TimeDimension holding the timestamps already
+    in the time table of a SQLite database, like
+    TimeDimension.from_database.
+
+    INPUTS:
+    * cur the cursor variable
+    """
+    cur.execute(sqlite_time_keys_select)
+    return TimeDimension(row[0] for row in cur.fetchall())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Create the sparkify schema in a SQLite database.")
+    parser.add_argument("path", help="the database file")
+    args = parser.parse_args(argv)
+
+    conn = connect(args.path)
+    cur = conn.cursor()
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import struct
+import numpy as np
+import pandas as pd
+import pytest
+from binary_copy import encode_column, encode_rows, FIXED_WIDTH_TYPES, \
+    POSTGRES_EPOCH_US
+
+
+def decode_cells(cells, pg_type):
+    """
+    Reads the length-prefixed binary COPY cells back, None for NULL.
+    """
+    values = []
+    for cell in cells:
+        length, = struct.unpack(">i", cell[:4])
+        data = cell[4:]
+        if length == -1:
+            assert data == b""
+            values.append(None)
+            continue
+        assert len(data) == length
+        if pg_type in FIXED_WIDTH_TYPES:
+            values.append(np.frombuffer(data, FIXED_WIDTH_TYPES[pg_type])[0])
+        elif pg_type.startswith("timestamp"):
+            micros, = struct.unpack(">q", data)
+            values.append(np.datetime64(micros + POSTGRES_EPOCH_US, "us"))
+        else:
+            values.append(data.decode("utf-8"))
+    return values
+
+
+@pytest.mark.parametrize("pg_type", ["smallint", "integer", "bigint"])
+def test_integers(pg_type):
+    values = np.array([0, 1, -1, 12345, -32768, 32767])
+    assert decode_cells(encode_column(values, pg_type), pg_type) \
+        == values.tolist()
+
+
+def test_integers_with_nulls():
+    values = pd.Series([1, None, 3], dtype="Int64")
+    assert decode_cells(encode_column(values, "bigint"), "bigint") \
+        == [1, None, 3]
+
+
+@pytest.mark.parametrize("pg_type", ["real", "double precision"])
+def test_floats(pg_type):
+    values = np.array([0.0, -1.5, 266.0, np.nan, 1e30])
+    decoded = decode_cells(encode_column(values, pg_type), pg_type)
+    assert decoded[3] is None
+    expected = values.astype(FIXED_WIDTH_TYPES[pg_type]).tolist()
+    assert [decoded[i] for i in (0, 1, 2, 4)] \
+        == [expected[i] for i in (0, 1, 2, 4)]
+
+
+def test_text():
+    values = ["", "Ça va", None, np.nan, "multi\nline", 42]
+    assert decode_cells(encode_column(values, "character varying"),
+                        "text") == ["", "Ça va", None, None, "multi\nline", "42"]
+
+
+def test_timestamps():
+    values = np.array(["2018-11-15T00:30:26.796", "1999-12-31T23:59:59",
+                       "NaT"], dtype="datetime64[ms]")
+    decoded = decode_cells(encode_column(values, "timestamp without time zone"),
+                           "timestamp without time zone")
+    assert decoded[:2] == list(values[:2].astype("datetime64[us]"))
+    assert decoded[2] is None
+
+
+def test_unsupported_type():
+    with pytest.raises(ValueError):
+        encode_column([1], "numeric")
+
+
+def test_rows():
+    block = encode_rows([np.array([1, 2]), ["a", None]], ["integer", "text"],
+                        0, 2)
+    # field count, then each cell of the tuple, per row
+    assert block == (struct.pack(">hii", 2, 4, 1) + struct.pack(">i", 1) + b"a"
+                     + struct.pack(">hiii", 2, 4, 2, -1))
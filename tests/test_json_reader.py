@@ -0,0 +1,75 @@
+import glob
+import gzip
+import json
+import os
+import pandas as pd
+import pytest
+from json_reader import iter_log_events, iter_log_frames, read_log_frame, \
+    LOG_FIELDS
+
+LOG_FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..",
+                                          "data", "log_data", "*", "*",
+                                          "*.json")))
+
+
+def write_log(path, num_events):
+    pages = ["NextSong", "Home", "NextSong", "Logout"]
+    with open(path, "w") as f:
+        for i in range(num_events):
+            f.write(json.dumps({
+                "artist": "Artist {}".format(i % 7), "song": "Song {}".format(i),
+                "length": 200.0 + i, "page": pages[i % len(pages)],
+                "ts": 1541105830796 + i, "userId": str(i % 5),
+                "firstName": "F", "lastName": "L", "gender": "F",
+                "level": "free", "sessionId": i // 10,
+                "location": "Somewhere", "userAgent": "Agent",
+                # a field the reader does not keep, mentioning NextSong
+                "note": "not a NextSong" if i % 4 == 1 else None,
+            }) + "\n")
+    return path
+
+
+def test_pandas_equivalence(tmp_path):
+    path = write_log(str(tmp_path / "events.json"), 40)
+    expected = pd.read_json(path, lines=True)
+    expected = expected[expected["page"] == "NextSong"]
+    frame = read_log_frame(path)
+    assert list(frame.index) == list(expected.index)
+    assert list(frame["song"]) == list(expected["song"])
+    assert list(frame["ts"]) == list(expected["ts"])
+
+
+@pytest.mark.parametrize("chunk_bytes", [1, 500, 4096, 1 << 20])
+def test_chunks_add_up_to_the_file(tmp_path, chunk_bytes):
+    path = write_log(str(tmp_path / "events.json"), 200)
+    whole = read_log_frame(path)
+    chunks = list(iter_log_frames(path, chunk_bytes))
+    if chunk_bytes == 1:
+        # one event per chunk
+        assert len(chunks) == len(whole)
+    pd.testing.assert_frame_equal(pd.concat(chunks), whole)
+
+
+def test_chunks_of_the_bundled_logs():
+    assert LOG_FILES
+    for path in LOG_FILES[:5]:
+        whole = read_log_frame(path)
+        pd.testing.assert_frame_equal(
+            pd.concat(list(iter_log_frames(path, 16 << 10))), whole)
+
+
+def test_empty_file_yields_one_empty_chunk_when_not_chunked(tmp_path):
+    path = tmp_path / "empty.json"
+    path.write_text("")
+    (lines, columns), = iter_log_events(str(path))
+    assert len(lines) == 0 and set(columns) == set(LOG_FIELDS)
+    assert list(iter_log_events(str(path), chunk_bytes=100)) == []
+
+
+def test_gzip_reads_like_plain(tmp_path):
+    path = write_log(str(tmp_path / "events.json"), 50)
+    with open(path, "rb") as f, gzip.open(path + ".gz", "wb") as g:
+        g.write(f.read())
+    pd.testing.assert_frame_equal(
+        pd.concat(list(iter_log_frames(path + ".gz", 300))),
+        read_log_frame(path))
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+from song_index import SongIndex, match_keys, DURATION_TOLERANCE
+
+
+TITLES = ["Hello", "hello!", "Kiss Me (Remix)", "kiss  me remix", "Yellow",
+          None, "Ça va"]
+NAMES = ["Adele", "ADELE ", "Sixpence", "sixpence-", "Coldplay", None,
+         "Zaz"]
+
+
+def random_songs(rng, num_songs):
+    return pd.DataFrame({
+        "title": rng.choice(TITLES, num_songs),
+        "name": rng.choice(NAMES, num_songs),
+        # few distinct durations, so several songs tie on a key
+        "duration": rng.choice([180.0, 180.4, 181.2, 200.9, 201.0, np.nan],
+                               num_songs),
+        "song_id": ["S{:04d}".format(i) for i in rng.permutation(num_songs)],
+        "artist_id": ["A{:04d}".format(i) for i in range(num_songs)],
+    })
+
+
+def brute_force(songs, titles, names, lengths, tolerance):
+    """
+    The closest song within tolerance per event, then the lowest song_id,
+    comparing every event against every song.
+    """
+    song_titles = match_keys(songs["title"])
+    song_names = match_keys(songs["name"])
+    event_titles = match_keys(titles)
+    event_names = match_keys(names)
+    best = []
+    for title, name, length in zip(event_titles, event_names, lengths):
+        candidates = []
+        for i, song in enumerate(songs.itertuples()):
+            if (pd.isna(title) or pd.isna(name) or pd.isna(length)
+                    or pd.isna(song.duration)
+                    or song_titles[i] != title or song_names[i] != name):
+                continue
+            distance = abs(song.duration - length)
+            if distance <= tolerance:
+                candidates.append((distance, song.song_id))
+        best.append(min(candidates)[1] if candidates else None)
+    return best
+
+
+def test_match_keys():
+    keys = match_keys(["Kiss Me (Remix)", "  kiss_me--remix ", None])
+    assert keys[0] == keys[1] == "kiss me remix"
+    assert keys[2] is None
+
+
+def test_match_against_brute_force():
+    rng = np.random.default_rng(7)
+    songs = random_songs(rng, 60)
+    num_events = 500
+    titles = rng.choice(TITLES, num_events)
+    names = rng.choice(NAMES, num_events)
+    lengths = rng.choice([179.0, 179.5, 180.2, 181.0, 182.5, 200.0, 201.9,
+                          np.nan], num_events)
+    for tolerance in (0.0, 0.5, DURATION_TOLERANCE, 2.5):
+        index = SongIndex(songs, tolerance)
+        positions = index.match(titles, names, lengths)
+        song_ids = index._values["song_id"]
+        found = [song_ids[p] if p >= 0 else None for p in positions]
+        assert found == brute_force(songs, titles, names, lengths, tolerance)
+
+
+def test_resolve_counts_and_rollback():
+    songs = pd.DataFrame({"title": ["Yellow"], "name": ["Coldplay"],
+                          "duration": [266.0], "song_id": ["S1"],
+                          "artist_id": ["A1"]})
+    index = SongIndex(songs)
+    events = pd.DataFrame({"song": ["yellow", "Blue"],
+                           "artist": ["Coldplay", "Coldplay"],
+                           "length": [266.4, 266.0]}, index=[3, 8])
+    index.begin()
+    resolved = index.resolve(events)
+    assert list(resolved.index) == [3, 8]
+    assert list(resolved["song_id"]) == ["S1", None]
+    assert list(resolved["artist_id"]) == ["A1", None]
+    assert (index.events, index.matched) == (2, 1)
+    index.rollback()
+    assert (index.events, index.matched) == (0, 0)
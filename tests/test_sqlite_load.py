@@ -0,0 +1,65 @@
+import glob
+import os
+import pandas as pd
+import etl
+import sqlite_backend
+from conftest import ROOT
+
+
+def read_json_tree(directory):
+    return pd.concat([pd.read_json(path, lines=True) for path in sorted(
+        glob.glob(os.path.join(ROOT, "data", directory, "**", "*.json"),
+                  recursive=True))], ignore_index=True)
+
+
+def count(cur, query):
+    cur.execute(query)
+    return cur.fetchone()[0]
+
+
+def test_load_bundled_data(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    path = str(tmp_path / "sparkify.db")
+    etl.main(["--sqlite", path])
+
+    songs = read_json_tree("song_data")
+    events = read_json_tree("log_data")
+    events = events[events["page"] == "NextSong"]
+    # some files have the user ids as strings
+    events = events.assign(userId=events["userId"].astype(int))
+    conn = sqlite_backend.connect(path)
+    cur = conn.cursor()
+    assert count(cur, "SELECT count(*) FROM songs;") \
+        == songs["song_id"].nunique()
+    assert count(cur, "SELECT count(*) FROM artists;") \
+        == songs["artist_id"].nunique()
+    assert count(cur, "SELECT count(*) FROM users;") \
+        == events["userId"].nunique()
+    assert count(cur, "SELECT count(*) FROM time;") == events["ts"].nunique()
+    # the bundled logs are a sample: a single event matches a song file
+    assert count(cur, """SELECT count(*) FROM songplays
+                         WHERE song_id IS NOT NULL
+                         AND artist_id IS NOT NULL;""") == 1
+    # users keep the level of their last event
+    last = events.groupby("userId")["level"].last()
+    cur.execute("SELECT user_id, level FROM users;")
+    assert {int(user): level for user, level in cur.fetchall()} \
+        == last.to_dict()
+    conn.close()
+
+
+def test_reload_is_idempotent(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    path = str(tmp_path / "sparkify.db")
+    etl.main(["--sqlite", path])
+    conn = sqlite_backend.connect(path)
+    cur = conn.cursor()
+    before = [count(cur, "SELECT count(*) FROM {};".format(table))
+              for table in ("songs", "artists", "users", "time")]
+    conn.close()
+    etl.main(["--sqlite", path, "--commit-files", "3"])
+    conn = sqlite_backend.connect(path)
+    cur = conn.cursor()
+    assert [count(cur, "SELECT count(*) FROM {};".format(table))
+            for table in ("songs", "artists", "users", "time")] == before
+    conn.close()
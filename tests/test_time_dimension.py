@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+from time_dimension import time_records, civil_from_days, days_from_civil, \
+    TimeDimension, MS_PER_DAY
+from sinks import CountingSink
+
+
+def test_time_records_match_pandas():
+    rng = np.random.default_rng(11)
+    # random instants from 1950 to 2050, plus the days around new year
+    # where the ISO week belongs to the other year
+    ts = rng.integers(-630720000000, 2524608000000, 20000)
+    new_years = pd.to_datetime(["{}-12-{}".format(year, day)
+                                for year in range(1995, 2030)
+                                for day in (28, 29, 30, 31)]
+                               + ["{}-01-0{}".format(year, day)
+                                  for year in range(1995, 2030)
+                                  for day in (1, 2, 3, 4)])
+    ts = np.concatenate([ts, new_years.values.astype("datetime64[ms]")
+                         .astype(np.int64) + 12345])
+
+    records = time_records(ts)
+    t = pd.Series(pd.to_datetime(ts, unit="ms"))
+    assert (records["start_time"] == t.values).all()
+    assert (records["hour"] == t.dt.hour.values).all()
+    assert (records["day"] == t.dt.day.values).all()
+    assert (records["week"] == t.dt.isocalendar().week.values).all()
+    assert (records["month"] == t.dt.month.values).all()
+    assert (records["year"] == t.dt.year.values).all()
+    assert (records["weekday"] == t.dt.weekday.values).all()
+
+
+def test_civil_round_trip():
+    days = np.arange(-800000, 800000, 7)
+    assert (days_from_civil(*civil_from_days(days)) == days).all()
+
+
+def test_time_dimension_forgets_rolled_back_timestamps():
+    sink = CountingSink()
+    dimension = TimeDimension([0])
+    dimension.begin()
+    assert dimension.add(None, [MS_PER_DAY, 0, MS_PER_DAY], sink) == 1
+    assert dimension.add(None, [MS_PER_DAY], sink) == 0
+    dimension.rollback()
+    assert dimension.known == {0}
+    assert dimension.add(None, [MS_PER_DAY], sink) == 1
@@ -0,0 +1,154 @@
+import numpy as np
+from binary_copy import copy_columns
+from sql_queries import time_keys_select
+
+
+MS_PER_HOUR = 3600 * 1000
+MS_PER_DAY = 24 * MS_PER_HOUR
+
+
+def civil_from_days(days):
+    """
+    This procedure converts days since 1970-01-01 to (year, month, day)
+    arrays with integer arithmetic only (proleptic gregorian calendar).
+    """
+    z = days + 719468
+    era = np.floor_divide(z, 146097)
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    year = yoe + era * 400 + (month <= 2)
+    return year, month, day
+
+
+def days_from_civil(year, month, day):
+    """
+    This procedure is the inverse of civil_from_days.
+    """
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    yoe = year - era * 400
+    mp = np.where(month > 2, month - 3, month + 9)
+    doy = (153 * mp + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def time_records(ts):
+    """
+    This procedure builds the time table columns for an array of epoch
+    millisecond timestamps.
+    hour, day, month and year are those of the UTC timestamp, week is the
+    ISO week number and weekday counts from Monday = 0, matching the
+    pandas .dt accessors used before.
+
+    INPUTS:
+    * ts int64 array of epoch milliseconds
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    days = np.floor_divide(ts, MS_PER_DAY)
+    year, month, day = civil_from_days(days)
+    # 1970-01-01 was a Thursday
+    weekday = (days + 3) % 7
+
+    # the ISO week belongs to the year of its Thursday
+    thursday = days - weekday + 3
+    iso_year = civil_from_days(thursday)[0]
+    jan1 = days_from_civil(iso_year, np.ones_like(iso_year),
+                           np.ones_like(iso_year))
+    week = (thursday - jan1) // 7 + 1
+
+    return {
+        "start_time": ts.astype("datetime64[ms]"),
+        "hour": np.floor_divide(ts, MS_PER_HOUR) % 24,
+        "day": day,
+        "week": week,
+        "month": month,
+        "year": year,
+        "weekday": weekday,
+    }
+
+
+class TimeDimension:
+    """
+    Run-wide set of the timestamps already in the time table.
+    add() loads the rows of timestamps not seen yet with one COPY, so each
+    time row is computed and written once per run and the load never
+    relies on ON CONFLICT.
+    """
+
+    def __init__(self, known=()):
+        self.known = set(known)
+        # timestamps added since the last commit, while tracking
+        self._uncommitted = None
+
+    @classmethod
+    def from_database(cls, cur):
+        """
+        This procedure creates a TimeDimension holding the timestamps
+        already in the time table.
+
+        INPUTS:
+        * cur the cursor variable
+        """
+        cur.execute(time_keys_select)
+        return cls(row[0] for row in cur.fetchall())
+
+    def new_timestamps(self, ts):
+        """
+        This procedure returns the distinct timestamps of ts that are not
+        in the time table yet, in ascending order.
+
+        INPUTS:
+        * ts array of epoch milliseconds
+        """
+        unique = np.unique(np.asarray(ts, dtype=np.int64))
+        known = self.known
+        is_new = np.fromiter((t not in known for t in unique.tolist()),
+                             dtype=bool, count=len(unique))
+        return unique[is_new]
+
+    def add(self, cur, ts, sink=None):
+        """
+        This procedure COPYs the time rows of the new timestamps of ts into
+        the time table, or writes them to sink, and returns the number of
+        rows loaded.
+
+        INPUTS:
+        * cur the cursor variable
+        * ts array of epoch milliseconds
+        * sink a sinks.Sink to write the rows to instead
+        """
+        new = self.new_timestamps(ts)
+        if len(new):
+            if sink is None:
+                copy_columns(cur, "time", time_records(new))
+            else:
+                sink.write("time", time_records(new))
+            self.known.update(new.tolist())
+            if self._uncommitted is not None:
+                self._uncommitted.extend(new.tolist())
+        return len(new)
+
+    def begin(self):
+        """
+        This procedure starts tracking the timestamps added in the open
+        transaction, so they can be forgotten if it is rolled back.
+        """
+        self._uncommitted = []
+
+    def commit(self):
+        if self._uncommitted is not None:
+            self._uncommitted = []
+
+    def rollback(self):
+        """
+        This procedure forgets the timestamps added since the last commit,
+        whose time rows were rolled back with the transaction.
+        """
+        if self._uncommitted:
+            self.known.difference_update(self._uncommitted)
+            self._uncommitted = []
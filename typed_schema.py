@@ -0,0 +1,130 @@
+import argparse
+import psycopg2
+import numpy as np
+from binary_copy import get_column_types, TIMESTAMP_TYPES
+from sql_queries import typed_tables, table_row_size_select, table_rename, \
+    index_rename, songplay_sequence_rename, songplay_sequence_sync, \
+    legacy_table_drop, songplays_partitioned_select, create_index_queries_typed, \
+    song_match_truncate
+
+
+def is_typed_schema(cur):
+    """
+    This procedure returns whether the star tables use the typed layout,
+    told by the type of songplays.start_time.
+
+    INPUTS:
+    * cur the cursor variable
+    """
+    return get_column_types(cur, "songplays").get("start_time") in TIMESTAMP_TYPES
+
+
+def songplay_start_time(ts, typed=False):
+    """
+    This procedure converts event timestamps to songplays.start_time
+    values: epoch seconds rounded from the milliseconds for the bigint
+    layout, the exact timestamp (the time table key) for the typed one.
+
+    INPUTS:
+    * ts array of epoch milliseconds
+    * typed whether songplays uses the typed layout
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    if typed:
+        return ts.astype("datetime64[ms]")
+    return np.round(ts / 1000.0).astype(np.int64)
+
+
+def row_sizes(cur):
+    """
+    This procedure returns a dict of star table -> (rows, average row size
+    in bytes), the row size being that of the row data without the tuple
+    header.
+
+    INPUTS:
+    * cur the cursor variable
+    """
+    sizes = {}
+    for table, *queries in typed_tables:
+        cur.execute(table_row_size_select.format(table=table))
+        rows, size = cur.fetchone()
+        sizes[table] = (rows, float(size))
+    return sizes
+
+
+def migrate(cur, conn):
+    """
+    This procedure converts the star tables from the bigint layout to the
+    typed layout in one transaction: each table is renamed aside, created
+    again with the typed layout and filled with the converted rows, then
+    the old tables are dropped and the secondary indexes rebuilt.
+    Returns the row sizes before and after, see row_sizes.
+
+    INPUTS:
+    * cur the cursor variable
+    * conn the connection variable
+    """
+    if is_typed_schema(cur):
+        raise ValueError("the tables already use the typed layout")
+    cur.execute(songplays_partitioned_select)
+    if cur.fetchone()[0]:
+        raise ValueError("partitioned songplays can not be migrated in place; "
+                         "recreate the tables with create_tables.py "
+                         "--typed-schema --partition-songplays and reload")
+    before = row_sizes(cur)
+    try:
+        for table, create, create_typed, migrate_query in typed_tables:
+            cur.execute(table_rename.format(table=table))
+            cur.execute(index_rename.format(table=table))
+            if table == "songplays":
+                cur.execute(songplay_sequence_rename)
+            cur.execute(create_typed)
+            cur.execute(migrate_query)
+            if table == "songplays":
+                cur.execute(songplay_sequence_sync)
+        for table, *queries in typed_tables:
+            cur.execute(legacy_table_drop.format(table=table))
+        for query in create_index_queries_typed:
+            cur.execute(query)
+        # matched again with the surrogate keys on the next staged load
+        cur.execute(song_match_truncate)
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    return before, row_sizes(cur)
+
+
+def size_report(before, after):
+    """
+    This procedure formats the per-row size of every table before and after
+    the migration.
+
+    INPUTS:
+    * before, after the row sizes returned by migrate
+    """
+    lines = ["{:<10} {:>10} {:>12} {:>12} {:>12}".format(
+        "table", "rows", "bytes/row", "typed", "saved/row")]
+    for table, (rows, size) in before.items():
+        typed_size = after[table][1]
+        lines.append("{:<10} {:>10} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+            table, rows, size, typed_size, size - typed_size))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Migrate the sparkify star tables to the typed layout.")
+    parser.add_argument("--dsn", default="host=127.0.0.1 dbname=sparkifydb "
+                                         "user=student password=student")
+    args = parser.parse_args(argv)
+
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    before, after = migrate(cur, conn)
+    print(size_report(before, after))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()